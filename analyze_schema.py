@@ -1,19 +1,93 @@
+import numpy as np
 import pandas as pd
-import glob
 import os
 from pathlib import Path
 from downloader import HERDDownloader
+from raw_files import default_cache_dir, file_year, list_raw_files, raw_header, read_raw_chunks
 
 # Setup paths
 BASE_DIR = Path(__file__).parent
 DATA_DIR = BASE_DIR / "data" / "raw"
 
-def get_label_val(row, potential_cols):
-    """Helper to extract text from the first existing column found."""
-    for col in potential_cols:
-        if col in row and pd.notna(row[col]):
-            return str(row[col]).strip()
-    return ""
+def _text(values):
+    """Label values as stripped strings ('nan' for missing, like str())."""
+    return values.astype(object).fillna('nan').astype(str).str.strip()
+
+def _first_label(df, label_cols):
+    """Per row, the first non-empty of the candidate label columns ("" if none)."""
+    if not label_cols:
+        return pd.Series("", index=df.index)
+    first = df[label_cols].astype(object).bfill(axis=1).iloc[:, 0]
+    return first.fillna("").astype(str).str.strip()
+
+def read_year_schema(file_path, cache_dir=None):
+    """
+    Distinct (qid, row, col, question) tuples of one raw year. Only the label
+    columns are loaded, and only their distinct combinations are normalized.
+    """
+    # Normalize column names to lowercase for easier detection
+    header = [c.lower() for c in raw_header(file_path, cache_dir)]
+
+    # Identify which columns hold the labels
+    row_cols = [c for c in header if c in ['row', 'row_label', 'question_label']]
+    col_cols = [c for c in header if c in ['column', 'column_label', 'col']]
+
+    # We want unique combinations of: No, Question, Row, Column
+    cols_to_use = ['questionnaire_no', 'question'] + row_cols + col_cols
+    chunks = [
+        chunk[cols_to_use].drop_duplicates()
+        for chunk in read_raw_chunks(file_path, cols_to_use, cache_dir=cache_dir)
+    ]
+    if not chunks:
+        return pd.DataFrame(columns=['qid', 'row', 'col', 'question'])
+    df = pd.concat(chunks, ignore_index=True).drop_duplicates()
+
+    schema = pd.DataFrame({
+        'qid': _text(df['questionnaire_no']),
+        'row': _first_label(df, row_cols),
+        'col': _first_label(df, col_cols),
+        'question': _text(df['question']),
+    })
+    valid = (schema['qid'] != "") & (schema['qid'].str.lower() != 'nan')
+    return schema[valid]
+
+def schema_report(schema, all_years):
+    """
+    Report rows for every (qid, row, col) data point in `schema`, a frame of
+    (qid, row, col, question, year) tuples in file order.
+    """
+    keys = ['qid', 'row', 'col']
+    schema = schema.assign(key_id=schema.groupby(keys, sort=False).ngroup())
+    # One description per data point and year: the last one seen wins
+    schema = schema.drop_duplicates(['key_id', 'year'], keep='last')
+
+    by_key = schema.groupby('key_id')
+    report = by_key.agg(
+        first_year=('year', 'min'), last_year=('year', 'max'),
+        description_count=('question', 'nunique'),
+    )
+    latest = schema.loc[by_key['year'].idxmax(), ['key_id'] + keys + ['question']].set_index('key_id')
+    report = latest.join(report)
+
+    # Status Logic
+    starts = report['first_year'] == all_years[0]
+    ends = report['last_year'] == all_years[-1]
+    status = np.select(
+        [starts & ends, starts, ends],
+        ["Consistent", "Removed", "New / Added"],
+        default="Intermittent",
+    )
+
+    return pd.DataFrame({
+        "Question ID": report['qid'],
+        "Row Label": report['row'],
+        "Column Label": report['col'],
+        "Question Text": report['question'],
+        "Status": status,
+        "First Year": report['first_year'],
+        "Last Year": report['last_year'],
+        "Description Count": report['description_count'],
+    }).reset_index(drop=True)
 
 def analyze_schema_changes():
     # 1. Ensure Data is Present
@@ -21,8 +95,7 @@ def analyze_schema_changes():
     downloader = HERDDownloader(DATA_DIR)
     downloader.run(start_year=2010)
 
-    csv_files = glob.glob(str(DATA_DIR / "*.csv"))
-    csv_files.sort()
+    csv_files = list_raw_files(DATA_DIR)
     
     if not csv_files:
         print("❌ No files found.")
@@ -30,93 +103,30 @@ def analyze_schema_changes():
 
     print(f"\n🔍 Analyzing Detailed Schema (ID + Row + Column) across {len(csv_files)} years...")
     
-    # Master storage: { unique_key : { year: description } }
-    # unique_key = (questionnaire_no, row_label, column_label)
-    schema_history = {}
+    # Distinct (questionnaire_no, row_label, column_label, question) per year
+    cache_dir = default_cache_dir(DATA_DIR)
+    frames = []
     all_years = []
 
     # 2. Scan every file
     for file_path in csv_files:
+        filename = os.path.basename(file_path)
+        year = file_year(file_path)
+        all_years.append(year)
         try:
-            filename = os.path.basename(file_path)
-            year_str = "".join(filter(str.isdigit, filename))
-            year = int(year_str) if year_str else 0
-            all_years.append(year)
-            
-            # Read file (read all cols to ensure we catch row/col labels)
-            # Using low_memory=False to prevent mixed-type warnings
-            df = pd.read_csv(file_path, encoding='latin-1', low_memory=False, dtype=str)
-            
-            # Normalize column names to lowercase for easier detection
-            df.columns = [c.lower() for c in df.columns]
-            
-            # Identify which columns hold the labels
-            row_cols = [c for c in df.columns if c in ['row', 'row_label', 'question_label']]
-            col_cols = [c for c in df.columns if c in ['column', 'column_label', 'col']]
-            
-            # Extract unique schema definitions
-            # We want unique combinations of: No, Question, Row, Column
-            cols_to_use = ['questionnaire_no', 'question'] + row_cols + col_cols
-            unique_rows = df[cols_to_use].drop_duplicates().to_dict('records')
-            
-            for item in unique_rows:
-                qid = str(item.get('questionnaire_no', '')).strip()
-                desc = str(item.get('question', '')).strip()
-                
-                # Get Row/Col labels safely
-                row_lbl = get_label_val(item, row_cols)
-                col_lbl = get_label_val(item, col_cols)
-                
-                if not qid or qid.lower() == 'nan': continue
-
-                # Create a composite key to track this specific data point
-                # e.g. ("09B01", "Aerospace Engineering", "")
-                unique_key = (qid, row_lbl, col_lbl)
-                
-                if unique_key not in schema_history:
-                    schema_history[unique_key] = {}
-                
-                schema_history[unique_key][year] = desc
-                
+            frames.append(read_year_schema(file_path, cache_dir).assign(year=year))
         except Exception as e:
             print(f"   ❌ Error reading {filename}: {e}")
 
     # 3. Generate Analysis Report
     print("\n📊 Generating Report...")
-    report_data = []
-    
-    for (qid, row_lbl, col_lbl), history in schema_history.items():
-        years_active = sorted(history.keys())
-        first_year = years_active[0]
-        last_year = years_active[-1]
-        latest_desc = history[last_year]
-        
-        # Status Logic
-        if first_year == all_years[0] and last_year == all_years[-1]:
-            status = "Consistent"
-        elif first_year == all_years[0]:
-            status = "Removed"
-        elif last_year == all_years[-1]:
-            status = "New / Added"
-        else:
-            status = "Intermittent"
-
-        report_data.append({
-            "Question ID": qid,
-            "Row Label": row_lbl,
-            "Column Label": col_lbl,
-            "Question Text": latest_desc,
-            "Status": status,
-            "First Year": first_year,
-            "Last Year": last_year,
-            "Description Count": len(set(history.values()))
-        })
-
-    if not report_data:
+    schema = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    if schema.empty:
         print("⚠️ No schema found.")
         return
 
-    report_df = pd.DataFrame(report_data)
+    report_df = schema_report(schema, all_years)
     
     # Sort for readability: ID -> Row Label
     report_df = report_df.sort_values(["Question ID", "Row Label"])
@@ -0,0 +1,1304 @@
+"""
+Offline benchmarks for the HERD pipeline.
+
+Everything runs against synthetic, HERD-shaped data generated from
+mapping.json, so no download or real herd.db is needed:
+
+    uv run benchmarks.py etl --workers 4
+    uv run benchmarks.py incremental
+    uv run benchmarks.py matching
+    uv run benchmarks.py mapping --scale 20
+    uv run benchmarks.py schema
+    uv run benchmarks.py queries --clients 32
+    uv run benchmarks.py snapshot
+    uv run benchmarks.py names
+    uv run benchmarks.py parity
+    uv run benchmarks.py pgsql
+    uv run benchmarks.py download
+    uv run benchmarks.py agent --questions 200 --concurrency 16
+    uv run benchmarks.py imports
+"""
+import argparse
+import asyncio
+import csv
+import hashlib
+import io
+import itertools
+import json
+import math
+import random
+import re
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from contextlib import contextmanager, nullcontext, redirect_stdout
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import analyze_schema
+import compiled_mapping
+import etl
+import generate_mapping
+import local_agent
+import name_index
+import snapshot
+import storage
+from downloader import HERDDownloader
+from matching import MappingIndex
+from query_engine import QueryEngine, QueryNotAllowed
+from raw_files import file_year, read_raw
+from sql_validator import InvalidSQL, SQLValidator
+
+# Columns of a raw HERD microdata file, in file order
+RAW_COLUMNS = [
+    'inst_id', 'year', 'ncses_inst_id', 'inst_name_long', 'inst_city', 'inst_state_code',
+    'questionnaire_no', 'question', 'row', 'column', 'data',
+]
+
+def make_synthetic_raw(out_dir, n_inst=200, years=range(2010, 2025), density=0.7, seed=0):
+    """
+    Writes one herd_{year}_*.csv per year with rows for the mapping entries
+    active that year (plus some unmapped noise), like the NSF files.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    with open(etl.MAPPING_PATH) as f:
+        entries = [info for items in json.load(f).values() for info in items.values()]
+
+    rng = random.Random(seed)
+    paths = []
+    for year in years:
+        active = [e for e in entries if e['start_year'] <= year <= e['end_year']]
+        path = out_dir / f"herd_{year}_herd_{year}.csv"
+        with open(path, 'w', newline='', encoding='latin-1') as f:
+            writer = csv.writer(f)
+            writer.writerow(RAW_COLUMNS)
+            for i in range(n_inst):
+                inst_id = f"{100000 + i:06d}"
+                # Some schools change name over time; the latest name should win
+                name = f"University {i} ({year})" if i % 7 == 0 else f"University {i}"
+                state = ('TX', 'CA', 'NY', 'FL')[i % 4]
+                base = [inst_id, year, f"R{i:05d}", name, f"City {i % 50}", state]
+                for e in active:
+                    if rng.random() > density:
+                        continue
+                    writer.writerow(base + [
+                        e['question_id'], e['description'].split(':')[0],
+                        e['row_match'] or '', e['col_match'] or '', rng.randint(0, 500_000),
+                    ])
+                writer.writerow(base + ['99', 'Unmapped question', 'Other', 'Other', 1])
+        paths.append(path)
+    return paths
+
+def _dump_database(db_path, by_name=False):
+    """
+    {table: (columns, sorted rows)} of every table and view a load writes
+    (not the manifest or SQLite's internals), columns in stored order or,
+    with `by_name`, sorted by name.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        names = [name for name, in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite_%' "
+            "AND name NOT LIKE 'institution_search_%' AND name != 'etl_manifest' ORDER BY name")]
+        tables = {}
+        for name in names:
+            cursor = conn.execute(f'SELECT * FROM "{name}"')
+            columns = [d[0] for d in cursor.description]
+            order = sorted(range(len(columns)), key=columns.__getitem__) if by_name else range(len(columns))
+            rows = sorted((tuple(row[i] for i in order) for row in cursor), key=repr)
+            tables[name] = ([columns[i] for i in order], rows)
+        return tables
+    finally:
+        conn.close()
+
+def _dump_differences(a, b):
+    """Tables whose columns or rows differ between two _dump_database results."""
+    return [name for name in sorted(a.keys() | b.keys())
+            if name not in a or name not in b or a[name][0] != b[name][0] or not _same_rows(a[name][1], b[name][1])]
+
+def bench_etl(args):
+    """Full rebuild with 1 worker vs N workers; both databases must match."""
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        print(f"🧪 Generating {args.institutions} institutions x 15 years...")
+        make_synthetic_raw(tmp / "raw", n_inst=args.institutions)
+
+        timings = {}
+        for workers in sorted({1, args.workers}):
+            db_path = tmp / f"herd_{workers}.db"
+            start = time.perf_counter()
+            etl.run_etl(full_rebuild=True, workers=workers, data_dir=tmp / "raw",
+                        db_path=db_path, download=False)
+            timings[workers] = time.perf_counter() - start
+
+        if args.workers != 1:
+            differing = _dump_differences(_dump_database(tmp / "herd_1.db"),
+                                          _dump_database(tmp / f"herd_{args.workers}.db"))
+            print(f"\n🔍 Serial and parallel databases identical: {not differing}")
+            if differing:
+                print(f"❌ Tables that differ: {', '.join(differing)}")
+                raise SystemExit(1)
+
+        print("\n⏱️  Full rebuild")
+        for workers, seconds in timings.items():
+            print(f"   {workers:>2} worker(s): {seconds:7.2f}s  (x{timings[1] / seconds:.2f})")
+
+def _string_lookup_map(full_config):
+    """The original "qid|row|col" string dictionary etl.py used to build."""
+    lookup_map = {}
+    for items in full_config.values():
+        for key, info in items.items():
+            r_lbl = str(info['row_match']) if info['row_match'] else ""
+            c_lbl = str(info['col_match']) if info['col_match'] else ""
+            lookup_map[f"{info['question_id']}|{r_lbl}|{c_lbl}".lower()] = key
+    return lookup_map
+
+def _match_strings(df, lookup_map):
+    """Reference implementation: per-row string fingerprint + dict map."""
+    qid_str = df['questionnaire_no'].astype(str)
+    row_series = df['row'].fillna("").astype(str)
+    col_series = df['column'].fillna("").astype(str)
+    return (qid_str + "|" + row_series + "|" + col_series).str.lower().map(lookup_map)
+
+def _best_of(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def bench_matching(args):
+    """String fingerprint + dict vs integer-coded MappingIndex on one year."""
+    with open(etl.MAPPING_PATH) as f:
+        full_config = json.load(f)
+    lookup_map = _string_lookup_map(full_config)
+    mapping_index = MappingIndex.from_config(full_config)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"🧪 Generating one year for {args.institutions} institutions...")
+        path, = make_synthetic_raw(tmp, n_inst=args.institutions, years=[2024])
+        df = pd.read_csv(path, encoding='latin-1', dtype={'inst_id': str}, low_memory=False)
+        labels = ['questionnaire_no', 'row', 'column']
+        df_cat = pd.read_csv(path, encoding='latin-1', usecols=labels, dtype='category')
+    print(f"   {len(df):,} raw rows")
+
+    t_str, by_string = _best_of(lambda: _match_strings(df, lookup_map), args.repeat)
+    t_obj, codes = _best_of(lambda: mapping_index.match(df['questionnaire_no'], df['row'], df['column']), args.repeat)
+    t_cat, codes_cat = _best_of(
+        lambda: mapping_index.match(df_cat['questionnaire_no'], df_cat['row'], df_cat['column']), args.repeat
+    )
+
+    matched = by_string.notna().to_numpy()
+    same = (
+        np.array_equal(matched, codes >= 0)
+        and np.array_equal(by_string[matched].to_numpy(dtype=object), mapping_index.names[codes[matched]])
+        and np.array_equal(codes, codes_cat)
+    )
+    print(f"\n🔍 Matches identical: {same} ({int((codes >= 0).sum()):,} matched rows)")
+    if not same:
+        raise SystemExit(1)
+
+    print("\n⏱️  Matching one year (best of %d)" % args.repeat)
+    print(f"   string keys + dict map:   {t_str * 1000:8.1f} ms")
+    print(f"   integer codes (object):   {t_obj * 1000:8.1f} ms  (x{t_str / t_obj:.1f})")
+    print(f"   integer codes (category): {t_cat * 1000:8.1f} ms  (x{t_str / t_cat:.1f})")
+
+def clean_slug(text):
+    """Turns 'Computer & Info Sciences' into 'computer_info_sciences'"""
+    if pd.isna(text): return "total"
+    text = str(text).lower()
+    text = re.sub(r'\(.*?\)', '', text) # Remove (parentheses)
+    text = re.sub(r'[^a-z0-9]', '_', text) # Special chars to _
+    text = re.sub(r'_+', '_', text) # Dedupe _
+    return text.strip('_')
+
+def _mapping_loop(df):
+    """Reference implementation: the per-row loop generate_mapping.py used to run."""
+    mapping = {category: {} for category in generate_mapping.CATEGORIES}
+    for _, row in df.iterrows():
+        qid = str(row['Question ID'])
+        row_lbl, col_lbl = row['Row Label'], row['Column Label']
+        if qid == 'nan': continue
+        if qid.startswith('01'):
+            category, key = "funding_sources", f"src_{clean_slug(row_lbl)}"
+        elif qid.startswith(('09', '9')):
+            category, key = "federal_detailed", f"fed_{clean_slug(row_lbl)}_{clean_slug(col_lbl)}"
+        elif qid.startswith('10'):
+            category, key = "federal_agencies", f"agency_{clean_slug(row_lbl)}"
+        elif qid.startswith('11'):
+            category, key = "nonfed_detailed", f"nonfed_{clean_slug(row_lbl)}_{clean_slug(col_lbl)}"
+        else:
+            category, key = "other_questions", f"q{clean_slug(qid)}_{clean_slug(row_lbl)}"
+        mapping[category][key] = {
+            "key": key,
+            "question_id": qid,
+            "row_match": row_lbl if pd.notna(row_lbl) else None,
+            "col_match": col_lbl if pd.notna(col_lbl) else None,
+            "description": f"{row['Question Text']}: {row_lbl} - {col_lbl}",
+            "start_year": int(row['First Year']),
+            "end_year": int(row['Last Year']),
+        }
+    return mapping
+
+def _startup_from_json(mapping_path, years):
+    """Reference implementation: what etl.py did with mapping.json on every run."""
+    with open(mapping_path) as f:
+        full_config = json.load(f)
+    mapping_index = MappingIndex.from_config(full_config)
+    metadata_rows = [{"category": category, "column_name": key, "description": info['description'],
+                      "start_year": info['start_year'], "end_year": info['end_year']}
+                     for category, items in full_config.items() for key, info in items.items()]
+    year_hashes = [compiled_mapping.mapping_hash_for_year(full_config, year) for year in years]
+    return mapping_index, metadata_rows, year_hashes
+
+def _startup_compiled(mapping_path, years):
+    mapping = compiled_mapping.load_mapping(mapping_path)
+    return mapping.mapping_index, mapping.metadata_rows, [mapping.year_hash(year) for year in years]
+
+def bench_mapping(args):
+    """Per-row vs vectorized mapping generation, and JSON vs compiled mapping at ETL startup."""
+    report = pd.read_csv(generate_mapping.CSV_PATH)
+    # Larger reports: copies of every row with new labels (so new keys) and the same years
+    copies = [report] + [report.assign(**{'Row Label': report['Row Label'] + f" {i}"}) for i in range(1, args.scale)]
+    report = pd.concat(copies, ignore_index=True)
+    print(f"🧪 Mapping report with {len(report):,} rows (x{args.scale})")
+
+    t_loop, reference = _best_of(lambda: _mapping_loop(report), args.repeat)
+    t_vec, mapping = _best_of(
+        lambda: generate_mapping.build_mapping(generate_mapping.build_entries(report)), args.repeat
+    )
+    same = json.dumps(mapping) == json.dumps(reference)
+    print(f"\n🔍 Mappings identical: {same} ({sum(len(v) for v in mapping.values()):,} keys)")
+    if not same:
+        raise SystemExit(1)
+
+    years = range(2010, 2025)
+    startup = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, source in [("mapping.json", None), (f"generated x{args.scale}", mapping)]:
+            path = Path(tmp) / f"mapping_{len(startup)}.json"
+            if source is None:
+                path.write_bytes(etl.MAPPING_PATH.read_bytes())
+            else:
+                path.write_text(json.dumps(source, indent=2))
+            compiled_mapping.compile_mapping(path)
+            t_json, old = _best_of(lambda: _startup_from_json(path, years), args.repeat)
+            t_compiled, new = _best_of(lambda: _startup_compiled(path, years), args.repeat)
+            if old[1] != new[1] or old[2] != new[2] or not np.array_equal(old[0].names, new[0].names):
+                raise SystemExit(f"compiled mapping differs from {label}")
+            startup[label] = (t_json, t_compiled)
+
+    print("\n⏱️  Mapping generation (best of %d)" % args.repeat)
+    print(f"   per-row loop:  {t_loop * 1000:8.1f} ms")
+    print(f"   vectorized:    {t_vec * 1000:8.1f} ms  (x{t_loop / t_vec:.1f})")
+    print("\n⏱️  ETL startup: lookup + metadata + per-year hashes")
+    for label, (t_json, t_compiled) in startup.items():
+        print(f"   {label:<16} JSON {t_json * 1000:7.1f} ms   compiled {t_compiled * 1000:7.1f} ms  "
+              f"(x{t_json / t_compiled:.1f})")
+
+def _schema_report_loop(paths):
+    """Reference implementation: per-record dict updates, as analyze_schema.py used to do."""
+    schema_history = {}
+    all_years = []
+    for path in paths:
+        year = file_year(path)
+        all_years.append(year)
+        df = read_raw(path, low_memory=False, dtype=str)
+        df.columns = [c.lower() for c in df.columns]
+        row_cols = [c for c in df.columns if c in ['row', 'row_label', 'question_label']]
+        col_cols = [c for c in df.columns if c in ['column', 'column_label', 'col']]
+        cols_to_use = ['questionnaire_no', 'question'] + row_cols + col_cols
+        for item in df[cols_to_use].drop_duplicates().to_dict('records'):
+            qid = str(item.get('questionnaire_no', '')).strip()
+            desc = str(item.get('question', '')).strip()
+            row_lbl = next((str(item[c]).strip() for c in row_cols if pd.notna(item[c])), "")
+            col_lbl = next((str(item[c]).strip() for c in col_cols if pd.notna(item[c])), "")
+            if not qid or qid.lower() == 'nan': continue
+            schema_history.setdefault((qid, row_lbl, col_lbl), {})[year] = desc
+
+    report = []
+    for (qid, row_lbl, col_lbl), history in schema_history.items():
+        years_active = sorted(history)
+        first_year, last_year = years_active[0], years_active[-1]
+        if first_year == all_years[0] and last_year == all_years[-1]:
+            status = "Consistent"
+        elif first_year == all_years[0]:
+            status = "Removed"
+        elif last_year == all_years[-1]:
+            status = "New / Added"
+        else:
+            status = "Intermittent"
+        report.append((qid, row_lbl, col_lbl, history[last_year], status,
+                       first_year, last_year, len(set(history.values()))))
+    return report
+
+def _schema_report_vectorized(paths, cache_dir=None):
+    frames = [analyze_schema.read_year_schema(path, cache_dir).assign(year=file_year(path)) for path in paths]
+    return analyze_schema.schema_report(pd.concat(frames, ignore_index=True), [file_year(p) for p in paths])
+
+def bench_schema(args):
+    """Per-record schema history loop vs the vectorized analyze_schema pipeline."""
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        print(f"🧪 Generating {args.institutions} institutions x 15 years...")
+        paths = make_synthetic_raw(tmp / "raw", n_inst=args.institutions)
+        cache_dir = tmp / "cache"
+
+        t_loop, reference = _best_of(lambda: _schema_report_loop(paths), args.repeat)
+        t_vec, report = _best_of(lambda: _schema_report_vectorized(paths), args.repeat)
+        _schema_report_vectorized(paths, cache_dir)
+        t_cached, cached = _best_of(lambda: _schema_report_vectorized(paths, cache_dir), args.repeat)
+
+    rows = list(report.itertuples(index=False, name=None))
+    same = rows == reference and report.equals(cached)
+    print(f"\n🔍 Reports identical: {same} ({len(rows):,} data points)")
+    if not same:
+        raise SystemExit(1)
+
+    print("\n⏱️  Schema analysis over 15 years (best of %d)" % args.repeat)
+    print(f"   per-record loop:           {t_loop:7.2f}s")
+    print(f"   vectorized:                {t_vec:7.2f}s  (x{t_loop / t_vec:.1f})")
+    print(f"   vectorized, cached years:  {t_cached:7.2f}s  (x{t_loop / t_cached:.1f})")
+
+def _query_mix(n_inst):
+    """Peer-comparison style queries like the ones agents send."""
+    queries = []
+    for i in range(0, n_inst, max(n_inst // 20, 1)):
+        inst_id = f"{100000 + i:06d}"
+        queries += [
+            f"SELECT name, year, src_total FROM institutions WHERE inst_id = '{inst_id}' ORDER BY year",
+            f"SELECT state, year, SUM(src_total) AS total FROM institutions "
+            f"WHERE state = (SELECT state FROM institutions WHERE inst_id = '{inst_id}' LIMIT 1) "
+            f"GROUP BY state, year ORDER BY year",
+        ]
+    queries.append("SELECT name, src_total FROM institutions WHERE year = 2024 ORDER BY src_total DESC LIMIT 25")
+    return queries
+
+def _query_per_call(db_path, sql):
+    """Reference implementation: what the server tool did for every call."""
+    conn = sqlite3.connect(db_path)
+    df = pd.read_sql(sql, conn)
+    conn.close()
+    return df
+
+async def _drive_clients(n_clients, per_client, queries, call):
+    latencies = []
+
+    async def client(c):
+        for k in range(per_client):
+            sql = queries[(c * per_client + k) % len(queries)]
+            start = time.perf_counter()
+            await call(sql)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(c) for c in range(n_clients)))
+    return time.perf_counter() - start, np.array(latencies)
+
+def bench_queries(args):
+    """Many concurrent clients: connection per call vs the pooled QueryEngine."""
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        print(f"🧪 Building a synthetic herd.db ({args.institutions} institutions x 15 years)...")
+        make_synthetic_raw(tmp / "raw", n_inst=args.institutions)
+        db_path = tmp / "herd.db"
+        etl.run_etl(full_rebuild=True, data_dir=tmp / "raw", db_path=db_path, download=False)
+
+        queries = _query_mix(args.institutions)
+        engine = QueryEngine(db_path, pool_size=args.pool)
+        try:
+            same = all(
+                _query_per_call(db_path, sql).values.tolist() == [list(r) for r in engine.execute(sql)[1]]
+                for sql in queries
+            )
+            print(f"\n🔍 Results identical: {same} ({len(queries)} distinct queries)")
+            if not same:
+                raise SystemExit(1)
+
+            async def per_call(sql):
+                return _query_per_call(db_path, sql)
+
+            results = {
+                "connection per call": asyncio.run(_drive_clients(args.clients, args.queries, queries, per_call)),
+                f"pooled engine ({args.pool} conns)": asyncio.run(
+                    _drive_clients(args.clients, args.queries, queries, engine.run)
+                ),
+            }
+        finally:
+            engine.close()
+
+    total = args.clients * args.queries
+    print(f"\n⏱️  {args.clients} clients x {args.queries} queries")
+    for label, (seconds, latencies) in results.items():
+        p50, p95 = np.percentile(latencies, [50, 95]) * 1000
+        print(f"   {label:<28} {total / seconds:8.0f} q/s   p50 {p50:7.1f} ms   p95 {p95:7.1f} ms")
+
+def _lookup_sql(engine, inst_ids, metric, years):
+    """get_metric through SQL: the wide table, pivoted to one row per institution."""
+    marks = ", ".join("?" * len(inst_ids))
+    _, rows = engine.execute(
+        f'SELECT inst_id, year, "{metric}" FROM institutions WHERE inst_id IN ({marks}) AND year BETWEEN ? AND ?',
+        (*inst_ids, min(years), max(years)),
+    )
+    values = {(inst_id, year): value for inst_id, year, value in rows}
+    return [[values.get((inst_id, year), float('nan')) for year in years] for inst_id in inst_ids]
+
+def _fallback_matches(engine, snap, lookups):
+    """Whether snapshot.fetch_snapshot (the server's answer while building) agrees with the full snapshot."""
+    def same(partial, inst_ids, metric):
+        return (partial.get_metric(inst_ids, metric)[0].tolist() == snap.get_metric(inst_ids, metric)[0].tolist()
+                and np.array_equal(partial.get_metric(inst_ids, metric)[1], snap.get_metric(inst_ids, metric)[1],
+                                   equal_nan=True)
+                and all(partial.institution(i) == snap.institution(i) for i in inst_ids))
+
+    for inst_ids, metric, _ in lookups:
+        if not same(asyncio.run(snapshot.fetch_snapshot(engine, metric, inst_ids)), inst_ids, metric):
+            return False
+    for group, members in snap.groups.items():
+        partial = asyncio.run(snapshot.fetch_snapshot(engine, lookups[0][1], group=group))
+        known = [i for i, _ in members if snap.has_institution(i)]
+        if partial.groups != snap.groups or not same(partial, known, lookups[0][1]):
+            return False
+    return True
+
+def bench_snapshot(args):
+    """Point lookups of one metric: pooled SQL vs the memory-mapped snapshot."""
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        print(f"🧪 Building a synthetic herd.db ({args.institutions} institutions x 15 years)...")
+        make_synthetic_raw(tmp / "raw", n_inst=args.institutions)
+        db_path = tmp / "herd.db"
+        etl.run_etl(full_rebuild=True, data_dir=tmp / "raw", db_path=db_path, download=False)
+
+        start = time.perf_counter()
+        snapshot.Snapshot.build(db_path)
+        build_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        snap = snapshot.Snapshot.load(db_path)
+        load_seconds = time.perf_counter() - start
+
+        rng = random.Random(0)
+        inst_ids, metrics = snap.inst_ids.tolist(), snap.metrics.tolist()
+        lookups = []
+        for _ in range(args.lookups):
+            first = rng.randrange(len(snap.years) - 4)
+            lookups.append((rng.sample(inst_ids, args.inst_per_lookup), rng.choice(metrics),
+                            snap.years[first:first + 5].tolist()))
+
+        engine = QueryEngine(db_path, pool_size=1)
+        try:
+            timings, results = {}, {}
+            for label, lookup in [("SQL (pooled engine)", lambda *a: _lookup_sql(engine, *a)),
+                                  ("snapshot", lambda *a: snap.get_metric(*a)[1].tolist())]:
+                start = time.perf_counter()
+                results[label] = [lookup(*args_) for args_ in lookups]
+                timings[label] = time.perf_counter() - start
+            fallback_same = _fallback_matches(engine, snap, lookups[:50])
+        finally:
+            engine.close()
+
+    same = np.array_equal(np.array(results["SQL (pooled engine)"]), np.array(results["snapshot"]), equal_nan=True)
+    print(f"\n🔍 Values identical: {same} ({len(lookups)} lookups)")
+    print(f"🔍 SQL fallback while building matches the snapshot: {fallback_same}")
+    if not (same and fallback_same):
+        raise SystemExit(1)
+
+    print(f"\n📦 Snapshot {snap.values.shape} ({snap.values.nbytes / 1e6:.1f} MB): "
+          f"built from herd.db in {build_seconds:.2f}s, mapped in {load_seconds * 1000:.1f} ms")
+    print(f"⏱️  {len(lookups)} lookups of {args.inst_per_lookup} institutions x 5 years")
+    base = timings["SQL (pooled engine)"]
+    for label, seconds in timings.items():
+        print(f"   {label:<20} {seconds / len(lookups) * 1e6:9.1f} µs per lookup  (x{base / seconds:.1f})")
+
+_NAME_WORDS = ['Texas', 'California', 'North', 'South', 'Carolina', 'Florida', 'Ohio', 'Michigan', 'Georgia',
+               'Virginia', 'Arizona', 'Oregon', 'Boston', 'Chicago', 'Denver', 'Dallas', 'Austin', 'Houston',
+               'Riverside', 'Davis', 'Irvine', 'Santa Barbara', 'San Diego', 'Rio Grande Valley', 'El Paso',
+               'Corpus Christi', 'Medical', 'Health Science', 'Technology', 'Polytechnic', 'A&M', 'State']
+
+def _misspell(rng, text):
+    i = rng.randrange(1, len(text) - 1)
+    return text[:i] + text[i + 1:]
+
+def bench_names(args):
+    """Institution-name lookups: LIKE scan vs the in-memory alias index."""
+    rng = random.Random(0)
+    names = {}
+    while len(names) < args.institutions:
+        place = " ".join(rng.sample(_NAME_WORDS, rng.randint(1, 3)))
+        kind = rng.choice(["University of {}", "{} University", "{} College", "University of {} at {}"])
+        name = kind.format(place, rng.choice(_NAME_WORDS))
+        names.setdefault(name, f"{len(names):06d}")
+
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE institution_years (inst_id TEXT, year INTEGER, name TEXT, state TEXT)")
+    conn.execute("CREATE INDEX idx_name ON institution_years (name)")
+    conn.execute("CREATE TABLE institution_name_history (inst_id TEXT, year INTEGER, name TEXT)")
+    conn.executemany("INSERT INTO institution_years VALUES (?, 2024, ?, 'TX')",
+                     [(inst_id, name) for name, inst_id in names.items()])
+    start = time.perf_counter()
+    n_aliases = name_index.build_name_index(conn, {})
+    index = name_index.AliasIndex.load(lambda sql: (None, conn.execute(sql).fetchall()))
+    build_seconds = time.perf_counter() - start
+
+    sample = rng.sample(sorted(names), min(args.lookups, len(names)))
+    queries = {
+        "exact name": [(name, names[name]) for name in sample],
+        "acronym": [(name_index.acronym(name), names[name]) for name in sample if name_index.acronym(name)],
+        "misspelled": [(_misspell(rng, name), names[name]) for name in sample],
+    }
+    print(f"🏫 {len(names)} institutions, {n_aliases} aliases indexed in {build_seconds * 1000:.0f} ms")
+    print(f"⏱️  {len(sample)} lookups per kind")
+    for label, pairs in queries.items():
+        latencies, hits = [], 0
+        for text, inst_id in pairs:
+            start = time.perf_counter()
+            matches = index.resolve(text)
+            latencies.append(time.perf_counter() - start)
+            hits += any(m[0] == inst_id for m in matches)
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+        print(f"   {label:<12} p50 {p50:6.3f} ms   p99 {p99:6.3f} ms   in top 5: {hits / len(pairs):.0%}")
+
+    start = time.perf_counter()
+    for name in sample:
+        conn.execute("SELECT inst_id FROM institution_years WHERE name LIKE ?", (f"%{name[2:-2]}%",)).fetchall()
+    print(f"   {'LIKE scan':<12} mean {(time.perf_counter() - start) / len(sample) * 1000:6.3f} ms")
+
+# --- Incremental load vs full rebuild ---
+
+def bench_incremental(args):
+    """Incremental loads after a changed year, a mapping edit and a removed newest file vs full rebuilds."""
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp, raw = Path(tmp), Path(tmp) / "raw"
+        print(f"🧪 Generating {args.institutions} institutions x 15 years...")
+        make_synthetic_raw(raw, n_inst=args.institutions)
+        mapping_path = tmp / "mapping.json"
+        mapping_path.write_bytes(etl.MAPPING_PATH.read_bytes())
+
+        def edit_mapping():
+            config = json.loads(mapping_path.read_text())
+            info = next(info for items in config.values() for info in items.values()
+                        if info['start_year'] == info['end_year'] == 2012)
+            info['description'] += " (edited)"
+            mapping_path.write_text(json.dumps(config, indent=2))
+
+        steps = [
+            ("changed year", lambda: make_synthetic_raw(raw, n_inst=args.institutions, years=[2020], seed=1)),
+            ("mapping edit", edit_mapping),
+            ("removed newest", lambda: next(raw.glob("herd_2024_*.csv")).unlink()),
+        ]
+        timings, failures = {}, []
+        default_mapping, etl.MAPPING_PATH = etl.MAPPING_PATH, mapping_path
+        try:
+            with redirect_stdout(io.StringIO()):
+                etl.run_etl(full_rebuild=True, data_dir=raw, db_path=tmp / "incremental.db", download=False)
+            for step, change in steps:
+                change()
+                for kind in ("incremental", "full"):
+                    db_path = tmp / f"{kind}.db"
+                    start = time.perf_counter()
+                    with redirect_stdout(io.StringIO()):
+                        etl.run_etl(full_rebuild=kind == "full", data_dir=raw, db_path=db_path, download=False)
+                    timings[(step, kind)] = time.perf_counter() - start
+                differing = _dump_differences(_dump_database(tmp / "incremental.db", by_name=True),
+                                              _dump_database(tmp / "full.db", by_name=True))
+                failures += [f"{step}: {name} differs from a full rebuild" for name in differing]
+
+                # Once caught up, the next run has nothing to do
+                log = io.StringIO()
+                with redirect_stdout(log):
+                    etl.run_etl(data_dir=raw, db_path=tmp / "incremental.db", download=False)
+                if "up to date" not in log.getvalue():
+                    failures.append(f"{step}: the run after the incremental load is not up to date")
+        finally:
+            etl.MAPPING_PATH = default_mapping
+
+    print(f"\n⏱️  {args.institutions} institutions x 15 years")
+    for (step, kind), seconds in timings.items():
+        print(f"   {step:<16} {kind:<12} {seconds:7.2f}s")
+    if failures:
+        for failure in failures:
+            print(f"❌ {failure}")
+        raise SystemExit(1)
+    print("\n✅ Incremental loads match full rebuilds and leave nothing to reload")
+
+# --- SQLite / PostgreSQL parity ---
+
+@contextmanager
+def throwaway_postgres(bin_dir=None):
+    """
+    A temporary PostgreSQL cluster (initdb and pg_ctl from `bin_dir` or
+    PATH) listening on a unix socket only; yields its URL and deletes it
+    afterwards. initdb refuses to run as root.
+    """
+    initdb, pg_ctl = (shutil.which(tool, path=bin_dir) for tool in ('initdb', 'pg_ctl'))
+    if not (initdb and pg_ctl):
+        raise SystemExit("initdb / pg_ctl not found: put PostgreSQL's bin directory on PATH, "
+                         "pass --pg-bin, or point --postgres at a server")
+    with tempfile.TemporaryDirectory() as tmp, socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        data = Path(tmp) / "data"
+        subprocess.run([initdb, '-D', data, '-U', 'postgres', '--auth=trust', '--no-sync'],
+                       check=True, capture_output=True)
+        options = f"-p {port} -k {tmp} -c listen_addresses='' -c fsync=off"
+        subprocess.run([pg_ctl, '-D', data, '-o', options, '-l', Path(tmp) / "log", '-w', 'start'],
+                       check=True, capture_output=True)
+        try:
+            yield f"postgresql://postgres@/postgres?host={tmp}&port={port}"
+        finally:
+            subprocess.run([pg_ctl, '-D', data, '-m', 'immediate', 'stop'], capture_output=True)
+
+def _same_rows(a, b):
+    """Row lists equal, floats to 1e-9 relative (the databases round pow / AVG differently)."""
+    return len(a) == len(b) and all(
+        len(x) == len(y) and all(
+            u == v or (isinstance(u, float) and isinstance(v, float) and math.isclose(u, v, rel_tol=1e-9))
+            for u, v in zip(x, y))
+        for x, y in zip(a, b))
+
+def _parity_queries(engine):
+    """Ordered dumps of every table, plus queries like the tools and agents run."""
+    _, metrics = engine.execute("SELECT column_name FROM data_dictionary ORDER BY metric_id")
+    wide = ", ".join(f'"{storage.column_name(engine.dialect, m)}"' for m, in metrics)
+    return {
+        'institution_years': "SELECT * FROM institution_years ORDER BY year, inst_id",
+        'herd_facts': "SELECT * FROM herd_facts ORDER BY metric_id, year, inst_id",
+        'institutions': f"SELECT inst_id, name, city, state, year, {wide} FROM institutions ORDER BY year, inst_id",
+        'data_dictionary': "SELECT * FROM data_dictionary ORDER BY metric_id",
+        'name history': "SELECT * FROM institution_name_history ORDER BY year, inst_id, name",
+        'herd_metrics': "SELECT * FROM herd_metrics ORDER BY metric, year, inst_id",
+        'metric_trends': "SELECT * FROM metric_trends ORDER BY metric_id, inst_id, year",
+        'peer_groups': "SELECT * FROM peer_groups ORDER BY group_name, inst_id",
+        'peer_group_stats': "SELECT * FROM peer_group_stats ORDER BY group_name, metric_id, year",
+        'institution_lookup': "SELECT * FROM institution_lookup ORDER BY alias_key, inst_id",
+        'institution_search': "SELECT inst_id, alias FROM institution_search "
+                              "WHERE alias_key LIKE '%univ%' ORDER BY inst_id, alias",
+        'state totals': "SELECT state, year, COUNT(*) AS n, SUM(src_total) AS total, AVG(src_total) AS mean "
+                        "FROM institutions GROUP BY state, year ORDER BY state, year",
+        'top 25': "SELECT name, src_total FROM institutions WHERE year = 2024 "
+                  "ORDER BY src_total DESC, inst_id LIMIT 25",
+    }
+
+_VALIDATOR_CASES = [
+    "SELECT name, year, src_total FROM institutions WHERE inst_id = '100007' ORDER BY year",
+    "SELECT name, src_totl FROM institutions",
+    "SELECT name FROM institutionz",
+    "SELECT a.src_total, b.src_total FROM institutions a, institutions b",
+    "SELECT name, src_total FROM institutions -- every year",
+    "SELECT name, src_total FROM institutions LIMIT (10)",
+    "SELECT name FROM institutions; DROP TABLE institutions",
+    "DELETE FROM herd_facts",
+]
+
+def _validator_outcome(validator, sql):
+    try:
+        return validator.validate(sql)
+    except InvalidSQL as e:
+        return f"rejected (fixable={e.fixable})"
+
+def _parity_report(stores, engines):
+    """Names of every check where the two databases disagree."""
+    mismatches = []
+    queries = [_parity_queries(engine) for engine in engines]
+    for name in queries[0]:
+        results = [engine.execute(q[name])[1] for engine, q in zip(engines, queries)]
+        if not _same_rows(*results):
+            mismatches.append(f"query {name} ({len(results[0])} vs {len(results[1])} rows)")
+
+    sql = "SELECT inst_id, year, name FROM institution_years ORDER BY year, inst_id"
+    for offset in (0, 150, 450):
+        pages = [engine.fetch_page(sql, offset, max_rows=150) for engine in engines]
+        if not _same_rows(pages[0].rows, pages[1].rows) or pages[0].more_rows != pages[1].more_rows:
+            mismatches.append(f"fetch_page at offset {offset}")
+
+    snaps = [snapshot.Snapshot.build(store) for store in stores]
+    for field in ('inst_ids', 'names', 'states', 'years', 'metrics'):
+        if not np.array_equal(getattr(snaps[0], field), getattr(snaps[1], field)):
+            mismatches.append(f"snapshot {field}")
+    if not np.array_equal(snaps[0].values, snaps[1].values, equal_nan=True) or snaps[0].groups != snaps[1].groups:
+        mismatches.append("snapshot values")
+    rng = random.Random(0)
+    inst_ids, metrics = snaps[0].inst_ids.tolist(), snaps[0].metrics.tolist()
+    lookups = [(rng.sample(inst_ids, min(3, len(inst_ids))), rng.choice(metrics), None) for _ in range(20)]
+    if not _fallback_matches(engines[1], snaps[0], lookups):
+        mismatches.append("snapshot SQL fallback")
+
+    indexes = [name_index.AliasIndex.load(engine.execute) for engine in engines]
+    names = [row[3] for row in indexes[0].rows]
+    texts = [text for name in rng.sample(names, min(50, len(names))) for text in (name, _misspell(rng, name))]
+    if [indexes[0].resolve(t) for t in texts] != [indexes[1].resolve(t) for t in texts]:
+        mismatches.append("resolve_institution")
+
+    validators = [SQLValidator(engine) for engine in engines]
+    for sql in _VALIDATOR_CASES:
+        outcomes = [_validator_outcome(validator, sql) for validator in validators]
+        if outcomes[0] != outcomes[1]:
+            mismatches.append(f"validator on {sql!r}: {outcomes[0]} vs {outcomes[1]}")
+    return mismatches
+
+def bench_parity(args):
+    """ETL into SQLite and PostgreSQL, full then incremental; every table, page and lookup must match."""
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        with (nullcontext(args.postgres) if args.postgres else throwaway_postgres(args.pg_bin)) as url:
+            from postgres_storage import PostgresStorage
+            stores = [storage.SQLiteStorage(tmp / "herd.db"),
+                      PostgresStorage(url, schema=args.schema, artifact_path=tmp / "pg")]
+            print(f"🧪 Generating {args.institutions} institutions x 15 years; loading {stores[1]}...")
+            make_synthetic_raw(tmp / "raw", n_inst=args.institutions)
+
+            timings, failures = {}, []
+            for step, years in (("full load", None), ("reload of 2020", [2020])):
+                if years:
+                    # New values for one year: an incremental load of just that year
+                    make_synthetic_raw(tmp / "raw", n_inst=args.institutions, years=years, seed=1)
+                for store in stores:
+                    start = time.perf_counter()
+                    etl.run_etl(full_rebuild=not years, data_dir=tmp / "raw", db_path=store, download=False)
+                    timings[(step, store.dialect)] = time.perf_counter() - start
+
+                engines = [store.engine(pool_size=1) for store in stores]
+                try:
+                    failures += [f"{step}: {m}" for m in _parity_report(stores, engines)]
+                finally:
+                    for engine in engines:
+                        engine.close()
+
+            if not args.keep:
+                with stores[1].connect() as conn:
+                    conn.execute(f"DROP SCHEMA IF EXISTS {args.schema} CASCADE")
+
+    print(f"\n⏱️  {args.institutions} institutions x 15 years")
+    for (step, dialect), seconds in timings.items():
+        print(f"   {step:<16} {dialect:<11} {seconds:7.2f}s")
+    if failures:
+        for failure in failures:
+            print(f"❌ {failure}")
+        raise SystemExit(1)
+    print("\n✅ SQLite and PostgreSQL agree on every table, page, snapshot, name lookup and validator check")
+
+# --- PostgreSQL SQL generation, without a server ---
+
+class _RecordingCursor:
+    """psycopg2 cursor stand-in: records statements and reads every COPY input."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.rows = []
+
+    def execute(self, sql, params=None):
+        self.raw.statements.append((" ".join(sql.split()), params))
+        # Column lists (storage.table_columns); every other query finds nothing
+        self.rows = [(c,) for c in self.raw.columns.get(params[0], [])] if 'pg_attribute' in sql else []
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def copy_expert(self, sql, file, size=8192):
+        chunks = list(iter(lambda: file.read(size), ""))
+        self.raw.copies.append((sql, "".join(chunks), len(chunks)))
+
+class _RecordingPg:
+    """psycopg2 connection stand-in for PgConnection; `columns` answers column lookups."""
+    closed = False
+
+    def __init__(self, columns=None):
+        self.columns = columns or {}
+        self.statements, self.copies = [], []
+
+    def cursor(self):
+        return _RecordingCursor(self)
+
+def _pgsql_failures():
+    import bulk_loader
+    from pivot import ID_COLUMNS, WideYear
+    from postgres_storage import CsvStream, PgConnection, _pg_sql, _plan_scans, _read_only_statement
+
+    failures = []
+    def check(ok, what):
+        if not ok:
+            failures.append(what)
+
+    sql = _pg_sql("CREATE TABLE t (a INTEGER, b REAL, c TEXT, PRIMARY KEY (a)) WITHOUT ROWID", ())
+    check(sql == 'CREATE TABLE t (a BIGINT, b DOUBLE PRECISION, c TEXT COLLATE "C", PRIMARY KEY (a))',
+          f"DDL types: {sql}")
+    sql = _pg_sql("SELECT name FROM institutions WHERE name LIKE '%univ%' AND year = ?", (2020,))
+    check(sql == "SELECT name FROM institutions WHERE name LIKE '%%univ%%' AND year = %s", f"placeholders: {sql}")
+    sql = _pg_sql("SELECT CAST(a AS INTEGER) FROM t WHERE c LIKE '%x'", ())
+    check(sql == "SELECT CAST(a AS INTEGER) FROM t WHERE c LIKE '%x'", f"query without parameters changed: {sql}")
+
+    raw = _RecordingPg()
+    bulk_loader.ensure_schema(PgConnection(raw))
+    created = [s for s, _ in raw.statements if s.startswith("CREATE TABLE")]
+    for table in ('institution_years', 'herd_facts', 'institutions'):
+        check(any(f"EXISTS {table} (" in s and s.endswith("PARTITION BY LIST (year)") for s in created),
+              f"{table} is not partitioned by year")
+    check(not any("ROWID" in s for s in created), "WITHOUT ROWID reaches PostgreSQL")
+
+    # 2020: three institutions, metric b new to the wide table
+    ids = pd.DataFrame({'inst_id': ['1', '2', '3'], 'name': ['A "One"', 'B, Two', None],
+                        'city': ['X', '', 'Z'], 'state': ['TX', 'CA', None], 'year': [2020] * 3})
+    wide = WideYear(ids, ['a', 'b'], np.array([0, 1, 2]), np.array([0, 1, 0]), np.array([1.5, 2.0, 0.0]))
+    wide.raw_names = [('1', 'A One'), ('2', 'B, Two')]
+    raw = _RecordingPg({'institutions': ID_COLUMNS + ['a', 'old']})
+    bulk_loader.write_year(PgConnection(raw), 2020, wide, {'a': 1, 'b': 2})
+    statements = [s for s, _ in raw.statements]
+    for table in ('institution_years', 'herd_facts', 'institutions'):
+        check(f'DROP TABLE IF EXISTS "{table}_2020"' in statements, f"{table}_2020 is not dropped first")
+        check(f'CREATE TABLE "{table}_2020" PARTITION OF {table} FOR VALUES IN (2020)' in statements,
+              f"{table}_2020 is not created as a partition")
+    check(('DELETE FROM institution_name_history WHERE year = %s', (2020,)) in raw.statements,
+          "name history of 2020 is not deleted")
+    check('ALTER TABLE institutions ADD COLUMN "b" DOUBLE PRECISION' in statements
+          and 'UPDATE institutions SET "b" = 0' in statements, "new metric column b is not added and zeroed")
+
+    copies = {re.match(r'COPY "(\w+)"', sql).group(1): (sql, text) for sql, text, _ in raw.copies}
+    check(list(copies) == ['institution_years_2020', 'herd_facts_2020', 'institution_name_history',
+                           'institutions_2020'], f"COPY targets: {list(copies)}")
+    if 'institutions_2020' in copies:
+        sql, text = copies['institutions_2020']
+        check('("inst_id", "name", "city", "state", "year", "a", "b", "old")' in sql, f"wide COPY columns: {sql}")
+        # Strings are quoted, so a missing value (unquoted empty field) is NULL and "" an empty string
+        expected = ['"1","A ""One""","X","TX",2020,1.5,0.0,0.0', '"2","B, Two","","CA",2020,0.0,2.0,0.0',
+                    '"3",,"Z",,2020,0.0,0.0,0.0']
+        check(text.splitlines() == expected, f"wide COPY rows: {text.splitlines()}")
+        parsed = list(csv.reader(io.StringIO(text)))
+        check([row[:4] for row in parsed] == [['1', 'A "One"', 'X', 'TX'], ['2', 'B, Two', '', 'CA'],
+                                             ['3', '', 'Z', '']], "wide COPY rows do not round-trip")
+    if 'herd_facts_2020' in copies:
+        # Zero cells are implied, not stored
+        check(copies['herd_facts_2020'][1].splitlines() == ['"1",2020,1,1.5', '"2",2020,2,2.0'],
+              f"facts COPY rows: {copies['herd_facts_2020'][1].splitlines()}")
+
+    # COPY input is formatted as it is read, not all up front
+    pulled = []
+    rows = (pulled.append(i) or (i, f"name {i}") for i in range(10_000))
+    stream = CsvStream(rows, batch_rows=100)
+    first = stream.read(64)
+    check(len(pulled) == 100, f"first read formatted {len(pulled)} rows, not one batch of 100")
+    text = first + stream.read()
+    check(len(pulled) == 10_000 and text.count("\n") == 10_000 and text.endswith('9999,"name 9999"\n'),
+          "streamed COPY input is incomplete")
+    raw = _RecordingPg()
+    PgConnection(raw).copy_rows('t', ['n', 's'], ((i, str(i)) for i in range(50_000)))
+    check(raw.copies[0][1].count("\n") == 50_000 and raw.copies[0][2] > 1,
+          f"copy_rows sent {raw.copies[0][1].count(chr(10))} rows in {raw.copies[0][2]} reads")
+
+    for sql in ("SELECT 1", "WITH t AS (SELECT 1) SELECT * FROM t", "select name from institutions;"):
+        try:
+            _read_only_statement(sql)
+        except QueryNotAllowed as e:
+            failures.append(f"read-only check rejects {sql!r}: {e}")
+    for sql in ("SELECT 1; SELECT 2", "DELETE FROM herd_facts", "UPDATE institutions SET a = 1"):
+        try:
+            _read_only_statement(sql)
+            failures.append(f"read-only check accepts {sql!r}")
+        except QueryNotAllowed:
+            pass
+
+    def seq(table):
+        return {'Node Type': 'Seq Scan', 'Relation Name': table}
+    plan = {'Node Type': 'Nested Loop', 'Plans': [
+        seq('institutions'),
+        {'Node Type': 'Append', 'Plans': [seq('herd_facts_2019'), seq('herd_facts_2020')]}]}
+    scans = []
+    _plan_scans(plan, None, scans, itertools.count(), {f'herd_facts_{y}': 'herd_facts' for y in (2019, 2020)})
+    check(scans[1:] == [(scans[0][0], "SCAN herd_facts")],
+          f"nested loop over an append of partitions: {scans}")
+    return failures
+
+def bench_pgsql(args):
+    """PostgreSQL DDL, partitions and COPY input from the shared load code, against a recording stand-in."""
+    failures = _pgsql_failures()
+    if failures:
+        for failure in failures:
+            print(f"❌ {failure}")
+        raise SystemExit(1)
+    print("✅ PostgreSQL schema, partitions, COPY input and plan checks generate the expected SQL")
+
+# --- Local stand-in for the NSF download page ---
+
+class _FakeNSFHandler(BaseHTTPRequestHandler):
+    """
+    Serves an index page linking to in-memory zip archives, with ETag,
+    Last-Modified, conditional GET and single-range support. A fixed
+    per-request latency stands in for the round trip to the real site.
+    """
+    archives = {}          # path -> zip bytes
+    latency = 0.0
+    requests_seen = []     # (path, status)
+    last_modified = formatdate(usegmt=True)
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=b"", headers=None):
+        self.requests_seen.append((self.path, status))
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        if self.path == '/':
+            links = "".join(f'<a href="{path}">{path}</a>' for path in self.archives)
+            return self._send(200, f"<html><body>{links}</body></html>".encode())
+
+        body = self.archives.get(self.path)
+        if body is None:
+            return self._send(404)
+
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        validators = {'ETag': etag, 'Last-Modified': self.last_modified, 'Accept-Ranges': 'bytes'}
+        if self.headers.get('If-None-Match') == etag:
+            return self._send(304, headers=validators)
+
+        range_header = self.headers.get('Range')
+        if range_header and self.headers.get('If-Range') in (None, etag, self.last_modified):
+            start = int(range_header.split('=')[1].split('-')[0])
+            if start >= len(body):
+                return self._send(416, headers={'Content-Range': f"bytes */{len(body)}"})
+            validators['Content-Range'] = f"bytes {start}-{len(body) - 1}/{len(body)}"
+            return self._send(206, body[start:], validators)
+        return self._send(200, body, validators)
+
+def _fake_archives(years, n_inst):
+    """One zip per year holding a synthetic herd_{year}.csv."""
+    archives = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for path in make_synthetic_raw(tmp, n_inst=n_inst, years=years):
+            year = etl.file_year(path)
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as z:
+                z.write(path, f"herd{year}.csv")
+            archives[f"/files/higher_education_r_and_d_{year}.zip"] = buffer.getvalue()
+    return archives
+
+def bench_download(args):
+    """Serial vs concurrent download, 304 re-runs and Range resume against a local server."""
+    _FakeNSFHandler.archives = _fake_archives(range(2010, 2025), args.institutions)
+    _FakeNSFHandler.latency = args.latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _FakeNSFHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}/"
+    total_mb = sum(len(b) for b in _FakeNSFHandler.archives.values()) / 1e6
+    print(f"🧪 Serving {len(_FakeNSFHandler.archives)} fake archives ({total_mb:.1f} MB) at {base_url}")
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            timings = {}
+            for workers in sorted({1, args.workers}):
+                out = Path(tmp) / f"raw_{workers}"
+                start = time.perf_counter()
+                HERDDownloader(out, base_url=base_url, workers=workers).run()
+                timings[workers] = time.perf_counter() - start
+
+            # Re-run: every year should be answered with 304 Not Modified
+            out = Path(tmp) / f"raw_{args.workers}"
+            _FakeNSFHandler.requests_seen.clear()
+            start = time.perf_counter()
+            HERDDownloader(out, base_url=base_url, workers=args.workers).run()
+            t_rerun = time.perf_counter() - start
+            not_modified = sum(1 for _, status in _FakeNSFHandler.requests_seen if status == 304)
+
+            # Resume: fake an interrupted 2024 download, half written
+            path = "/files/higher_education_r_and_d_2024.zip"
+            body = _FakeNSFHandler.archives[path]
+            expected = sorted(out.glob("herd_2024*.csv"))[0].read_bytes()
+            for old in out.glob("herd_2024*.csv"):
+                old.unlink()
+            part = out / "herd_2024.zip.part"
+            part.write_bytes(body[:len(body) // 2])
+            part.with_name(part.name + ".json").write_text(
+                json.dumps({'etag': '"%s"' % hashlib.md5(body).hexdigest()})
+            )
+            _FakeNSFHandler.requests_seen.clear()
+            HERDDownloader(out, base_url=base_url, workers=args.workers).run()
+            ranged = [status for p, status in _FakeNSFHandler.requests_seen if p == path]
+            resumed_ok = ranged == [206] and sorted(out.glob("herd_2024*.csv"))[0].read_bytes() == expected
+    finally:
+        server.shutdown()
+
+    print(f"\n🔍 Re-run answered 304 for {not_modified}/15 years; resume used Range and matched: {resumed_ok}")
+    if not_modified != 15 or not resumed_ok:
+        raise SystemExit(1)
+
+    print(f"\n⏱️  Cold download ({args.latency * 1000:.0f} ms simulated latency per request)")
+    for workers, seconds in timings.items():
+        print(f"   {workers:>2} worker(s): {seconds:7.2f}s  (x{timings[1] / seconds:.2f})")
+    print(f"   re-run, all 304: {t_rerun:7.2f}s")
+
+# --- Local stand-in for an OpenAI-compatible LLM endpoint ---
+
+class _FakeLLMHandler(BaseHTTPRequestHandler):
+    """
+    Answers /v1/chat/completions after a fixed latency: SQL for the agent's
+    SQL prompts (looking up the institution number in the question), a
+    canned sentence for summary prompts. Some first answers name a column
+    that does not exist, to exercise the agent's repair round-trip. `stream=True` requests get the
+    answer as a single server-sent chunk.
+    """
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True   # headers and body go out as separate writes
+    latency = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        prompt = "\n".join(m['content'] for m in request['messages'])
+        time.sleep(self.latency)
+
+        if "SQL Expert" in prompt:
+            question = re.search(r'### REQUEST\s*"(.*?)"', prompt, re.DOTALL).group(1)
+            number = int(re.search(r'\d+', question).group())
+            # Every tenth institution first gets a misspelled column, fixed on repair
+            column = "src_totl" if number % 10 == 7 and "failed validation" not in prompt else "src_total"
+            content = (f"```sql\nSELECT name, year, {column} FROM institutions "
+                       f"WHERE inst_id = '{100000 + number:06d}' ORDER BY year;\n```")
+        else:
+            content = f"Summary of {prompt.count(chr(10))} lines of data."
+
+        if request.get('stream'):
+            chunks = [
+                {'index': 0, 'finish_reason': None, 'delta': {'role': 'assistant', 'content': content}},
+                {'index': 0, 'finish_reason': 'stop', 'delta': {}},
+            ]
+            body = "".join(
+                "data: " + json.dumps({'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': 0,
+                                       'model': request['model'], 'choices': [choice]}) + "\n\n"
+                for choice in chunks
+            ).encode() + b"data: [DONE]\n\n"
+            content_type = 'text/event-stream'
+        else:
+            body = json.dumps({
+                'id': 'chatcmpl-fake', 'object': 'chat.completion', 'created': 0, 'model': request['model'],
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': content}}],
+                'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+            }).encode()
+            content_type = 'application/json'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def bench_agent(args):
+    """LocalAgent batch mode against a fake LLM: one question at a time vs concurrent."""
+    _FakeLLMHandler.latency = args.latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _FakeLLMHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}/v1"
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            print(f"🧪 Building a synthetic herd.db ({args.institutions} institutions x 15 years)...")
+            make_synthetic_raw(tmp / "raw", n_inst=args.institutions)
+            db_path = tmp / "herd.db"
+            etl.run_etl(full_rebuild=True, data_dir=tmp / "raw", db_path=db_path, download=False)
+
+            questions = [f"How has institution {i % args.institutions} total R&D changed?"
+                         for i in range(args.questions)]
+            timings, outputs = {}, {}
+            # The SQL memo is off (TTL 0) so every run pays for its LLM calls;
+            # the last run reuses the SQL memoized by a warm-up run.
+            runs = [(c, c, 0) for c in sorted({1, args.concurrency})] + [("memo", args.concurrency, 3600)]
+            for label, concurrency, memo_ttl in runs:
+                if label == "memo":
+                    (tmp / "herd.sql_memo.db").unlink(missing_ok=True)
+                    agent = local_agent.LocalAgent(db_path=db_path, pool_size=concurrency, memo_ttl=memo_ttl)
+                    asyncio.run(agent.run_batch(questions, tmp / "warmup.jsonl", concurrency,
+                                                base_url=base_url, api_key="fake"))
+                    agent.engine.close()
+                    agent.sql_memo.close()
+                out = tmp / f"results_{label}.jsonl"
+                agent = local_agent.LocalAgent(db_path=db_path, pool_size=concurrency, memo_ttl=memo_ttl)
+                start = time.perf_counter()
+                failed = asyncio.run(agent.run_batch(questions, out, concurrency, base_url=base_url, api_key="fake"))
+                timings[label] = time.perf_counter() - start
+                agent.engine.close()
+                agent.sql_memo.close()
+                if failed:
+                    raise SystemExit(f"{failed} questions failed")
+                with open(out) as f:
+                    records = sorted((json.loads(line) for line in f), key=lambda r: r['index'])
+                outputs[label] = [(r['sql'], r['result'], r['summary']) for r in records]
+    finally:
+        server.shutdown()
+
+    same = outputs[1] == outputs[args.concurrency] == outputs["memo"]
+    print(f"\n🔍 Answers identical: {same} ({len(questions)} questions)")
+    if not same:
+        raise SystemExit(1)
+
+    print(f"\n⏱️  {len(questions)} questions, {args.latency * 1000:.0f} ms per LLM call")
+    for label, seconds in timings.items():
+        name = f"concurrency {label:>3}" if label != "memo" else f"{args.concurrency:>3} + SQL memo"
+        print(f"   {name:<15}: {seconds:7.2f}s  {len(questions) / seconds:7.1f} questions/s"
+              f"  (x{timings[1] / seconds:.1f})")
+
+# Cold-start budgets: modules that must not be imported, and the most
+# milliseconds the module may add on top of its unavoidable base import.
+# The server's share includes fastmcp registering its tools (docstring
+# parsing and JSON schemas), roughly 100 ms.
+IMPORT_BUDGETS = {
+    'server': {'base': 'from fastmcp import FastMCP', 'forbidden': ['pandas', 'numpy', 'openai'], 'max_ms': 250},
+    'local_agent': {'base': None, 'forbidden': ['pandas', 'numpy', 'openai', 'yaml'], 'max_ms': 150},
+}
+
+_IMPORT_MARK = "-- import starts --"
+
+def _import_time(statement):
+    """
+    Milliseconds `statement` takes in a fresh interpreter, and the
+    cumulative microseconds per module it imported, from `-X importtime`.
+    """
+    code = (f"import sys, time; print('{_IMPORT_MARK}', file=sys.stderr, flush=True); "
+            f"start = time.perf_counter(); {statement}; print(time.perf_counter() - start)")
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            capture_output=True, text=True, cwd=Path(__file__).parent)
+    if result.returncode != 0:
+        raise SystemExit(f"{statement} failed:\n{result.stderr[-2000:]}")
+    modules = {}
+    # Interpreter startup (site, encodings) is logged before the marker
+    for line in result.stderr.split(_IMPORT_MARK, 1)[-1].splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \| (\s*)(\S+)", line)
+        if match:
+            modules[match.group(3)] = int(match.group(1))
+    return float(result.stdout) * 1000, modules
+
+def bench_imports(args):
+    """Cold-start import time of the server and agent, with regression thresholds."""
+    failures = []
+    for module, budget in IMPORT_BUDGETS.items():
+        runs = [_import_time(f"import {module}") for _ in range(args.repeat)]
+        total_ms, modules = min(runs, key=lambda run: run[0])
+        base_ms = min(_import_time(budget['base'])[0] for _ in range(args.repeat)) if budget['base'] else 0.0
+        own_ms = total_ms - base_ms
+        max_ms = args.max_ms if args.max_ms is not None else budget['max_ms']
+
+        base_note = f" ({budget['base']}: {base_ms:.0f} ms)" if budget['base'] else ""
+        print(f"\n📦 import {module}: {total_ms:.0f} ms, {own_ms:.0f} ms of its own{base_note}, best of {args.repeat}")
+        top_level = sorted(((name, us) for name, us in modules.items() if '.' not in name and name != module),
+                           key=lambda item: -item[1])[:args.top]
+        for name, us in top_level:
+            print(f"   {name:<24}{us / 1000:8.1f} ms")
+
+        heavy = [name for name in budget['forbidden'] if name in modules]
+        if heavy:
+            failures.append(f"import {module} pulls in {', '.join(heavy)}")
+        if own_ms > max_ms:
+            failures.append(f"import {module} takes {own_ms:.0f} ms beyond its base import (budget {max_ms:.0f} ms)")
+
+    if failures:
+        for failure in failures:
+            print(f"❌ {failure}")
+        raise SystemExit(1)
+    print("\n✅ Cold-start imports within budget")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks on synthetic HERD data.")
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    p = sub.add_parser('etl', help="Serial vs process-pool ETL rebuild (with parity check).")
+    p.add_argument('--institutions', type=int, default=200)
+    p.add_argument('--workers', type=int, default=4)
+    p.set_defaults(func=bench_etl)
+
+    p = sub.add_parser('incremental', help="Incremental loads vs full rebuilds on SQLite (fails on mismatch).")
+    p.add_argument('--institutions', type=int, default=60)
+    p.set_defaults(func=bench_incremental)
+
+    p = sub.add_parser('matching', help="String fingerprints vs integer-coded matching.")
+    p.add_argument('--institutions', type=int, default=1000)
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(func=bench_matching)
+
+    p = sub.add_parser('mapping', help="Per-row vs vectorized mapping generation; JSON vs compiled startup.")
+    p.add_argument('--scale', type=int, default=20, help="Copies of the schema report to generate from.")
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(func=bench_mapping)
+
+    p = sub.add_parser('schema', help="Per-record loop vs vectorized schema analyzer.")
+    p.add_argument('--institutions', type=int, default=200)
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(func=bench_schema)
+
+    p = sub.add_parser('queries', help="Concurrent clients against herd.db: per-call connections vs pool.")
+    p.add_argument('--institutions', type=int, default=200)
+    p.add_argument('--clients', type=int, default=32)
+    p.add_argument('--queries', type=int, default=50, help="Queries per client.")
+    p.add_argument('--pool', type=int, default=4)
+    p.set_defaults(func=bench_queries)
+
+    p = sub.add_parser('snapshot', help="Point metric lookups: pooled SQL vs the memory-mapped snapshot.")
+    p.add_argument('--institutions', type=int, default=200)
+    p.add_argument('--lookups', type=int, default=2000)
+    p.add_argument('--inst-per-lookup', type=int, default=3)
+    p.set_defaults(func=bench_snapshot)
+
+    p = sub.add_parser('names', help="Institution-name lookups: LIKE scan vs the in-memory alias index.")
+    p.add_argument('--institutions', type=int, default=3000)
+    p.add_argument('--lookups', type=int, default=1000)
+    p.set_defaults(func=bench_names)
+
+    p = sub.add_parser('parity', help="SQLite vs PostgreSQL: load times and identical results (fails on mismatch).")
+    p.add_argument('--institutions', type=int, default=60)
+    p.add_argument('--postgres', metavar='URL',
+                   help="Server to test against (default: a throwaway cluster from initdb on PATH).")
+    p.add_argument('--pg-bin', metavar='DIR', help="Directory with initdb and pg_ctl for the throwaway cluster.")
+    p.add_argument('--schema', default="herd_parity", help="Schema to load into (dropped afterwards).")
+    p.add_argument('--keep', action='store_true', help="Keep the PostgreSQL schema for inspection.")
+    p.set_defaults(func=bench_parity)
+
+    p = sub.add_parser('pgsql', help="PostgreSQL SQL, partitions and COPY input, no server needed (fails on mismatch).")
+    p.set_defaults(func=bench_pgsql)
+
+    p = sub.add_parser('download', help="Concurrent/resumable downloads against a local fake NSF server.")
+    p.add_argument('--institutions', type=int, default=50)
+    p.add_argument('--workers', type=int, default=4)
+    p.add_argument('--latency', type=float, default=0.25)
+    p.set_defaults(func=bench_download)
+
+    p = sub.add_parser('agent', help="LocalAgent batch mode against a local fake OpenAI-compatible server.")
+    p.add_argument('--institutions', type=int, default=50)
+    p.add_argument('--questions', type=int, default=100)
+    p.add_argument('--concurrency', type=int, default=16)
+    p.add_argument('--latency', type=float, default=0.05, help="Seconds per fake LLM call.")
+    p.set_defaults(func=bench_agent)
+
+    p = sub.add_parser('imports', help="Cold-start import time of server.py and local_agent.py (fails over budget).")
+    p.add_argument('--repeat', type=int, default=5)
+    p.add_argument('--top', type=int, default=8, help="Slowest top-level imports to list.")
+    p.add_argument('--max-ms', type=float, default=None, help="Override the per-module budget.")
+    p.set_defaults(func=bench_imports)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
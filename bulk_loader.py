@@ -0,0 +1,323 @@
+"""
+Bulk loader for etl.py: the schema and writers, for SQLite and PostgreSQL.
+
+A SQLite load never touches herd.db directly. It runs inside a staging copy
+(`herd.db.staging`) opened with journaling and fsync disabled and a large
+page cache, as one transaction of `executemany` inserts over plain tuples.
+Secondary indexes are built after the data is in, then the file is
+ANALYZEd, VACUUMed and atomically renamed over herd.db, so readers such as
+server.py only ever see the previous or the finished database.
+
+On PostgreSQL (postgres_storage.py) the same functions run inside the load
+transaction there; the identity, facts and wide tables are partitioned by
+year, and rows go in with COPY instead of `executemany`.
+"""
+import os
+import sqlite3
+from contextlib import closing, contextmanager
+from pathlib import Path
+
+import instrumentation
+import storage
+from pivot import ID_COLUMNS
+
+# Staging connection settings: durability is provided by the final rename,
+# so the load itself can skip the journal and fsyncs.
+STAGING_PRAGMAS = {
+    'journal_mode': 'OFF',
+    'synchronous': 'OFF',
+    'locking_mode': 'EXCLUSIVE',
+    'temp_store': 'MEMORY',
+    'cache_size': -512 * 1024,  # KiB, i.e. 512 MB
+}
+
+def staging_path(db_path):
+    db_path = Path(db_path)
+    return db_path.with_name(db_path.name + ".staging")
+
+@contextmanager
+def staging_database(db_path, fresh=False):
+    """
+    Yields an autocommit connection to a staging copy of `db_path` inside an
+    open transaction. On success the transaction is committed, the file is
+    analyzed and vacuumed and replaces `db_path`; on any error the staging
+    file is discarded and `db_path` is left untouched.
+
+    `fresh=True` starts from an empty database instead of a copy. Every
+    load bumps the load generation (`PRAGMA user_version`) that result
+    caches key on, also across fresh rebuilds.
+    """
+    db_path = Path(db_path)
+    staging = staging_path(db_path)
+    staging.unlink(missing_ok=True)  # leftover from an interrupted load
+    generation = read_generation(db_path) + 1
+
+    conn = sqlite3.connect(staging, isolation_level=None)
+    try:
+        if not fresh and db_path.exists():
+            with closing(sqlite3.connect(db_path)) as source:
+                source.backup(conn)
+        for pragma, value in STAGING_PRAGMAS.items():
+            conn.execute(f"PRAGMA {pragma} = {value}")
+
+        conn.execute("BEGIN")
+        yield conn
+        with instrumentation.span("commit"):
+            conn.execute(f"PRAGMA user_version = {generation}")
+            conn.execute("COMMIT")
+
+            conn.execute("ANALYZE")
+            conn.execute("VACUUM")
+            conn.close()
+            os.replace(staging, db_path)
+    except BaseException:
+        conn.close()
+        staging.unlink(missing_ok=True)
+        raise
+
+def read_generation(db_path):
+    """Load generation of `db_path` (0 if it does not exist yet)."""
+    if not Path(db_path).exists():
+        return 0
+    with closing(sqlite3.connect(db_path)) as conn:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+
+# --- SCHEMA & WRITERS ---
+
+def table_columns(conn, table):
+    return storage.table_columns(conn, table)
+
+def institutions_type(conn):
+    """'table' for the wide table, 'view' for the facts-backed view, else None."""
+    return storage.table_type(conn, 'institutions')
+
+def _postgres(conn):
+    return storage.dialect(conn) == 'postgresql'
+
+def _partitions(conn, wide_table):
+    """Year-partitioned tables on PostgreSQL (none on SQLite)."""
+    if not _postgres(conn):
+        return []
+    from postgres_storage import PARTITIONED_TABLES
+    return [t for t in PARTITIONED_TABLES if wide_table or t != 'institutions']
+
+def _insert(conn, table, columns, rows, year=None):
+    """
+    Appends `rows`: executemany on SQLite, one COPY on PostgreSQL (into the
+    table's partition for `year`, when it has one).
+    """
+    if _postgres(conn):
+        from postgres_storage import PARTITIONED_TABLES, partition
+        conn.copy_rows(partition(table, year) if table in PARTITIONED_TABLES else table, columns, rows)
+        return
+    names = ", ".join(f'"{c}"' for c in columns)
+    conn.executemany(f"INSERT INTO {table} ({names}) VALUES ({', '.join('?' * len(columns))})", rows)
+
+def drop_institutions(conn):
+    kind = institutions_type(conn)
+    if kind:
+        conn.execute(f"DROP {kind.upper()} institutions")
+
+def ensure_schema(conn, wide_table=True):
+    # Views are recreated by create_views at the end of every load;
+    # PostgreSQL will not drop or alter the tables they read while they exist
+    conn.execute("DROP VIEW IF EXISTS herd_metrics")
+    if institutions_type(conn) == 'view':
+        drop_institutions(conn)
+    # Identity, facts and wide rows: one partition per year on PostgreSQL
+    by_year = " PARTITION BY LIST (year)" if _postgres(conn) else ""
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS etl_manifest (
+            path TEXT PRIMARY KEY,
+            year INTEGER,
+            size INTEGER,
+            mtime REAL,
+            sha256 TEXT,
+            mapping_hash TEXT,
+            year_mapping_hash TEXT,
+            loaded_at TEXT
+        )
+    """)
+    # Long-format storage: one identity row per (inst_id, year) and one fact
+    # per non-zero cell. The clustered key (metric_id, year, inst_id) is the
+    # covering index: time-series and peer lookups on a metric are range scans.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS institution_years (
+            inst_id TEXT NOT NULL, name TEXT, city TEXT, state TEXT, year INTEGER NOT NULL,
+            PRIMARY KEY (year, inst_id)
+        )""" + (by_year or " WITHOUT ROWID"))
+    # Every name an institution reported, before names are unified to the
+    # latest year's; seeds the name search index (name_index.py)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS institution_name_history (
+            inst_id TEXT NOT NULL, year INTEGER NOT NULL, name TEXT NOT NULL,
+            PRIMARY KEY (year, inst_id, name)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS herd_facts (
+            inst_id TEXT NOT NULL,
+            year INTEGER NOT NULL,
+            metric_id INTEGER NOT NULL,
+            value REAL,
+            PRIMARY KEY (metric_id, year, inst_id)
+        )""" + (by_year or " WITHOUT ROWID"))
+
+    if wide_table:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS institutions (
+                inst_id TEXT, name TEXT, city TEXT, state TEXT, year INTEGER
+            )""" + by_year)
+
+def _wide_columns(conn, columns):
+    return [storage.column_name(storage.dialect(conn), c) for c in columns]
+
+def sync_metric_columns(conn, mapped_cols):
+    """Drops metric columns whose key is no longer in mapping.json."""
+    mapped_cols = set(_wide_columns(conn, mapped_cols))
+    for col in table_columns(conn, 'institutions'):
+        if col not in ID_COLUMNS and col not in mapped_cols:
+            conn.execute(f'ALTER TABLE institutions DROP COLUMN "{col}"')
+
+def _add_columns(conn, columns):
+    """
+    Adds newly seen metrics as columns. They default to 0 so years that lack
+    them match the full-build fillna(0). PostgreSQL would copy a default to
+    every year partition, and dropping hundreds of defaults per partition
+    exhausts its lock table, so there rows already stored are set to 0 and
+    write_year fills the columns a year lacks.
+    """
+    existing = set(table_columns(conn, 'institutions'))
+    added = [col for col in _wide_columns(conn, columns) if col not in existing]
+    for col in added:
+        conn.execute(f'ALTER TABLE institutions ADD COLUMN "{col}" REAL' + ("" if _postgres(conn) else " DEFAULT 0"))
+    if added and _postgres(conn):
+        conn.execute("UPDATE institutions SET " + ", ".join(f'"{col}" = 0' for col in added))
+
+def delete_year(conn, year, wide_table=True):
+    conn.execute("DELETE FROM institution_name_history WHERE year = ?", (year,))
+    partitioned = _partitions(conn, wide_table)
+    if partitioned:
+        from postgres_storage import partition
+        for table in partitioned:
+            conn.execute(f'DROP TABLE IF EXISTS "{partition(table, year)}"')
+        return
+    conn.execute("DELETE FROM institution_years WHERE year = ?", (year,))
+    conn.execute("DELETE FROM herd_facts WHERE year = ?", (year,))
+    if wide_table:
+        conn.execute("DELETE FROM institutions WHERE year = ?", (year,))
+
+def write_year(conn, year, wide, metric_ids, wide_table=True):
+    """
+    Replaces every row of one survey year with `wide`: identity rows, facts,
+    and (unless running facts-only) the wide `institutions` rows.
+    """
+    delete_year(conn, year, wide_table)
+    if wide is None or not len(wide):
+        return 0
+    if wide_table:
+        _add_columns(conn, wide.columns)
+    for table in _partitions(conn, wide_table):
+        from postgres_storage import partition
+        conn.execute(f'CREATE TABLE "{partition(table, year)}" PARTITION OF {table} FOR VALUES IN ({int(year)})')
+
+    _insert(conn, 'institution_years', ID_COLUMNS,
+            wide.ids.reindex(columns=ID_COLUMNS).astype(object).where(wide.ids.notna(), None)
+                .itertuples(index=False, name=None), year)
+    _insert(conn, 'herd_facts', ['inst_id', 'year', 'metric_id', 'value'],
+            wide.iter_facts([metric_ids[m] for m in wide.metrics]), year)
+    # Unique per year already (etl.process_year drops duplicates)
+    _insert(conn, 'institution_name_history', ['inst_id', 'year', 'name'],
+            [(inst_id, year, name) for inst_id, name in wide.raw_names])
+    if wide_table:
+        columns, rows = _wide_columns(conn, wide.columns), wide.iter_rows()
+        if _postgres(conn):
+            absent = [c for c in table_columns(conn, 'institutions') if c not in set(columns)]
+            columns, rows = columns + absent, (row + (0.0,) * len(absent) for row in rows)
+        _insert(conn, 'institutions', columns, rows, year)
+    return len(wide)
+
+def create_indexes(conn, wide_table=True):
+    """Secondary indexes, built once the rows are in."""
+    if wide_table:
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_inst_id ON institutions(inst_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_name ON institutions(name)")
+    else:
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_years_inst_id ON institution_years(inst_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_years_name ON institution_years(name)")
+
+def write_data_dictionary(conn, metadata_rows):
+    """
+    Rewrites data_dictionary, keeping each metric's integer metric_id stable
+    across loads (facts of unchanged years still reference it). Returns
+    {column_name: metric_id} and deletes facts of metrics no longer mapped.
+    """
+    previous = {}
+    if 'metric_id' in table_columns(conn, 'data_dictionary'):
+        previous = dict(conn.execute("SELECT column_name, metric_id FROM data_dictionary"))
+
+    metric_ids, latest = {}, {}
+    next_id = max(previous.values(), default=0) + 1
+    for m in metadata_rows:
+        name = m['column_name']
+        latest[name] = m  # a repeated column keeps its last metadata row
+        if name in metric_ids:
+            continue
+        if name in previous:
+            metric_ids[name] = previous[name]
+        else:
+            metric_ids[name] = next_id
+            next_id += 1
+
+    dropped = [(metric_id,) for name, metric_id in previous.items() if name not in metric_ids]
+    conn.executemany("DELETE FROM herd_facts WHERE metric_id = ?", dropped)
+
+    conn.execute("DROP TABLE IF EXISTS data_dictionary")
+    conn.execute("""
+        CREATE TABLE data_dictionary (
+            metric_id INTEGER PRIMARY KEY, category TEXT, column_name TEXT UNIQUE,
+            description TEXT, start_year INTEGER, end_year INTEGER
+        )
+    """)
+    conn.executemany(
+        "INSERT INTO data_dictionary VALUES (?, ?, ?, ?, ?, ?)",
+        [(metric_ids[name], m['category'], name, m['description'], m['start_year'], m['end_year'])
+         for name, m in latest.items()]
+    )
+    return metric_ids
+
+def create_views(conn, wide_table=True):
+    """
+    `herd_metrics` is a readable face of herd_facts. Without the wide table,
+    `institutions` becomes a view with the same columns, so existing queries
+    keep working; each metric column is a primary-key lookup that SQLite only
+    evaluates when the query actually selects it.
+    """
+    conn.execute("DROP VIEW IF EXISTS herd_metrics")
+    conn.execute("""
+        CREATE VIEW herd_metrics AS
+        SELECT f.inst_id, y.name, y.state, f.year, d.column_name AS metric, d.category, f.value
+        FROM herd_facts f
+        JOIN data_dictionary d ON d.metric_id = f.metric_id
+        JOIN institution_years y ON y.year = f.year AND y.inst_id = f.inst_id
+    """)
+
+    if wide_table:
+        return
+    drop_institutions(conn)
+    metrics = conn.execute("""
+        SELECT metric_id, column_name FROM data_dictionary d
+        WHERE EXISTS (SELECT 1 FROM herd_facts f WHERE f.metric_id = d.metric_id)
+        ORDER BY column_name
+    """).fetchall()
+    metric_cols = "".join(
+        f',\n            COALESCE((SELECT f.value FROM herd_facts f WHERE f.metric_id = {metric_id}'
+        f' AND f.year = y.year AND f.inst_id = y.inst_id), 0) AS "{name}"'
+        for metric_id, name in zip([m[0] for m in metrics], _wide_columns(conn, [m[1] for m in metrics]))
+    )
+    conn.execute(f"""
+        CREATE VIEW institutions AS
+        SELECT y.inst_id, y.name, y.city, y.state, y.year{metric_cols}
+        FROM institution_years y
+    """)
@@ -0,0 +1,127 @@
+"""
+TF-IDF retrieval index over the data dictionary, used to pick the columns
+an LLM prompt should mention.
+
+Each metric is a document made of its column name, description and category.
+Terms are lower-cased words plus character trigrams of every word, so
+partial and misspelled words ("comp sci", "engineeering") still match. The
+index is an inverted list of L2-normalized TF-IDF weights; a query touches
+only the postings of its own terms and ranks all columns in well under a
+millisecond.
+
+etl.py builds it after every load and saves it next to herd.db as
+`herd.columns.npz`.
+"""
+import math
+import os
+import re
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+# Character trigrams count for less than whole words
+NGRAM_WEIGHT = 0.5
+
+def index_path(db_path):
+    db_path = Path(db_path)
+    return db_path.with_name(db_path.stem + ".columns.npz")
+
+def _terms(text):
+    """Weighted terms of a text: words, plus trigrams of '#word#'."""
+    terms = Counter()
+    for word in _WORD.findall(text.lower()):
+        terms[word] += 1.0
+        padded = f"#{word}#"
+        for i in range(len(padded) - 2):
+            terms["~" + padded[i:i + 3]] += NGRAM_WEIGHT
+    return terms
+
+def _weights(terms, idf):
+    """Sublinear TF x IDF, L2-normalized. Unknown terms are dropped."""
+    weights = {t: (1.0 + math.log(tf)) * idf[t] if tf >= 1 else tf * idf[t]
+               for t, tf in terms.items() if t in idf}
+    norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+    return {t: w / norm for t, w in weights.items()}
+
+class ColumnIndex:
+    """Inverted TF-IDF index: term -> (column ids, weights)."""
+
+    def __init__(self, columns, terms, idf, indptr, doc_ids, doc_weights):
+        self.columns = columns
+        self.idf = dict(zip(terms.tolist(), idf.tolist()))
+        self._term_ids = {t: i for i, t in enumerate(terms.tolist())}
+        self._indptr = indptr
+        self._doc_ids = doc_ids
+        self._doc_weights = doc_weights
+
+    @classmethod
+    def build(cls, metadata_rows):
+        """Index of data_dictionary-shaped rows (column_name, description, category)."""
+        columns, docs = [], []
+        for m in metadata_rows:
+            if m['column_name'] in columns:
+                continue
+            columns.append(m['column_name'])
+            docs.append(_terms(" ".join([
+                m['column_name'].replace('_', ' '), m.get('description') or "", m.get('category') or "",
+            ])))
+
+        n_docs = len(docs)
+        doc_freq = Counter(t for doc in docs for t in doc)
+        idf = {t: math.log((1 + n_docs) / (1 + df)) + 1.0 for t, df in doc_freq.items()}
+
+        postings = {t: [] for t in sorted(idf)}
+        for doc_id, doc in enumerate(docs):
+            for t, w in _weights(doc, idf).items():
+                postings[t].append((doc_id, w))
+
+        terms = np.array(list(postings), dtype=str)
+        lengths = [len(p) for p in postings.values()]
+        flat = [entry for p in postings.values() for entry in p]
+        return cls(
+            columns=np.array(columns, dtype=str),
+            terms=terms,
+            idf=np.array([idf[t] for t in postings]),
+            indptr=np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+            doc_ids=np.array([d for d, _ in flat], dtype=np.int32),
+            doc_weights=np.array([w for _, w in flat], dtype=np.float32),
+        )
+
+    def save(self, path):
+        path = Path(path)
+        tmp = path.with_name(path.name + ".tmp")
+        terms = np.array(list(self._term_ids), dtype=str)
+        with open(tmp, 'wb') as f:
+            np.savez(f, columns=self.columns, terms=terms, idf=np.array([self.idf[t] for t in terms.tolist()]),
+                     indptr=self._indptr, doc_ids=self._doc_ids, doc_weights=self._doc_weights)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['columns'], data['terms'], data['idf'], data['indptr'],
+                       data['doc_ids'], data['doc_weights'])
+
+    def search(self, query, k=20):
+        """Top-k (column_name, score) pairs for a free-text query, best first."""
+        scores = np.zeros(len(self.columns), dtype=np.float32)
+        for t, w in _weights(_terms(query), self.idf).items():
+            i = self._term_ids[t]
+            lo, hi = self._indptr[i], self._indptr[i + 1]
+            scores[self._doc_ids[lo:hi]] += w * self._doc_weights[lo:hi]
+
+        k = min(k, int((scores > 0).sum()))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.lexsort((top, -scores[top]))]
+        return [(str(self.columns[i]), float(scores[i])) for i in top]
+
+def build_index(metadata_rows, db_path):
+    """Builds the index for a load and saves it next to `db_path`."""
+    index = ColumnIndex.build(metadata_rows)
+    index.save(index_path(db_path))
+    return index
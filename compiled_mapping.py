@@ -0,0 +1,162 @@
+"""
+Compiled form of mapping.json for ETL and agent startup.
+
+mapping.json stays the editable source of truth. `compile_mapping` turns it
+into `mapping.compiled.npz`, which holds:
+- the MappingIndex arrays (the pre-keyed lookup the matcher searches),
+- the metadata table that becomes `data_dictionary`,
+- the hash of the entries active in each survey year (for the load
+  manifest),
+- the SHA-256 of the mapping.json it was built from.
+
+`load_mapping` uses the artifact while that hash still matches mapping.json
+and recompiles it otherwise, so a hand edit is never served stale.
+Collisions (one key in several categories, or one raw (question, row,
+column) fingerprint claimed by several keys) are detected at compile time
+and reported.
+"""
+import hashlib
+import json
+import os
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+
+from matching import MappingIndex
+from raw_files import hash_file
+
+MAPPING_PATH = Path(__file__).parent / "mapping.json"
+COMPILED_VERSION = 1
+
+_METADATA_FIELDS = ['category', 'column_name', 'description', 'start_year', 'end_year']
+
+def compiled_path(mapping_path):
+    mapping_path = Path(mapping_path)
+    return mapping_path.with_name(mapping_path.stem + ".compiled.npz")
+
+def mapping_hash_for_year(full_config, year):
+    """
+    Hash of only the mapping entries active in `year` (start_year..end_year),
+    so editing one entry only invalidates the years it covers.
+    """
+    active = []
+    for category, items in full_config.items():
+        for key, info in items.items():
+            if info['start_year'] <= year <= info['end_year']:
+                active.append([category, key, info])
+    active.sort(key=lambda item: (item[0], item[1]))
+    return hashlib.sha256(json.dumps(active, sort_keys=True).encode()).hexdigest()
+
+def find_collisions(full_config):
+    """Human-readable descriptions of keys and fingerprints that overwrite each other."""
+    categories = defaultdict(list)
+    claimed = defaultdict(list)
+    for category, items in full_config.items():
+        for key, info in items.items():
+            categories[key].append(category)
+            triple = tuple("" if v is None else str(v).lower()
+                           for v in (info['question_id'], info['row_match'] or None, info['col_match'] or None))
+            claimed[triple].append(key)
+
+    collisions = [f"key '{key}' is defined in {', '.join(cats)}"
+                  for key, cats in categories.items() if len(cats) > 1]
+    collisions += [f"fingerprint {'|'.join(triple)} maps to {', '.join(keys)} (last one wins)"
+                   for triple, keys in claimed.items() if len(set(keys)) > 1]
+    return collisions
+
+class CompiledMapping:
+    """Match index, metadata and per-year hashes of one mapping.json."""
+
+    def __init__(self, sha256, mapping_index, metadata, year_hashes, empty_hash, collisions):
+        self.sha256 = sha256
+        self.mapping_index = mapping_index
+        self.metadata = metadata            # {field: np.ndarray}, one element per mapping entry
+        self.year_hashes = year_hashes      # {year: hash of its active entries}
+        self.empty_hash = empty_hash        # hash for years no entry covers
+        self.collisions = collisions
+
+    @classmethod
+    def from_config(cls, full_config, sha256):
+        rows = [(category, key, info['description'], info['start_year'], info['end_year'])
+                for category, items in full_config.items() for key, info in items.items()]
+        metadata = {field: np.array([row[i] for row in rows], dtype=np.int64 if field.endswith('year') else str)
+                    for i, field in enumerate(_METADATA_FIELDS)}
+
+        years = range(int(metadata['start_year'].min()), int(metadata['end_year'].max()) + 1) if rows else []
+        return cls(
+            sha256=sha256,
+            mapping_index=MappingIndex.from_config(full_config),
+            metadata=metadata,
+            year_hashes={year: mapping_hash_for_year(full_config, year) for year in years},
+            empty_hash=mapping_hash_for_year({}, 0),
+            collisions=find_collisions(full_config),
+        )
+
+    @property
+    def metadata_rows(self):
+        """Rows for bulk_loader.write_data_dictionary / ColumnIndex.build."""
+        columns = [self.metadata[f].tolist() for f in _METADATA_FIELDS]
+        return [dict(zip(_METADATA_FIELDS, values)) for values in zip(*columns)]
+
+    def year_hash(self, year):
+        return self.year_hashes.get(year, self.empty_hash)
+
+    def save(self, path):
+        path = Path(path)
+        tmp = path.with_name(path.name + ".tmp")
+        years = sorted(self.year_hashes)
+        arrays = {f"index_{name}": values for name, values in self.mapping_index.to_arrays().items()}
+        arrays.update({f"meta_{field}": values for field, values in self.metadata.items()})
+        with open(tmp, 'wb') as f:
+            np.savez(
+                f, version=np.array(COMPILED_VERSION), sha256=np.array(self.sha256),
+                years=np.array(years, dtype=np.int64),
+                year_hashes=np.array([self.year_hashes[y] for y in years], dtype=str),
+                empty_hash=np.array(self.empty_hash), collisions=np.array(self.collisions, dtype=str),
+                **arrays,
+            )
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            if int(data['version']) != COMPILED_VERSION:
+                raise ValueError("compiled mapping version mismatch")
+            index = MappingIndex.from_arrays(**{name[len("index_"):]: data[name]
+                                                for name in data.files if name.startswith("index_")})
+            return cls(
+                sha256=str(data['sha256']),
+                mapping_index=index,
+                metadata={field: data[f"meta_{field}"] for field in _METADATA_FIELDS},
+                year_hashes=dict(zip(data['years'].tolist(), data['year_hashes'].tolist())),
+                empty_hash=str(data['empty_hash']),
+                collisions=data['collisions'].tolist(),
+            )
+
+def compile_mapping(mapping_path=None):
+    """Compiles mapping.json next to itself and returns the CompiledMapping."""
+    mapping_path = Path(mapping_path or MAPPING_PATH)
+    sha256 = hash_file(mapping_path)
+    with open(mapping_path) as f:
+        compiled = CompiledMapping.from_config(json.load(f), sha256)
+    compiled.save(compiled_path(mapping_path))
+    return compiled
+
+def load_mapping(mapping_path=None):
+    """
+    The compiled mapping for mapping.json, recompiled first when the
+    artifact is missing, unreadable or built from different bytes.
+    """
+    mapping_path = Path(mapping_path or MAPPING_PATH)
+    try:
+        compiled = CompiledMapping.load(compiled_path(mapping_path))
+        if compiled.sha256 == hash_file(mapping_path):
+            return compiled
+    except (OSError, ValueError, KeyError):
+        pass
+    compiled = compile_mapping(mapping_path)
+    if compiled.collisions:
+        print(f"⚠️  mapping.json has {len(compiled.collisions)} colliding entries "
+              f"(run generate_mapping.py --check to list them)")
+    return compiled
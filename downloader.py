@@ -1,32 +1,65 @@
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
-import os
+import json
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlsplit
 import zipfile
-import io
 import re
+import instrumentation
+from raw_files import main_csv_member
 
 class HERDDownloader:
-    def __init__(self, output_dir):
-        self.base_url = 'https://ncses.nsf.gov/explore-data/microdata/higher-education-research-development'
+    """
+    Fetches the yearly HERD zip archives.
+
+    Years are downloaded concurrently over one keep-alive `requests.Session`.
+    Each archive is streamed to a `.part` file in chunks, so an interrupted
+    download resumes with an HTTP Range request on the next run. The ETag /
+    Last-Modified of every archive is kept in `downloads.json`, and later runs
+    send conditional requests so unchanged years cost a single 304.
+
+    With `keep_archives=True` the archive itself is kept as `herd_{year}.zip`
+    and nothing is extracted; raw_files reads the CSV straight out of it.
+    """
+    CHUNK_SIZE = 1 << 20
+    MANIFEST_NAME = "downloads.json"
+
+    def __init__(self, output_dir, base_url=None, workers=4, timeout=60, keep_archives=False):
+        self.base_url = base_url or 'https://ncses.nsf.gov/explore-data/microdata/higher-education-research-development'
         self.output_dir = Path(output_dir)
         self.headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
+        self.workers = workers
+        self.timeout = timeout
+        self.keep_archives = keep_archives
+        # Links are resolved against the site root, as on the NSF page
+        self.site_root = "{0.scheme}://{0.netloc}".format(urlsplit(self.base_url))
+        self._print_lock = threading.Lock()
+
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
     def run(self, start_year=2010):
         print(f"⬇️  Starting automated download to {self.output_dir}...")
         self.output_dir.mkdir(parents=True, exist_ok=True)
-        
+
         # 1. Fetch the page
         try:
-            response = requests.get(self.base_url, headers=self.headers)
-            response.raise_for_status()
+            with instrumentation.span("download"):
+                response = self.session.get(self.base_url, timeout=self.timeout)
+                response.raise_for_status()
         except Exception as e:
             print(f"❌ Error accessing NSF website: {e}")
             return
 
         soup = BeautifulSoup(response.text, 'html.parser')
-        
+
         # 2. Find all ZIP links
         zip_links = []
         for link in soup.find_all('a', href=True):
@@ -37,47 +70,168 @@ class HERDDownloader:
                 if year_match:
                     year = int(year_match.group(1))
                     if year >= start_year:
-                        zip_links.append((year, urljoin('https://ncses.nsf.gov', href)))
+                        zip_links.append((year, urljoin(self.site_root, href)))
 
         print(f"🔎 Found {len(zip_links)} datasets from {start_year} to present.")
 
-        # 3. Download and Extract
-        for year, link in zip_links:
-            self._process_year(year, link)
+        # 3. Download and Extract, several years at a time
+        manifest = self._load_manifest()
+        with ThreadPoolExecutor(max_workers=max(self.workers, 1)) as pool:
+            futures = {
+                pool.submit(self._timed_year, year, link, manifest.get(str(year), {})): year
+                for year, link in zip_links
+            }
+            for future in as_completed(futures):
+                validators = future.result()
+                if validators is not None:
+                    # Only the main thread touches the manifest
+                    manifest[str(futures[future])] = validators
+                    self._save_manifest(manifest)
+
+    def _say(self, line):
+        """Prints one whole progress line; years report from several threads."""
+        with self._print_lock:
+            print(line, flush=True)
 
-    def _process_year(self, year, link):
-        # Check if we already have the csv to avoid re-downloading
-        expected_file = self.output_dir / f"herd_{year}.csv"
-        
+    # --- Download manifest (ETag / Last-Modified per year) ---
+
+    def _load_manifest(self):
+        path = self.output_dir / self.MANIFEST_NAME
+        if path.exists():
+            with open(path) as f:
+                return json.load(f)
+        return {}
+
+    def _save_manifest(self, manifest):
+        path = self.output_dir / self.MANIFEST_NAME
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        tmp.replace(path)
+
+    # --- One year ---
+
+    def _timed_year(self, year, link, validators):
+        with instrumentation.span("download", year=year):
+            return self._process_year(year, link, validators)
+
+    def _process_year(self, year, link, validators):
+        """
+        Downloads and extracts one year. Returns the validators to remember
+        for it, or None when nothing should be recorded.
+        """
         # We look for any file starting with herd_{year} because the raw names vary
+        kept_archive = self.output_dir / f"herd_{year}.zip"
         existing = list(self.output_dir.glob(f"herd_{year}*.csv"))
-        if existing:
-            print(f"   ✓ Data for {year} already exists. Skipping.")
-            return
+        if kept_archive.exists():
+            existing.append(kept_archive)
+        if existing and not validators:
+            # Extracted before validators were tracked: nothing to compare against
+            self._say(f"   ✓ Data for {year} already exists. Skipping.")
+            return None
 
-        print(f"   ⏳ Downloading {year} data...")
         try:
-            r = requests.get(link, headers=self.headers, stream=True)
-            r.raise_for_status()
-            
-            # Unzip in memory
-            with zipfile.ZipFile(io.BytesIO(r.content)) as z:
-                # Find the main CSV (usually starts with 'herd_')
-                csv_files = [f for f in z.namelist() if f.endswith('.csv')]
-                for csv_file in csv_files:
-                    # Save it with a clean name to preserve your ETL logic
-                    # We keep the original name to be safe, or you can rename it here
-                    source = z.open(csv_file)
-                    target_path = self.output_dir / f"herd_{year}_{csv_file}"
-                    
-                    with open(target_path, 'wb') as f:
-                        f.write(source.read())
-                    print(f"   ✅ Extracted: {target_path.name}")
-                    
+            archive, validators = self._download(year, link, validators if existing else {})
+            if archive is None:
+                self._say(f"   ✓ Data for {year} is unchanged on the server. Skipping.")
+                return None
+
+            # The new archive replaces whatever was stored for this year
+            for old in existing:
+                if old != archive:
+                    old.unlink()
+            if self.keep_archives or kept_archive in existing:
+                self._say(f"   ✅ Stored: {archive.name} (compressed)")
+            else:
+                self._extract(year, archive)
+                archive.unlink()
+            return validators
         except Exception as e:
-            print(f"   ❌ Failed to download {year}: {e}")
+            self._say(f"   ❌ Failed to download {year}: {e}")
+            return None
+
+    def _download(self, year, link, validators):
+        """
+        Streams the archive to `herd_{year}.zip.part`, resuming a partial file
+        with a Range request. Returns (archive_path, validators), or
+        (None, validators) if the server answered 304 Not Modified.
+        """
+        part = self.output_dir / f"herd_{year}.zip.part"
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+        offset = part.stat().st_size if part.exists() else 0
+        partial = self._load_partial(part)
+        partial_validator = partial.get('etag') or partial.get('last_modified')
+        if offset and partial_validator:
+            # Resume only if the server still has the same file (If-Range)
+            headers['Range'] = f"bytes={offset}-"
+            headers['If-Range'] = partial_validator
+
+        with self.session.get(link, headers=headers, stream=True, timeout=self.timeout) as r:
+            if r.status_code == 304:
+                return None, validators
+            if r.status_code == 416 and offset:
+                # Range past the end: the partial file is already complete
+                pass
+            else:
+                r.raise_for_status()
+                resumed = r.status_code == 206
+                self._say(f"   ⏳ {'Resuming' if resumed else 'Downloading'} {year} data"
+                      f"{f' from byte {offset:,}' if resumed else ''}...")
+
+                validators = {
+                    'url': link,
+                    'etag': r.headers.get('ETag'),
+                    'last_modified': r.headers.get('Last-Modified'),
+                }
+                self._save_partial(part, validators)
+                with open(part, 'ab' if resumed else 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=self.CHUNK_SIZE):
+                        f.write(chunk)
+
+        if not zipfile.is_zipfile(part):
+            part.unlink()
+            raise IOError("downloaded archive is not a valid zip file")
+
+        archive = self.output_dir / f"herd_{year}.zip"
+        part.replace(archive)
+        self._partial_meta(part).unlink(missing_ok=True)
+        return archive, validators or partial
+
+    @staticmethod
+    def _partial_meta(part):
+        return part.with_name(part.name + ".json")
+
+    def _load_partial(self, part):
+        meta = self._partial_meta(part)
+        if part.exists() and meta.exists():
+            with open(meta) as f:
+                return json.load(f)
+        return {}
+
+    def _save_partial(self, part, validators):
+        with open(self._partial_meta(part), 'w') as f:
+            json.dump(validators, f)
+
+    def _extract(self, year, archive):
+        with zipfile.ZipFile(archive) as z:
+            # Find the main CSV, the same member raw_files reads from a kept archive
+            csv_file = main_csv_member(z)
+            # Save it with a clean name to preserve your ETL logic
+            target_path = self.output_dir / f"herd_{year}_{csv_file}"
+            tmp_path = target_path.with_suffix('.csv.tmp')
+
+            # Stream member -> disk without holding the CSV in memory
+            with z.open(csv_file) as source, open(tmp_path, 'wb') as f:
+                shutil.copyfileobj(source, f, self.CHUNK_SIZE)
+            tmp_path.replace(target_path)
+            self._say(f"   ✅ Extracted: {target_path.name}")
 
 if __name__ == "__main__":
     # Test run
     downloader = HERDDownloader("data/raw")
-    downloader.run()
\ No newline at end of file
+    downloader.run()
@@ -1,156 +1,409 @@
 import pandas as pd
-import json
-import sqlite3
-import glob
+import argparse
 import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
 from pathlib import Path
+import bulk_loader
+import column_index
+import compiled_mapping
+import instrumentation
+import name_index
+import snapshot
+import storage
+import summaries
 from downloader import HERDDownloader
+from pivot import RAW_ID_COLUMNS, build_wide_year
+from raw_files import (
+    COL_LABEL_COLUMNS, DEFAULT_CHUNKSIZE, ROW_LABEL_COLUMNS, default_cache_dir,
+    file_year, first_present, hash_file, list_raw_files, prune_cache, raw_header,
+    read_raw_chunks,
+)
 
 # Paths
 BASE_DIR = Path(__file__).parent
 DATA_DIR = BASE_DIR / "data" / "raw"
-DB_PATH = BASE_DIR / "herd.db"
+DB_PATH = storage.default_database(BASE_DIR / "herd.db")
 MAPPING_PATH = BASE_DIR / "mapping.json"
 
-def run_etl():
+def build_master_names(file_path, chunksize=DEFAULT_CHUNKSIZE, cache_dir=None):
+    """Name Normalization Map: latest known name for every inst_id."""
+    master_names = {}
+    chunks = read_raw_chunks(file_path, ['inst_id', 'inst_name_long'], chunksize, cache_dir)
+    for chunk in instrumentation.timed(chunks, "parse", year=file_year(file_path)):
+        pairs = chunk[['inst_id', 'inst_name_long']].drop_duplicates()
+        master_names.update(zip(pairs['inst_id'].astype(object), pairs['inst_name_long'].astype(object)))
+    return master_names
+
+def match_chunk(chunk, row_col, col_col, mapping_index):
+    """Mapping column id of every raw row in a chunk (-1 if unmapped)."""
+    return mapping_index.match(
+        chunk['questionnaire_no'],
+        chunk[row_col] if row_col else None,
+        chunk[col_col] if col_col else None,
+    )
+
+def process_year(year, file_paths, mapping_index, master_names, chunksize=DEFAULT_CHUNKSIZE, cache_dir=None):
+    """
+    Streams every raw file of one survey year and returns the year as a
+    pivot.WideYear (one row per institution, one column per mapped metric).
+    Each chunk is matched and filtered as soon as it is read, so only mapped
+    rows are ever held for the pivot.
+    """
+    # --- THE MATCHING LOGIC ---
+    matched = []
+    for file_path in file_paths:
+        # Find the row/col label columns dynamically
+        header = [c.lower() for c in raw_header(file_path, cache_dir)]
+        row_col = first_present(header, ROW_LABEL_COLUMNS)
+        col_col = first_present(header, COL_LABEL_COLUMNS)
+        id_cols = [c for c in RAW_ID_COLUMNS if c in header]
+        needed = id_cols + ['questionnaire_no', 'data'] + [c for c in (row_col, col_col) if c]
+
+        chunks = read_raw_chunks(file_path, needed, chunksize, cache_dir)
+        for chunk in instrumentation.timed(chunks, "parse", year=year):
+            with instrumentation.span("match", year=year):
+                codes = match_chunk(chunk, row_col, col_col, mapping_index)
+
+                # 4. Filter: Keep only rows that matched our mapping
+                keep = codes >= 0
+                if not keep.any():
+                    continue
+                part = chunk.loc[keep, id_cols + ['data']]
+                part = part.astype({c: object for c in id_cols if c != 'year'})
+                part['data'] = pd.to_numeric(part['data'], errors='coerce')
+                part['metric'] = codes[keep]
+                matched.append(part)
+
+    if not matched:
+        return None
+    with instrumentation.span("pivot", year=year):
+        df_filtered = pd.concat(matched, ignore_index=True)
+
+        # 5. Normalization & Pivot (the names as reported are kept for name search)
+        raw_names = []
+        if 'inst_name_long' in df_filtered.columns:
+            reported = df_filtered[['inst_id', 'inst_name_long']].dropna().drop_duplicates()
+            raw_names = list(zip(reported['inst_id'].tolist(), reported['inst_name_long'].tolist()))
+            df_filtered['inst_name_long'] = df_filtered['inst_id'].map(master_names).fillna(df_filtered['inst_name_long'])
+
+        # Scatters values into (institution, metric) cells, scaled to dollars
+        wide = build_wide_year(df_filtered, mapping_index.names, scale=1000)
+        if wide is not None:
+            wide.raw_names = raw_names
+        return wide
+
+# --- PARALLEL PROCESSING ---
+# Worker processes receive the shared lookup tables once, via the pool
+# initializer, instead of with every task. Their spans are sent back with
+# each result and recorded by the parent.
+_worker_state = {}
+
+def _init_worker(mapping_index, master_names, chunksize, cache_dir):
+    _worker_state.update(mapping_index=mapping_index, master_names=master_names,
+                         chunksize=chunksize, cache_dir=cache_dir)
+    instrumentation.recorder = instrumentation.Recorder()
+    instrumentation.recorder.keep_spans()
+
+def _process_in_worker(year, file_paths):
+    wide = process_year(
+        year, file_paths, _worker_state['mapping_index'], _worker_state['master_names'],
+        _worker_state['chunksize'], _worker_state['cache_dir']
+    )
+    return wide, instrumentation.recorder.drain()
+
+def iter_processed(changed, mapping_index, master_names, chunksize, workers=1, cache_dir=None):
+    """
+    Yields (year, entries, wide, error) for every changed year, in year order.
+    With workers > 1 the years are processed in a process pool; results are
+    still yielded in order so the single writer produces the same database
+    as the serial path.
+    """
+    if workers <= 1 or len(changed) <= 1:
+        for year, entries in changed:
+            try:
+                wide = process_year(year, [entry[0] for entry in entries], mapping_index, master_names,
+                                    chunksize, cache_dir)
+            except Exception as e:
+                yield year, entries, None, e
+                continue
+            yield year, entries, wide, None
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(changed)),
+        initializer=_init_worker,
+        initargs=(mapping_index, master_names, chunksize, cache_dir),
+    ) as pool:
+        futures = [pool.submit(_process_in_worker, year, [entry[0] for entry in entries])
+                   for year, entries in changed]
+        for (year, entries), future in zip(changed, futures):
+            try:
+                wide, spans = future.result()
+            except Exception as e:
+                yield year, entries, None, e
+                continue
+            instrumentation.recorder.replay(spans)
+            yield year, entries, wide, None
+
+# --- LOAD MANIFEST ---
+
+def read_manifest(conn):
+    """{path: (size, mtime, sha256, mapping_hash, year_mapping_hash)} of the last load."""
+    return {
+        row[0]: row[1:] for row in conn.execute(
+            "SELECT path, size, mtime, sha256, mapping_hash, year_mapping_hash FROM etl_manifest"
+        )
+    }
+
+def _record_manifest(conn, file_path, stat, sha, mapping_hash, year_mapping_hash):
+    conn.execute("DELETE FROM etl_manifest WHERE path = ?", (file_path,))
+    conn.execute(
+        """INSERT INTO etl_manifest
+           (path, year, size, mtime, sha256, mapping_hash, year_mapping_hash, loaded_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+        (file_path, file_year(file_path), stat.st_size, stat.st_mtime, sha,
+         mapping_hash, year_mapping_hash, datetime.now(timezone.utc).isoformat())
+    )
+
+def plan_changes(manifest, csv_files, year_hash_of):
+    """
+    Compares raw files against the manifest and returns (changed, removed, touched).
+    `year_hash_of(year)` is the hash of the mapping entries active in that year.
+    A year is loaded as a whole (write_year replaces all of its rows), so
+    `changed` holds (year, entries) for every year with a new, modified or
+    removed file, where `entries` are (path, stat, sha256, year_mapping_hash)
+    for every file of that year. `removed` lists manifest paths no longer on
+    disk; `touched` the entries of unchanged years whose mtime moved but
+    bytes did not.
+    """
+    by_year, stale_years, touched = {}, set(), []
+    for file_path in csv_files:
+        stat = os.stat(file_path)
+        year = file_year(file_path)
+        year_hash = year_hash_of(year)
+        previous = manifest.get(file_path)
+
+        # Fast path: same size + mtime means same bytes; skip hashing
+        if previous and previous[0] == stat.st_size and previous[1] == stat.st_mtime:
+            sha = previous[2]
+        else:
+            sha = hash_file(file_path)
+
+        entry = (file_path, stat, sha, year_hash)
+        by_year.setdefault(year, []).append(entry)
+        if previous and previous[2] == sha and previous[4] == year_hash:
+            if previous[1] != stat.st_mtime:
+                touched.append(entry)
+            continue
+        stale_years.add(year)
+
+    removed = [path for path in manifest if path not in csv_files]
+    stale_years.update(file_year(path) for path in removed)
+    changed = [(year, by_year[year]) for year in sorted(stale_years) if year in by_year]
+    touched = [entry for entry in touched if file_year(entry[0]) not in stale_years]
+    return changed, removed, touched
+
+def apply_master_names(conn, master_names, wide_table=True):
+    """
+    Renames the rows of every year as a full rebuild would name them after
+    the newest file changed or was removed: the newest file's name where it
+    lists the institution, else a name it reported that year (from
+    institution_name_history), replacing one left by the previous newest file.
+    """
+    renames = [(name, inst_id) for inst_id, name in master_names.items()]
+    for table in ['institution_years'] + (['institutions'] if wide_table else []):
+        reported = f"FROM institution_name_history h WHERE h.inst_id = {table}.inst_id AND h.year = {table}.year"
+        conn.execute(f"""
+            UPDATE {table} SET name = (SELECT MIN(h.name) {reported})
+            WHERE NOT EXISTS (SELECT 1 {reported} AND h.name = {table}.name)
+        """)
+        conn.executemany(f"UPDATE {table} SET name = ? WHERE inst_id = ?", renames)
+
+def _needs_full_rebuild(db, wide_table):
+    """Reason string when the database cannot be updated incrementally, else None."""
+    if not db.exists():
+        return "No database yet"
+    with db.connect(readonly=True) as conn:
+        tables = {name for name, kind in storage.tables(conn).items() if kind == 'table'}
+        if not {'etl_manifest', 'herd_facts'} <= tables:
+            return "No load manifest found"
+        if 'institution_name_history' not in tables:
+            return "No institution name history yet"
+        if bulk_loader.institutions_type(conn) == ('view' if wide_table else 'table'):
+            return "Storage layout changed (wide table vs facts-only)"
+    return None
+
+def run_etl(full_rebuild=False, chunksize=DEFAULT_CHUNKSIZE, workers=1,
+            data_dir=DATA_DIR, db_path=DB_PATH, download=True, wide_table=True,
+            keep_archives=False, cache=True):
     # 1. DOWNLOAD
-    print("🔄 Checking for data...")
-    downloader = HERDDownloader(DATA_DIR)
-    downloader.run(start_year=2010)
+    if download:
+        print("🔄 Checking for data...")
+        downloader = HERDDownloader(data_dir, keep_archives=keep_archives)
+        downloader.run(start_year=2010)
 
-    print(f"🔌 Connecting to database at {DB_PATH}...")
-    conn = sqlite3.connect(DB_PATH)
-    
     # 2. LOAD MAPPING
     if not MAPPING_PATH.exists():
         print("❌ mapping.json missing. Run 'generate_mapping.py' first!")
         return
 
-    with open(MAPPING_PATH, 'r') as f:
-        full_config = json.load(f)
+    print("📚 Building Lookup Table...")
+    with instrumentation.span("mapping"):
+        # Compiled from mapping.json (and cached next to it) only when it changed
+        mapping = compiled_mapping.load_mapping(MAPPING_PATH)
+    mapping_index, metadata_rows = mapping.mapping_index, mapping.metadata_rows
+    mapping_hash = mapping.sha256
+    mapped_cols = {m['column_name'] for m in metadata_rows}
 
-    # Flatten mapping into a "Lookup Dictionary"
-    # Keys = (Question ID, Row Label, Col Label) -> Standard Name
-    lookup_map = {}
-    metadata_rows = []
+    # 3. PLAN: which years need (re)loading?
+    db = storage.open_storage(db_path)
+    csv_files = [str(path) for path in list_raw_files(data_dir)]
+    cache_dir = default_cache_dir(data_dir) if cache else None
+    if cache_dir:
+        prune_cache(cache_dir, csv_files)
 
-    print("📚 Building Lookup Table...")
-    for category, items in full_config.items():
-        for key, info in items.items():
-            # Create a tuple key for fast matching
-            # We treat None/NaN as empty strings for consistent matching
-            qid = str(info['question_id'])
-            r_lbl = str(info['row_match']) if info['row_match'] else ""
-            c_lbl = str(info['col_match']) if info['col_match'] else ""
-            
-            # Key: "09A|Computer Science|DOD"
-            lookup_key = f"{qid}|{r_lbl}|{c_lbl}".lower()
-            lookup_map[lookup_key] = key
-            
-            # Add to metadata
-            metadata_rows.append({
-                "category": category,
-                "column_name": key,
-                "description": info['description'],
-                "start_year": info['start_year'],
-                "end_year": info['end_year']
-            })
-
-    # Save Metadata
-    pd.DataFrame(metadata_rows).to_sql('data_dictionary', conn, if_exists='replace', index=False)
-
-    # 3. PROCESS FILES
-    csv_files = glob.glob(str(DATA_DIR / "*.csv"))
-    csv_files.sort()
-    
-    # Name Normalization Map
-    master_names = {}
-    if csv_files:
-        df_latest = pd.read_csv(csv_files[-1], encoding='latin-1', dtype={'inst_id': str}, low_memory=False)
-        for _, row in df_latest[['inst_id', 'inst_name_long']].drop_duplicates().iterrows():
-            master_names[row['inst_id']] = row['inst_name_long']
+    reason = None if full_rebuild else _needs_full_rebuild(db, wide_table)
+    if reason:
+        print(f"ℹ️  {reason}, running a full rebuild.")
+        full_rebuild = True
 
-    all_years_data = []
-    print(f"📦 Processing {len(csv_files)} files using detailed mapping...")
+    config = summaries.load_config()
+    manifest, summary_hash = {}, None
+    if not full_rebuild:
+        with db.connect(readonly=True) as conn:
+            manifest = read_manifest(conn)
+            summary_hash = summaries.stored_config_hash(conn)
+    with instrumentation.span("plan"):
+        changed, removed, touched = plan_changes(manifest, csv_files, mapping.year_hash)
 
-    for file_path in csv_files:
-        try:
-            df = pd.read_csv(file_path, encoding='latin-1', dtype={'inst_id': str}, low_memory=False)
-            
-            # --- THE MATCHING LOGIC ---
-            # 1. Normalize Raw Data columns to string & lowercase
-            df['qid_str'] = df['questionnaire_no'].astype(str)
-            
-            # Find the row/col label columns dynamically
-            df.columns = [c.lower() for c in df.columns]
-            
-            # Helper to find existing columns
-            def get_col(df, candidates):
-                for c in candidates:
-                    if c in df.columns: return df[c].fillna("").astype(str)
-                return pd.Series([""] * len(df), index=df.index)
-
-            row_series = get_col(df, ['row', 'row_label', 'question_label'])
-            col_series = get_col(df, ['column', 'column_label', 'col'])
-
-            # 2. Create the "Fingerprint" for every row in the CSV
-            # Format: "id|row|col"
-            df['lookup_key'] = (df['qid_str'] + "|" + row_series + "|" + col_series).str.lower()
-            
-            # 3. Map to Standard Name
-            df['standard_name'] = df['lookup_key'].map(lookup_map)
-            
-            # 4. Filter: Keep only rows that matched our mapping
-            df_filtered = df.dropna(subset=['standard_name']).copy()
-
-            if df_filtered.empty:
-                print(f"   ⚠️  No matching data found in {os.path.basename(file_path)}")
+    mapping_changed = any(entry[3] != mapping_hash for entry in manifest.values())
+    peers_changed = summary_hash != summaries.config_hash(config)
+    if not (full_rebuild or changed or removed or mapping_changed or peers_changed):
+        # Nothing to load: refresh fingerprints of touched files in place
+        with db.connect() as conn:
+            for entry in touched:
+                _record_manifest(conn, entry[0], entry[1], entry[2], mapping_hash, entry[3])
+        if not column_index.index_path(db.artifact_path).exists():
+            column_index.build_index(metadata_rows, db.artifact_path)
+        if not snapshot.snapshot_path(db.artifact_path).exists():
+            snapshot.build_snapshot(db)
+        print(f"✓ {db} is up to date. Nothing to load.")
+        return
+
+    # 4. PROCESS FILES in one load transaction (SQLite: a staging copy that
+    # replaces herd.db when done; see storage.py)
+    print(f"🔌 Loading into {db}...")
+    with db.load(fresh=full_rebuild) as conn:
+        bulk_loader.ensure_schema(conn, wide_table)
+
+        # Save Metadata
+        metric_ids = bulk_loader.write_data_dictionary(conn, metadata_rows)
+        if wide_table:
+            bulk_loader.sync_metric_columns(conn, mapped_cols)
+
+        changed_years = {year for year, _ in changed}
+        for file_path in removed:
+            print(f"   🗑️  Removing {os.path.basename(file_path)} (no longer on disk)")
+            conn.execute("DELETE FROM etl_manifest WHERE path = ?", (file_path,))
+            # A year with files left is reloaded from them below
+            if file_year(file_path) not in changed_years:
+                bulk_loader.delete_year(conn, file_year(file_path), wide_table)
+        for file_path, stat, sha, year_hash in touched:
+            _record_manifest(conn, file_path, stat, sha, mapping_hash, year_hash)
+
+        if changed:
+            n_years = len({file_year(path) for path in csv_files})
+            print(f"📦 Processing {len(changed)} of {n_years} years using detailed mapping"
+                  f" ({workers} worker{'s' if workers != 1 else ''})...")
+
+        # The newest file defines canonical names for every year, so every
+        # year is renamed when it changes or the year that was newest is removed
+        latest_year = file_year(csv_files[-1]) if csv_files else None
+        rename = not full_rebuild and latest_year is not None and (
+            latest_year in changed_years or any(file_year(path) > latest_year for path in removed))
+        master_names = build_master_names(csv_files[-1], chunksize, cache_dir) if changed or rename else {}
+
+        total_rows = 0
+        results = iter_processed(changed, mapping_index, master_names, chunksize, workers, cache_dir)
+        for year, entries, wide, error in results:
+            if error is not None:
+                print(f"   ❌ Error {year}: {error}")
                 continue
 
-            # 5. Normalization & Pivot
-            # (Restore original camelCase ID/Name columns if lowercase conversion messed them up)
-            # Actually, standardizing is safer:
-            pivot_index = ['inst_id', 'inst_name_long', 'inst_city', 'inst_state_code', 'year']
-            # Map index cols to available lowercase cols
-            actual_index = [c for c in pivot_index if c in df_filtered.columns]
-            
-            if 'inst_id' in df_filtered.columns:
-                df_filtered['inst_name_long'] = df_filtered['inst_id'].map(master_names).fillna(df_filtered['inst_name_long'])
-
-            wide_df = df_filtered.pivot_table(
-                index=actual_index,
-                columns='standard_name',
-                values='data',
-                aggfunc='first'
-            ).reset_index()
-
-            all_years_data.append(wide_df)
-            
-        except Exception as e:
-            print(f"   ❌ Error {os.path.basename(file_path)}: {e}")
-
-    # 4. SAVE
-    if all_years_data:
-        final_df = pd.concat(all_years_data, ignore_index=True)
-        
-        # Rename for standard DB schema
-        rename_map = {'inst_name_long': 'name', 'inst_city': 'city', 'inst_state_code': 'state'}
-        final_df = final_df.rename(columns=rename_map)
-        
-        # Cleanup Numbers (Multiply by 1000)
-        # Identify numeric columns (the ones from our mapping)
-        mapped_cols = [m['column_name'] for m in metadata_rows]
-        for col in mapped_cols:
-            if col in final_df.columns:
-                final_df[col] = final_df[col].fillna(0) * 1000
-
-        final_df.to_sql('institutions', conn, if_exists='replace', index=False)
-        print(f"\n✅ Success! Loaded {len(final_df)} rows with {len(final_df.columns)} columns.")
-        
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_inst_id ON institutions(inst_id)")
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_name ON institutions(name)")
-    
-    conn.close()
+            if wide is None:
+                print(f"   ⚠️  No matching data found for {year}")
+
+            with instrumentation.span("write", year=year):
+                total_rows += bulk_loader.write_year(conn, year, wide, metric_ids, wide_table)
+            for file_path, stat, sha, year_hash in entries:
+                _record_manifest(conn, file_path, stat, sha, mapping_hash, year_hash)
+
+        # Every manifest row now matches the data dictionary just written,
+        # including the rows of years no mapping edit touched
+        conn.execute("UPDATE etl_manifest SET mapping_hash = ?", (mapping_hash,))
+
+        if rename:
+            apply_master_names(conn, master_names, wide_table)
+
+        with instrumentation.span("indexes"):
+            bulk_loader.create_indexes(conn, wide_table)
+            bulk_loader.create_views(conn, wide_table)
+
+        # Peer and trend tables are derived from the whole database
+        print("📈 Building peer and trend summary tables and the name search index...")
+        with instrumentation.span("summaries"):
+            summaries.build_summary_tables(conn, config)
+        with instrumentation.span("name_index"):
+            name_index.build_name_index(conn, config)
+        n_cols = len(bulk_loader.table_columns(conn, 'institutions'))
+
+    # Column retrieval index for prompt building, saved next to herd.db
+    with instrumentation.span("column_index"):
+        column_index.build_index(metadata_rows, db.artifact_path)
+    # Memory-mapped metric cube for the server's point lookups
+    with instrumentation.span("snapshot"):
+        snapshot.build_snapshot(db)
+
+    print(f"\n✅ Success! Loaded {total_rows} rows into {n_cols} columns ({len(changed)} years refreshed).")
+
+def main():
+    parser = argparse.ArgumentParser(description="Build herd.db from the raw NSF HERD files.")
+    parser.add_argument('--full', action='store_true',
+                        help="Ignore the load manifest and rebuild every year from scratch.")
+    parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE,
+                        help="Rows read per CSV chunk (bounds peak memory).")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Process survey years in parallel across N processes.")
+    parser.add_argument('--no-download', action='store_true',
+                        help="Use the files already in data/raw without checking the NSF site.")
+    parser.add_argument('--database', default=DB_PATH, metavar='PATH_OR_URL',
+                        help="SQLite file or postgresql:// URL to load into "
+                             f"(default ${storage.DATABASE_ENV} or herd.db).")
+    parser.add_argument('--facts-only', action='store_true',
+                        help="Skip the wide institutions table; serve it as a view over herd_facts.")
+    parser.add_argument('--keep-archives', action='store_true',
+                        help="Keep downloaded years as zip archives and read CSVs straight from them.")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Parse the raw CSVs directly instead of through the parsed-year cache.")
+    parser.add_argument('--profile', nargs='?', const=str(BASE_DIR / "etl_profile.jsonl"), metavar='PATH',
+                        help="Print a per-stage / per-year timing breakdown and write the spans to PATH "
+                             "(JSONL, or Prometheus text for .prom; default etl_profile.jsonl).")
+    args = parser.parse_args()
+
+    if args.profile:
+        instrumentation.recorder.keep_spans()
+    try:
+        with instrumentation.span("etl"):
+            run_etl(full_rebuild=args.full, chunksize=args.chunksize, workers=args.workers,
+                    db_path=args.database, download=not args.no_download, wide_table=not args.facts_only,
+                    keep_archives=args.keep_archives, cache=not args.no_cache)
+    finally:
+        if args.profile:
+            print("\n⏱️  Seconds per stage and year (parallel workers add up):")
+            print(instrumentation.recorder.table('year'))
+            instrumentation.recorder.write(args.profile)
+            print(f"   Spans written to {args.profile}")
 
 if __name__ == "__main__":
-    run_etl()
\ No newline at end of file
+    main()
@@ -0,0 +1,55 @@
+"""
+Plain-Python rendering of query results (column names + sqlite3 row
+tuples), so server.py and local_agent.py answer without importing pandas.
+
+`markdown_table` follows the layout of pandas' `to_markdown(index=False)`:
+pipe tables, numeric columns right-aligned. `text_table` follows
+`to_string(index=False)`. Floats are printed in full rather than in exponent
+notation, so dollar amounts stay readable; NULL is blank, and text that
+looks numeric (zero-padded inst_id) stays left-aligned text.
+"""
+
+def format_value(value):
+    if value is None or (isinstance(value, float) and value != value):
+        return ""
+    if isinstance(value, float):
+        if value.is_integer() and abs(value) < 1e16:
+            return str(int(value))
+        if 0 < abs(value) < 1e-4:
+            return f"{value:.6g}"
+        return str(round(value, 4))
+    return str(value)
+
+def _numeric_columns(rows, n_columns):
+    """Columns whose non-NULL values are all numbers (and that have at least one)."""
+    numeric = []
+    for i in range(n_columns):
+        values = [row[i] for row in rows if row[i] is not None]
+        numeric.append(bool(values) and all(isinstance(v, (int, float)) for v in values))
+    return numeric
+
+def markdown_table(columns, rows):
+    columns = [str(c) for c in columns]
+    cells = [[format_value(v).replace("|", "\\|").replace("\n", " ") for v in row] for row in rows]
+    numeric = _numeric_columns(rows, len(columns))
+    widths = [max([len(header) + 2] + [len(row[i]) for row in cells]) for i, header in enumerate(columns)]
+
+    def line(values):
+        return "| " + " | ".join(v.rjust(w) if right else v.ljust(w)
+                                 for v, w, right in zip(values, widths, numeric)) + " |"
+
+    if rows:
+        rule = ["-" * (w + 1) + ":" if right else ":" + "-" * (w + 1) for w, right in zip(widths, numeric)]
+    else:
+        rule = ["-" * (w + 2) for w in widths]
+    return "\n".join([line(columns), "|" + "|".join(rule) + "|"] + [line(row) for row in cells])
+
+def text_table(columns, rows, max_rows=None):
+    """Right-justified plain-text table; with `max_rows`, the middle rows are elided."""
+    columns = [str(c) for c in columns]
+    cells = [[format_value(v) for v in row] for row in rows]
+    if max_rows and len(cells) > max_rows:
+        half = max(max_rows // 2, 1)
+        cells = cells[:half] + [["..."] * len(columns)] + cells[-half:]
+    widths = [max([len(header)] + [len(row[i]) for row in cells]) for i, header in enumerate(columns)]
+    return "\n".join(" ".join(v.rjust(w) for v, w in zip(values, widths)) for values in [columns] + cells)
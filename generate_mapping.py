@@ -1,23 +1,93 @@
 import pandas as pd
+import argparse
 import json
-import re
 from pathlib import Path
 
+import numpy as np
+
+import compiled_mapping
+
 # Paths
 BASE_DIR = Path(__file__).parent
 CSV_PATH = BASE_DIR / "schema_changes_detailed.csv"
 MAPPING_PATH = BASE_DIR / "mapping.json"
 
-def clean_slug(text):
-    """Turns 'Computer & Info Sciences' into 'computer_info_sciences'"""
-    if pd.isna(text): return "total"
-    text = str(text).lower()
-    text = re.sub(r'\(.*?\)', '', text) # Remove (parentheses)
-    text = re.sub(r'[^a-z0-9]', '_', text) # Special chars to _
-    text = re.sub(r'_+', '_', text) # Dedupe _
-    return text.strip('_')
+# Categories in mapping.json order
+CATEGORIES = ["funding_sources", "federal_detailed", "federal_agencies", "nonfed_detailed", "other_questions"]
+
+def slugify(values):
+    """Turns 'Computer & Info Sciences' into 'computer_info_sciences' for a Series of labels; missing ones become 'total'."""
+    slugs = (values.astype(str).str.lower()
+             .str.replace(r'\(.*?\)', '', regex=True)   # Remove (parentheses)
+             .str.replace(r'[^a-z0-9]', '_', regex=True)  # Special chars to _
+             .str.replace(r'_+', '_', regex=True)         # Dedupe _
+             .str.strip('_'))
+    return slugs.where(values.notna(), "total")
+
+def _text(values, missing='nan'):
+    """Labels as str, with missing values spelled out (f-strings print NaN as 'nan')."""
+    return values.astype(object).where(values.notna(), missing).astype(str)
+
+def build_entries(df):
+    """One mapping entry per report row, with its category and key."""
+    qid = _text(df['Question ID'])
+    # Skip rows with no ID
+    df, qid = df[qid != 'nan'], qid[qid != 'nan']
+    row_lbl, col_lbl = df['Row Label'], df['Column Label']
+    row_slug, col_slug = slugify(row_lbl), slugify(col_lbl)
+
+    # --- 1. Funding Sources (Q1): Row Label (e.g. "Federal government")
+    # --- 2. Federal Fields & Agencies (Q9): Row (Field) + Col (Agency), e.g. "fed_aerospace_eng_dod"
+    # --- 3. Federal Agency Totals (Q10): Row Label is the Agency
+    # --- 4. Non-Federal Fields & Sources (Q11): Row (Field) + Col (Source), e.g. "nonfed_biology_business"
+    # --- 5. Catch-All
+    conditions = [qid.str.startswith('01'), qid.str.startswith(('09', '9')),
+                  qid.str.startswith('10'), qid.str.startswith('11')]
+    keys = np.select(conditions, [
+        "src_" + row_slug,
+        "fed_" + row_slug + "_" + col_slug,
+        "agency_" + row_slug,
+        "nonfed_" + row_slug + "_" + col_slug,
+    ], default="q" + slugify(qid) + "_" + row_slug)
+
+    # We store the "match_criteria" to allow exact lookup later
+    return pd.DataFrame({
+        "category": np.select(conditions, CATEGORIES[:4], default=CATEGORIES[4]),
+        "key": keys,
+        "question_id": qid,
+        "row_match": row_lbl.astype(object).where(row_lbl.notna(), None),
+        "col_match": col_lbl.astype(object).where(col_lbl.notna(), None),
+        "description": _text(df['Question Text']) + ": " + _text(row_lbl) + " - " + _text(col_lbl),
+        "start_year": df['First Year'].astype(int),
+        "end_year": df['Last Year'].astype(int),
+    })
+
+def key_collisions(entries):
+    """Keys produced by report rows with different match criteria (only the last row survives)."""
+    criteria = (entries['question_id'] + "|" + _text(entries['row_match'], "") + "|"
+                + _text(entries['col_match'], ""))
+    distinct = criteria.groupby([entries['category'], entries['key']], sort=False).nunique()
+    collisions = []
+    for (category, key), n in distinct[distinct > 1].items():
+        rows = criteria[(entries['category'] == category) & (entries['key'] == key)].unique()
+        collisions.append(f"{category}.{key} <- {n} different fields: {'; '.join(rows)}")
+    return collisions
 
-def generate_mapping():
+def build_mapping(entries):
+    """
+    {category: {key: entry}}. On duplicate keys (schema drifted slightly)
+    the last row wins but keeps the position of the first, as repeated
+    dict assignment did.
+    """
+    order = entries.groupby(['category', 'key'], sort=False).ngroup()
+    latest = entries.assign(order=order).drop_duplicates(['category', 'key'], keep='last').sort_values('order')
+
+    mapping = {category: {} for category in CATEGORIES}
+    for entry in latest.drop(columns='order').to_dict('records'):
+        mapping[entry.pop('category')][entry['key']] = entry
+    return mapping
+
+def generate_mapping(strict=False):
     print(f"📖 Reading {CSV_PATH}...")
     try:
         df = pd.read_csv(CSV_PATH)
@@ -25,86 +95,50 @@ def generate_mapping():
         print("❌ Error: schema_changes_detailed.csv not found. Please upload it.")
         return
 
-    mapping = {
-        "funding_sources": {},
-        "federal_detailed": {},    # Q9
-        "federal_agencies": {},    # Q10
-        "nonfed_detailed": {},     # Q11
-        "other_questions": {}
-    }
-
-    count = 0
-    
-    for _, row in df.iterrows():
-        qid = str(row['Question ID'])
-        row_lbl = row['Row Label']
-        col_lbl = row['Column Label']
-        desc = row['Question Text']
-        start_year = row['First Year']
-        end_year = row['Last Year']
-
-        # Skip rows with no ID
-        if qid == 'nan': continue
-
-        # --- 1. Funding Sources (Q1) ---
-        if qid.startswith('01'):
-            # Key uses Row Label (e.g. "Federal government")
-            slug = clean_slug(row_lbl)
-            key = f"src_{slug}"
-            category = "funding_sources"
-
-        # --- 2. Federal Fields & Agencies (Q9) ---
-        elif qid.startswith(('09', '9')):
-            # Key uses Row (Field) + Col (Agency)
-            # e.g. "fed_aerospace_eng_dod"
-            field_slug = clean_slug(row_lbl)
-            agency_slug = clean_slug(col_lbl)
-            key = f"fed_{field_slug}_{agency_slug}"
-            category = "federal_detailed"
-
-        # --- 3. Federal Agency Totals (Q10) ---
-        elif qid.startswith('10'):
-            # Usually Row Label is the Agency
-            slug = clean_slug(row_lbl)
-            key = f"agency_{slug}"
-            category = "federal_agencies"
-
-        # --- 4. Non-Federal Fields & Sources (Q11) ---
-        elif qid.startswith('11'):
-            # Key uses Row (Field) + Col (Source)
-            # e.g. "nonfed_biology_business"
-            field_slug = clean_slug(row_lbl)
-            source_slug = clean_slug(col_lbl)
-            key = f"nonfed_{field_slug}_{source_slug}"
-            category = "nonfed_detailed"
-
-        # --- 5. Catch-All ---
-        else:
-            category = "other_questions"
-            key = f"q{clean_slug(qid)}_{clean_slug(row_lbl)}"
-
-        # Construct the mapping entry
-        # We store the "match_criteria" to allow exact lookup later
-        entry = {
-            "key": key,
-            "question_id": qid,
-            "row_match": row_lbl if pd.notna(row_lbl) else None,
-            "col_match": col_lbl if pd.notna(col_lbl) else None,
-            "description": f"{desc}: {row_lbl} - {col_lbl}",
-            "start_year": int(start_year),
-            "end_year": int(end_year)
-        }
-        
-        # Add to the dictionary (Handle duplicates if schema drifted slightly)
-        # If key exists, we might overwrite, but usually latest year wins in this logic
-        mapping[category][key] = entry
-        count += 1
+    entries = build_entries(df)
+
+    # Rows that only repeat the same field are expected; different fields are reported
+    collisions = key_collisions(entries)
+    if collisions:
+        print(f"⚠️  {len(collisions)} keys are shared by different fields; the last one wins:")
+        for collision in collisions[:10]:
+            print(f"   - {collision}")
+        if len(collisions) > 10:
+            print(f"   ... and {len(collisions) - 10} more")
+        if strict:
+            raise SystemExit("❌ Key collisions found (--strict); mapping.json was not written.")
+
+    mapping = build_mapping(entries)
 
     # Save
     with open(MAPPING_PATH, 'w') as f:
         json.dump(mapping, f, indent=2)
+    compiled_mapping.compile_mapping(MAPPING_PATH)
+
+    print(f"✅ Generated mapping.json with {len(entries)} fields based on your CSV report "
+          f"(compiled to {compiled_mapping.compiled_path(MAPPING_PATH).name}).")
+
+def check_mapping():
+    """Compiles the existing mapping.json and lists its collisions."""
+    compiled = compiled_mapping.compile_mapping(MAPPING_PATH)
+    if not compiled.collisions:
+        print(f"✅ {MAPPING_PATH.name}: {len(compiled.metadata['column_name'])} entries, no collisions.")
+        return
+    print(f"⚠️  {MAPPING_PATH.name}: {len(compiled.collisions)} collisions")
+    for collision in compiled.collisions:
+        print(f"   - {collision}")
 
-    print(f"✅ Generated mapping.json with {count} fields based on your CSV report.")
+def main():
+    parser = argparse.ArgumentParser(description="Build mapping.json from schema_changes_detailed.csv.")
+    parser.add_argument('--strict', action='store_true',
+                        help="Fail instead of letting colliding keys overwrite each other.")
+    parser.add_argument('--check', action='store_true',
+                        help="Only compile the existing mapping.json and list colliding entries.")
+    args = parser.parse_args()
+    if args.check:
+        check_mapping()
+    else:
+        generate_mapping(strict=args.strict)
 
 if __name__ == "__main__":
-    generate_mapping()
\ No newline at end of file
+    main()
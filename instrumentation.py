@@ -0,0 +1,187 @@
+"""
+Lightweight timing spans and counters shared by etl.py, local_agent.py and
+server.py.
+
+    with instrumentation.span("parse", year=2024):
+        ...
+    instrumentation.count("tool_calls", tool="query_herd_data")
+
+Every span updates running totals (count, sum, max seconds) per name and
+labels, which `prometheus()` renders in the Prometheus text format. Labels
+should be low-cardinality (a year, a tool name). Individual spans are kept
+only when asked for, either in memory (`keep_spans()`, used by
+`etl.py --profile`) or appended as JSON lines to the file named by the
+HERD_TRACE environment variable.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+TRACE_ENV = "HERD_TRACE"
+
+def _label_text(labels):
+    return ",".join(f'{k}="{v}"' for k, v in labels)
+
+class Recorder:
+    """Span totals, counters and (optionally) individual spans; thread-safe."""
+
+    def __init__(self, trace_path=None):
+        self._lock = threading.Lock()
+        self.totals = {}     # (name, labels) -> [count, seconds, max seconds]
+        self.counters = {}   # (name, labels) -> value
+        self.spans = None    # list of span dicts while keeping spans
+        self._trace = open(trace_path, 'a') if trace_path else None
+
+    def keep_spans(self):
+        if self.spans is None:
+            self.spans = []
+
+    def drain(self):
+        """Kept spans so far, removed from the recorder."""
+        with self._lock:
+            spans = self.spans or []
+            if self.spans is not None:
+                self.spans = []
+        return spans
+
+    def record(self, name, seconds, start=None, pid=None, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            total = self.totals.setdefault(key, [0, 0.0, 0.0])
+            total[0] += 1
+            total[1] += seconds
+            total[2] = max(total[2], seconds)
+            if self.spans is None and self._trace is None:
+                return
+            event = {'name': name, 'start': start if start is not None else time.time() - seconds,
+                     'seconds': round(seconds, 6), 'pid': pid or os.getpid(), **labels}
+            if self.spans is not None:
+                self.spans.append(event)
+            if self._trace is not None:
+                self._trace.write(json.dumps(event) + "\n")
+                self._trace.flush()
+
+    def replay(self, spans):
+        """Records spans drained from another process's recorder."""
+        for event in spans:
+            event = dict(event)
+            name, seconds, start = event.pop('name'), event.pop('seconds'), event.pop('start')
+            self.record(name, seconds, start, **event)
+
+    @contextmanager
+    def span(self, name, **labels):
+        start, clock = time.time(), time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - clock, start, **labels)
+
+    def timed(self, iterable, name, **labels):
+        """Yields from `iterable`, recording the time spent producing items as one span."""
+        start, seconds = time.time(), 0.0
+        iterator = iter(iterable)
+        try:
+            while True:
+                clock = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    seconds += time.perf_counter() - clock
+                    return
+                seconds += time.perf_counter() - clock
+                yield item
+        finally:
+            self.record(name, seconds, start, **labels)
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def prometheus(self, prefix="herd"):
+        """Span totals and counters in the Prometheus text exposition format."""
+        with self._lock:
+            totals = sorted(self.totals.items())
+            counters = sorted(self.counters.items())
+        lines = []
+        if totals:
+            lines += [f"# HELP {prefix}_span_seconds Time spent in each instrumented stage.",
+                      f"# TYPE {prefix}_span_seconds summary"]
+            for (name, labels), (n, seconds, _) in totals:
+                label_text = _label_text((('span', name),) + labels)
+                lines.append(f"{prefix}_span_seconds_count{{{label_text}}} {n}")
+                lines.append(f"{prefix}_span_seconds_sum{{{label_text}}} {seconds:.6f}")
+            lines.append(f"# TYPE {prefix}_span_seconds_max gauge")
+            for (name, labels), (_, _, longest) in totals:
+                lines.append(f"{prefix}_span_seconds_max{{{_label_text((('span', name),) + labels)}}} {longest:.6f}")
+        for name in dict.fromkeys(name for (name, _), _ in counters):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            for (counter, labels), value in counters:
+                if counter == name:
+                    label_text = f"{{{_label_text(labels)}}}" if labels else ""
+                    lines.append(f"{prefix}_{name}_total{label_text} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def table(self, column_label):
+        """
+        Plain-text breakdown of seconds per span name (rows) and value of
+        `column_label` (columns); spans without that label go in 'other'.
+        """
+        cells, columns = {}, set()
+        with self._lock:
+            totals = list(self.totals.items())
+        for (name, labels), (_, seconds, _) in totals:
+            column = str(dict(labels).get(column_label, 'other'))
+            columns.add(column)
+            row = cells.setdefault(name, {})
+            row[column] = row.get(column, 0.0) + seconds
+        columns = sorted(columns - {'other'}) + (['other'] if 'other' in columns else [])
+
+        width = max([len(name) for name in cells] + [5])
+        lines = [f"{'stage':<{width}}" + "".join(f"{c:>9}" for c in columns) + f"{'total':>9}"]
+        for name, row in sorted(cells.items(), key=lambda item: -sum(item[1].values())):
+            lines.append(f"{name:<{width}}" + "".join(f"{row[c]:9.2f}" if c in row else f"{'':>9}" for c in columns)
+                         + f"{sum(row.values()):9.2f}")
+        return "\n".join(lines)
+
+    def report(self):
+        """Calls, total seconds and mean / max milliseconds per span name."""
+        merged = {}
+        with self._lock:
+            for (name, _), (n, seconds, longest) in self.totals.items():
+                row = merged.setdefault(name, [0, 0.0, 0.0])
+                row[0] += n
+                row[1] += seconds
+                row[2] = max(row[2], longest)
+        width = max([len(name) for name in merged] + [5])
+        lines = [f"{'stage':<{width}}{'calls':>8}{'total s':>10}{'mean ms':>10}{'max ms':>10}"]
+        for name, (n, seconds, longest) in sorted(merged.items(), key=lambda item: -item[1][1]):
+            lines.append(f"{name:<{width}}{n:>8}{seconds:10.2f}{seconds / n * 1000:10.1f}{longest * 1000:10.1f}")
+        return "\n".join(lines)
+
+    def write(self, path):
+        """Writes Prometheus text to a .prom / .txt file, otherwise kept spans as JSONL."""
+        path = str(path)
+        with open(path, 'w') as f:
+            if path.endswith(('.prom', '.txt')):
+                f.write(self.prometheus())
+            else:
+                for event in self.spans or []:
+                    f.write(json.dumps(event) + "\n")
+
+# Process-wide recorder used by the module-level helpers
+recorder = Recorder(os.environ.get(TRACE_ENV))
+
+def span(name, **labels):
+    return recorder.span(name, **labels)
+
+def timed(iterable, name, **labels):
+    return recorder.timed(iterable, name, **labels)
+
+def record(name, seconds, **labels):
+    recorder.record(name, seconds, **labels)
+
+def count(name, value=1, **labels):
+    recorder.count(name, value, **labels)
@@ -1,34 +1,81 @@
-import sqlite3
-import pandas as pd
-import yaml
-from openai import OpenAI
+import argparse
+import asyncio
+import json
+import time
 import re
+from functools import cached_property, lru_cache
+import instrumentation
+from formatting import markdown_table, text_table
+from prompt_cache import DEFAULT_TTL, LatencyStats, SQLMemo, memo_path, prompt_hash
+from result_cache import ResultCache
+from sql_validator import InvalidSQL, SQLValidator
+import storage
 
 # --- CONFIGURATION ---
-# client = OpenAI(
-#     base_url='http://localhost:11434/v1',
-#     api_key='ollama'
-# )
+# LLM_BASE_URL = 'http://localhost:11434/v1'
+# LLM_API_KEY = 'ollama'
 # MODEL_NAME = "qwen2.5-coder" 
 
-client = OpenAI(
-    base_url='http://10.146.11.55:8001/v1', # Server IP
-    api_key='EMPTY'
-)
+LLM_BASE_URL = 'http://10.146.11.55:8001/v1' # Server IP
+LLM_API_KEY = 'EMPTY'
 
 # MUST match the --model flag used on the server exactly
 MODEL_NAME = "Qwen/Qwen2.5-Coder-32B-Instruct-AWQ"
 
-DB_PATH = "herd.db"
+DB_PATH = storage.default_database("herd.db")
 CONFIG_PATH = "config.yml"
 
+def truncation_notes(page):
+    """Notes on what fetch_page cut off, as server.render_page words them."""
+    notes = []
+    if page.hidden_columns:
+        notes.append(f"{len(page.hidden_columns)} more columns omitted; select fewer columns to see them.")
+    if page.more_rows:
+        notes.append(f"Showing the first {len(page.rows)} rows; more rows available (add filters or a LIMIT).")
+    return notes
+
+@lru_cache(maxsize=1)
+def llm_client():
+    """The OpenAI-compatible client, created (and openai imported) on first use."""
+    from openai import OpenAI
+    return OpenAI(base_url=LLM_BASE_URL, api_key=LLM_API_KEY)
+
 class LocalAgent:
-    def __init__(self):
-        self.config = self._load_config()
-        self.all_columns = self._get_all_columns()
+    # Construction is cheap: config, the column index, the prompt prefix and
+    # the SQL memo are loaded on first use and then kept.
+    def __init__(self, db_path=DB_PATH, pool_size=1, memo_ttl=DEFAULT_TTL):
+        self.storage = storage.open_storage(db_path)
+        self.memo_ttl = memo_ttl
+        self.engine = self.storage.engine(pool_size=pool_size)
+        self._columns = (None, [])  # (load generation, institutions columns)
+        # Rendered (table, summary input) per (load generation, normalized SQL)
+        self.result_cache = ResultCache()
+        self.validator = SQLValidator(self.engine)
+        self.llm_stats = LatencyStats()
+
+    @cached_property
+    def config(self):
+        return self._load_config()
+
+    @cached_property
+    def column_index(self):
+        return self._load_column_index()
+
+    @cached_property
+    def prompt_prefix(self):
+        # The question-independent part of the SQL prompt is built once and
+        # sent byte-identical every time, so vLLM can reuse its prefix cache
+        return self._build_prompt_prefix()
+
+    @cached_property
+    def sql_memo(self):
+        # Memoized SQL is only reused for the same model, prompt and schema
+        namespace = prompt_hash(MODEL_NAME, self.prompt_prefix, ",".join(self.all_columns))
+        return SQLMemo(memo_path(self.storage.artifact_path), self.memo_ttl, namespace=namespace)
         
     def _load_config(self):
         """Loads the Institution Configuration."""
+        import yaml
         try:
             with open(CONFIG_PATH, 'r') as f:
                 return yaml.safe_load(f)
@@ -36,18 +83,44 @@ class LocalAgent:
             print(f"⚠️ Config Error: {e}")
             return {}
 
-    def _get_all_columns(self):
+    @property
+    def all_columns(self):
+        """Columns of `institutions`, read through the pool once per database load."""
+        try:
+            generation = self.engine.generation()
+            if self._columns[0] != generation:
+                self._columns = (generation, self.engine.table_columns('institutions'))
+        except Exception:
+            pass
+        return self._columns[1]
+
+    def _load_column_index(self):
+        """
+        Retrieval index over data_dictionary built by etl.py; without one it
+        is built in memory from the compiled mapping (None if neither exists).
+        """
+        from column_index import ColumnIndex, index_path
+        from compiled_mapping import load_mapping
+        try:
+            return ColumnIndex.load(index_path(self.storage.artifact_path))
+        except OSError:
+            pass
         try:
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute("PRAGMA table_info(institutions)")
-            cols = [row[1] for row in cursor.fetchall()]
-            conn.close()
-            return cols
-        except: return []
-
-    def _find_relevant_columns(self, question):
-        """Smart Column Search (Same as before)"""
+            return ColumnIndex.build(load_mapping().metadata_rows)
+        except OSError:
+            return None
+
+    def _find_relevant_columns(self, question, k=30):
+        """Identity columns plus the top-k metric columns for the question, best first."""
+        if self.column_index is None:
+            return self._keyword_columns(question)
+        available = set(self.all_columns)
+        ranked = [storage.column_name(self.engine.dialect, c) for c, _ in self.column_index.search(question, k * 2)]
+        ranked = [c for c in ranked if not available or c in available]
+        return ["name", "inst_id", "year"] + (ranked[:k] or ["src_total"])
+
+    def _keyword_columns(self, question):
+        """Keyword scan, used when no column index has been built yet."""
         question = question.lower()
         relevant = ["name", "inst_id", "year"] # Always include ID
         
@@ -72,8 +145,6 @@ class LocalAgent:
         DeepSeek Specific Cleaner:
         It aggressively extracts SQL from markdown blocks or messy text.
         """
-        print(f"   (Raw Model Output: {text[:60]}...)") # Debug print
-        
         # Strategy 1: Look for Markdown Code Blocks (```sql ... ```)
         # DeepSeek almost always uses these.
         match = re.search(r'```sql\s*(.*?)\s*```', text, re.IGNORECASE | re.DOTALL)
@@ -96,7 +167,8 @@ class LocalAgent:
 
         return text.strip()
 
-    def generate_sql(self, question):
+    def _build_prompt_prefix(self):
+        """Everything in the SQL prompt that does not depend on the question."""
         # 1. Build Peer Lists from Config
         inst = self.config['institution']
         my_id = inst['inst_id']
@@ -108,11 +180,7 @@ class LocalAgent:
         nat_peers = self.config['peers']['national']
         nat_ids = ", ".join([f"'{p['id']}'" for p in nat_peers])
         
-        # 2. Get Relevant Columns
-        relevant_cols = self._find_relevant_columns(question)
-        col_list_str = ", ".join(relevant_cols)
-        
-        prompt = f"""
+        return f"""
         You are a SQL Expert for the {inst['name']}.
         
         ### CONTEXT & IDs (Use these for accuracy)
@@ -120,13 +188,6 @@ class LocalAgent:
         - Texas Peers List: ({tx_ids})
         - National Peers List: ({nat_ids})
         
-        ### DATABASE SCHEMA
-        Table: institutions
-        Relevant Columns: {col_list_str}
-        
-        ### REQUEST
-        "{question}"
-        
         ### RULES
         1. **CRITICAL:** Use `inst_id` for specific schools. 
            - If user asks for "{my_name}" or "UNT", use: WHERE inst_id = '{my_id}'
@@ -136,22 +197,122 @@ class LocalAgent:
         4. Return ONLY valid SQL ending in ;
         5. Output ONLY the SQL code. No explanation.
         """
+
+    def sql_messages(self, question):
+        """Fixed prefix first, then the question-specific schema and request."""
+        with instrumentation.span("prompt_build"):
+            # 2. Get Relevant Columns
+            relevant_cols = self._find_relevant_columns(question)
+            col_list_str = ", ".join(relevant_cols)
         
-        response = client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0
-        )
-        return self._clean_sql(response.choices[0].message.content)
-
-    def summarize(self, question, df):
-        if df.empty: return "No data found."
-        data_text = df.to_string(index=False, max_rows=10)
-        prompt = f"Summarize this data for: '{question}'.\nData:\n{data_text}\nKeep it to 2 sentences."
-        response = client.chat.completions.create(
-            model=MODEL_NAME, messages=[{"role": "user", "content": prompt}], temperature=0.3
+        request = f"""
+        ### DATABASE SCHEMA
+        Table: institutions
+        Relevant Columns: {col_list_str}
+        
+        ### REQUEST
+        "{question}"
+        """
+        return [{"role": "system", "content": self.prompt_prefix}, {"role": "user", "content": request}]
+
+    def _record_llm(self, ttft, total):
+        self.llm_stats.record(ttft, total)
+        instrumentation.record("llm_call", total)
+        instrumentation.record("llm_ttft", ttft if ttft is not None else total)
+
+    def _complete(self, messages, temperature):
+        """Streams one chat completion; returns (text, time to first token, total seconds)."""
+        start = time.perf_counter()
+        ttft, parts = None, []
+        stream = llm_client().chat.completions.create(
+            model=MODEL_NAME, messages=messages, temperature=temperature, stream=True
         )
-        return response.choices[0].message.content
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                parts.append(chunk.choices[0].delta.content)
+        total = time.perf_counter() - start
+        self._record_llm(ttft, total)
+        return "".join(parts), ttft, total
+
+    def generate_sql(self, question):
+        """Returns (sql, memo_hit); a memoized question skips the LLM entirely."""
+        sql = self.sql_memo.get(question)
+        if sql is not None:
+            print("   ♻️  SQL reused from memo")
+            return sql, True
+
+        text, ttft, total = self._complete(self.sql_messages(question), 0)
+        print(f"   (Raw Model Output: {text[:60]}...)") # Debug print
+        print(f"   ⏱️  TTFT {(ttft or total) * 1000:.0f} ms, total {total * 1000:.0f} ms")
+        return self._clean_sql(text), False
+
+    def repair_messages(self, question, sql, error):
+        """The SQL conversation plus the rejected statement and why it was rejected."""
+        return self.sql_messages(question) + [
+            {"role": "assistant", "content": sql},
+            {"role": "user", "content": f"That SQL failed validation: {error}\nReturn ONLY the corrected SQL."},
+        ]
+
+    def check_sql(self, question, sql, memo_hit=False):
+        """
+        Validates `sql` before it runs (see sql_validator.py). A fixable
+        error gets one repair round-trip to the model; if the repaired SQL is
+        still invalid, InvalidSQL is raised and nothing is executed.
+        """
+        try:
+            return self.validator.validate(sql)
+        except InvalidSQL as e:
+            if memo_hit or not e.fixable:
+                raise
+            print(f"   🔧 Repairing: {e}")
+            text, _, _ = self._complete(self.repair_messages(question, sql, e), 0)
+            sql = self.validator.validate(self._clean_sql(text))
+            self.validator.count('repaired')
+            return sql
+
+    def run_query(self, sql):
+        """
+        Returns (markdown table, plain-text preview) for a query, or None if
+        it found no rows. Results are capped like the server's; both texts
+        end with notes on any rows or columns that were cut off. Repeated
+        queries are served from the result cache.
+        """
+        key = self.result_cache.key(self.engine.generation(), sql)
+        cached = self.result_cache.get(key)
+        if cached is not None:
+            return cached or None
+
+        with instrumentation.span("sql_exec"):
+            page = self.engine.fetch_page(sql)
+        with instrumentation.span("render"):
+            notes = truncation_notes(page)
+            rendered = () if not page.rows else (
+                "\n\n".join([markdown_table(page.columns, page.rows)] + notes),
+                "\n".join([text_table(page.columns, page.rows, max_rows=10)] + notes),
+            )
+        self.result_cache.put(key, rendered)
+        return rendered or None
+
+    @staticmethod
+    def summary_prompt(question, data_text):
+        return f"Summarize this data for: '{question}'.\nData:\n{data_text}\nKeep it to 2 sentences."
+
+    def summarize(self, question, data_text):
+        prompt = self.summary_prompt(question, data_text)
+        text, _, _ = self._complete([{"role": "user", "content": prompt}], 0.3)
+        return text
+
+    def print_stats(self):
+        stats = self.result_cache.stats()
+        memo = self.sql_memo.stats()
+        print(f"   Result cache: {stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evictions")
+        print(f"   SQL memo: {memo['hits']} hits, {memo['misses']} misses")
+        print(f"   LLM: {self.llm_stats.summary()}")
+        print(f"   SQL checks: {self.validator.summary()}")
+        print("   Time per stage:")
+        print("\n".join("      " + line for line in instrumentation.recorder.report().splitlines()))
 
     def run(self):
         print(f"✅ Config-Aware Agent Ready ({MODEL_NAME})")
@@ -159,26 +320,157 @@ class LocalAgent:
         
         while True:
             q = input("\nAsk (or 'q'): ")
-            if q.lower() in ['q', 'quit']: break
+            if q.lower() in ['q', 'quit']:
+                self.print_stats()
+                break
             
             print("   Thinking...", end="\r")
-            sql = self.generate_sql(q)
+            sql, memo_hit = self.generate_sql(q)
+            try:
+                sql = self.check_sql(q, sql, memo_hit)
+            except InvalidSQL as e:
+                print(f"❌ Rejected before running: {e}")
+                continue
             print(f"⚡ SQL: {sql}")
             
             try:
-                conn = sqlite3.connect(DB_PATH)
-                df = pd.read_sql(sql, conn)
-                conn.close()
+                result = self.run_query(sql)
+                if not memo_hit:
+                    # Only SQL that ran is worth reusing
+                    self.sql_memo.put(q, sql)
                 
-                if df.empty:
+                if result is None:
                     print("⚠️ No results.")
                 else:
+                    table, preview = result
                     print("\n📊 Result:")
-                    print(df.to_markdown(index=False))
+                    print(table)
                     print("\n📝 Insight:")
-                    print(self.summarize(q, df))
+                    print(self.summarize(q, preview))
             except Exception as e:
                 print(f"❌ Error: {e}")
 
+    # --- Batch mode ---
+
+    async def _acomplete(self, aclient, limit, messages, temperature):
+        """Async `_complete`; `limit` caps the calls in flight."""
+        async with limit:
+            start = time.perf_counter()
+            ttft, parts = None, []
+            stream = await aclient.chat.completions.create(
+                model=MODEL_NAME, messages=messages, temperature=temperature, stream=True
+            )
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                    parts.append(chunk.choices[0].delta.content)
+            total = time.perf_counter() - start
+        self._record_llm(ttft, total)
+        return "".join(parts), ttft
+
+    async def answer(self, question, aclient, limit):
+        """
+        Generate SQL -> run it -> summarize, for one question. `limit` caps
+        the LLM calls in flight across all questions; the query itself runs
+        in a worker thread, so other questions keep generating meanwhile.
+        """
+        record = {'question': question, 'sql': None, 'result': None, 'summary': None, 'error': None,
+                  'memo_hit': False, 'repaired': False}
+        timings = record['seconds'] = {}
+        start = time.perf_counter()
+        try:
+            sql = self.sql_memo.get(question)
+            record['memo_hit'] = sql is not None
+            if sql is None:
+                text, ttft = await self._acomplete(aclient, limit, self.sql_messages(question), 0)
+                sql = self._clean_sql(text)
+                timings['generate_ttft'] = round(ttft, 4) if ttft is not None else None
+            record['sql'] = sql
+            try:
+                record['sql'] = sql = await asyncio.to_thread(self.validator.validate, sql)
+            except InvalidSQL as e:
+                if record['memo_hit'] or not e.fixable:
+                    raise
+                text, _ = await self._acomplete(aclient, limit, self.repair_messages(question, sql, e), 0)
+                record['sql'] = sql = self._clean_sql(text)
+                record['sql'] = sql = await asyncio.to_thread(self.validator.validate, sql)
+                self.validator.count('repaired')
+                record['repaired'] = True
+            timings['generate'] = round(time.perf_counter() - start, 4)
+
+            start = time.perf_counter()
+            result = await asyncio.to_thread(self.run_query, sql)
+            timings['query'] = round(time.perf_counter() - start, 4)
+            if not record['memo_hit']:
+                self.sql_memo.put(question, sql)
+
+            if result is None:
+                record['summary'] = "No data found."
+            else:
+                record['result'], preview = result
+                start = time.perf_counter()
+                prompt = [{"role": "user", "content": self.summary_prompt(question, preview)}]
+                record['summary'], ttft = await self._acomplete(aclient, limit, prompt, 0.3)
+                timings['summarize_ttft'] = round(ttft, 4) if ttft is not None else None
+                timings['summarize'] = round(time.perf_counter() - start, 4)
+        except Exception as e:
+            record['error'] = str(e)
+        return record
+
+    async def run_batch(self, questions, output_path, concurrency=8, base_url=None, api_key=None):
+        """
+        Answers every question concurrently and writes one JSON line per
+        question (in completion order, with its `index`) to `output_path`.
+        Returns the number of questions that failed.
+        """
+        from openai import AsyncOpenAI
+        aclient = AsyncOpenAI(base_url=base_url or LLM_BASE_URL, api_key=api_key or LLM_API_KEY)
+        limit = asyncio.Semaphore(concurrency)
+        self.sql_memo  # loaded once here rather than racing in worker threads
+
+        async def numbered(index, question):
+            return {'index': index, **await self.answer(question, aclient, limit)}
+
+        print(f"🚀 Answering {len(questions)} questions ({concurrency} concurrent LLM calls)...")
+        start = time.perf_counter()
+        failed = 0
+        try:
+            tasks = [asyncio.create_task(numbered(i, q)) for i, q in enumerate(questions)]
+            with open(output_path, 'w') as out:
+                for task in asyncio.as_completed(tasks):
+                    record = await task
+                    failed += record['error'] is not None
+                    out.write(json.dumps(record) + "\n")
+        finally:
+            await aclient.close()
+
+        elapsed = time.perf_counter() - start
+        print(f"✅ {len(questions) - failed}/{len(questions)} answered in {elapsed:.1f}s "
+              f"({len(questions) / elapsed:.2f} questions/s) -> {output_path}")
+        self.print_stats()
+        return failed
+
+def read_questions(path):
+    """One question per line; blank lines and '#' comments are skipped."""
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+
+def main():
+    parser = argparse.ArgumentParser(description="Ask the HERD database questions in natural language.")
+    parser.add_argument('--batch', metavar='QUESTIONS',
+                        help="Answer every question in this file (one per line) instead of prompting.")
+    parser.add_argument('--output', default="batch_results.jsonl", help="JSONL file for batch results.")
+    parser.add_argument('--concurrency', type=int, default=8, help="LLM calls in flight in batch mode.")
+    parser.add_argument('--memo-ttl', type=float, default=DEFAULT_TTL,
+                        help="Seconds memoized SQL is reused (0 disables the memo).")
+    args = parser.parse_args()
+
+    if args.batch:
+        agent = LocalAgent(pool_size=args.concurrency, memo_ttl=args.memo_ttl)
+        asyncio.run(agent.run_batch(read_questions(args.batch), args.output, args.concurrency))
+    else:
+        LocalAgent(memo_ttl=args.memo_ttl).run()
+
 if __name__ == "__main__":
-    LocalAgent().run()
\ No newline at end of file
+    main()
\ No newline at end of file
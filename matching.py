@@ -0,0 +1,111 @@
+"""
+Integer-coded matching of raw HERD rows to mapping.json keys.
+
+Instead of building a "qid|row|col" string for every raw row, each label
+column is factorized (or read as a categorical) and only its distinct values
+are lower-cased and looked up in the mapping's vocabulary. A row's
+fingerprint is then three small integers combined into one int64 and
+resolved against the precomputed mapping with a binary search.
+"""
+import numpy as np
+import pandas as pd
+
+class MappingIndex:
+    """Precomputed, integer-keyed view of mapping.json for fast row matching."""
+
+    def __init__(self, entries):
+        """`entries` is an iterable of (question_id, row_match, col_match, key)."""
+        fingerprints = {}
+        names = {}
+        for qid, row_lbl, col_lbl, key in entries:
+            # Same normalization as the string fingerprint: None -> "", lower-case
+            triple = tuple("" if v is None else str(v).lower() for v in (qid, row_lbl, col_lbl))
+            # Later entries win on duplicate fingerprints, like a dict would
+            fingerprints[triple] = names.setdefault(key, len(names))
+
+        # Column ids follow mapping order
+        self.names = np.array(list(names), dtype=object)
+
+        triples = list(fingerprints)
+        self.qid_vocab = pd.Index(sorted({t[0] for t in triples}))
+        self.row_vocab = pd.Index(sorted({t[1] for t in triples}))
+        self.col_vocab = pd.Index(sorted({t[2] for t in triples}))
+
+        combined = self._combine(
+            self.qid_vocab.get_indexer([t[0] for t in triples]),
+            self.row_vocab.get_indexer([t[1] for t in triples]),
+            self.col_vocab.get_indexer([t[2] for t in triples]),
+        )
+        order = np.argsort(combined)
+        self._keys = combined[order]
+        self._values = np.fromiter(fingerprints.values(), dtype=np.int64, count=len(triples))[order]
+
+    @classmethod
+    def from_config(cls, full_config):
+        """Builds the index from the parsed mapping.json."""
+        return cls(
+            (info['question_id'], info['row_match'] or None, info['col_match'] or None, key)
+            for items in full_config.values()
+            for key, info in items.items()
+        )
+
+    def to_arrays(self):
+        """Plain arrays of the index, for saving (see compiled_mapping.py)."""
+        return {
+            'names': np.array(self.names.tolist(), dtype=str),
+            'qid_vocab': np.array(self.qid_vocab.tolist(), dtype=str),
+            'row_vocab': np.array(self.row_vocab.tolist(), dtype=str),
+            'col_vocab': np.array(self.col_vocab.tolist(), dtype=str),
+            'keys': self._keys,
+            'values': self._values,
+        }
+
+    @classmethod
+    def from_arrays(cls, names, qid_vocab, row_vocab, col_vocab, keys, values):
+        """Rebuilds an index from `to_arrays` output without re-keying the mapping."""
+        index = cls.__new__(cls)
+        index.names = np.array(names.tolist(), dtype=object)
+        index.qid_vocab = pd.Index(qid_vocab.tolist())
+        index.row_vocab = pd.Index(row_vocab.tolist())
+        index.col_vocab = pd.Index(col_vocab.tolist())
+        index._keys = np.asarray(keys, dtype=np.int64)
+        index._values = np.asarray(values, dtype=np.int64)
+        return index
+
+    def _combine(self, q, r, c):
+        n_row, n_col = len(self.row_vocab), len(self.col_vocab)
+        return (np.asarray(q, dtype=np.int64) * n_row + r) * n_col + c
+
+    @staticmethod
+    def _codes(values, vocab, n_rows):
+        """Per-row vocabulary code of a label column (-1 if not in the mapping)."""
+        empty = vocab.get_indexer([""])[0]
+        if values is None:
+            return np.full(n_rows, empty, dtype=np.int64)
+
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            codes, uniques = values.cat.codes.to_numpy(), values.cat.categories
+        else:
+            codes, uniques = pd.factorize(values)
+
+        # Only the distinct labels are converted to lower-case strings
+        lookup = vocab.get_indexer(pd.Index(uniques.astype(str)).str.lower())
+        # Missing labels (code -1) pick the trailing "" entry
+        lookup = np.append(lookup, empty)
+        return lookup[codes]
+
+    def match(self, qids, rows=None, cols=None):
+        """
+        Returns the mapping column id of every row (-1 when unmatched).
+        `rows` / `cols` may be None when the file has no such label column.
+        """
+        n_rows = len(qids)
+        q = self._codes(qids, self.qid_vocab, n_rows)
+        r = self._codes(rows, self.row_vocab, n_rows)
+        c = self._codes(cols, self.col_vocab, n_rows)
+
+        valid = (q >= 0) & (r >= 0) & (c >= 0)
+        combined = self._combine(q, r, c)
+        pos = np.searchsorted(self._keys, combined).clip(max=len(self._keys) - 1)
+        hit = valid & (self._keys[pos] == combined)
+        return np.where(hit, self._values[pos], -1)
@@ -0,0 +1,205 @@
+"""
+Institution-name search behind the `resolve_institution` server tool.
+
+Users name schools by nickname or abbreviation ("UTRGV", "Texas A&M",
+"UT Dallas"), and a guessed `name LIKE '%...%'` filter scans the table.
+etl.py rebuilds two small tables with every load instead:
+
+- `institution_lookup`: aliases keyed on their normalized text. The aliases
+  are the current name, every name an institution reported in earlier
+  survey years (`institution_name_history`), the names config.yml gives the
+  home institution and its peers, and an acronym of each name
+  ("University of Texas Rio Grande Valley" -> "UTRGV").
+- `institution_search`: the same aliases with their normalized text
+  trigram-indexed, so SQL can filter on a name fragment
+  (`inst_id IN (SELECT inst_id FROM institution_search WHERE alias_key LIKE '%a&m%')`).
+  On SQLite it is an FTS5 table with the trigram tokenizer; on PostgreSQL a
+  table with a pg_trgm GIN index (a plain scan where the extension is not
+  available).
+
+`AliasIndex` loads `institution_lookup` once per database load and answers
+in memory: the institutions with an exact alias, or else those whose
+aliases share the most of the text's trigrams (which tolerates misspellings). A ranked OR over
+every trigram in FTS5 would have to score each alias that shares a common
+trigram such as "uni", which takes milliseconds; AliasIndex picks its
+candidates from the text's rarest trigrams, so a lookup does a bounded
+amount of work however many aliases hold the common ones.
+"""
+import re
+from collections import defaultdict
+
+import numpy as np
+
+import storage
+
+_WORD = re.compile(r"[a-z0-9&]+")
+_STOPWORDS = {'of', 'the', 'at', 'and', 'in', 'for', 'a', '&'}
+
+# Aliases re-scored per lookup, by most shared trigrams
+SEARCH_CANDIDATES = 50
+# Candidates are picked from the text's rarest trigrams, up to this many
+# postings in total
+SEED_POSTINGS = 8192
+# Fuzzy matches scoring lower share too little of the text to be useful
+MIN_SCORE = 0.3
+
+def normalize(text):
+    """Lower-case words separated by single spaces ('Texas A&M Univ.' -> 'texas a&m univ')."""
+    return " ".join(_WORD.findall(str(text).lower()))
+
+def acronym(name):
+    """Initials of the significant words (whole 'A&M'-style words, no numbers); None if under 3 letters."""
+    letters = "".join(word.replace('&', '') if '&' in word else word[0]
+                      for word in _WORD.findall(str(name).lower())
+                      if word not in _STOPWORDS and word[0].isalpha())
+    return letters.upper() if len(letters) >= 3 else None
+
+def trigrams(key):
+    """Character trigrams of a normalized key."""
+    return {key[i:i + 3] for i in range(len(key) - 2)}
+
+class AliasIndex:
+    """Exact and trigram lookups over institution_lookup rows, in memory."""
+
+    def __init__(self, rows):
+        self.rows = rows                    # (alias_key, inst_id, alias, name, state)
+        self._exact = defaultdict(list)     # alias_key -> row numbers
+        postings = defaultdict(list)        # trigram -> row numbers
+        row_grams = []                      # trigram ids of each row
+        for i, (key, *_) in enumerate(rows):
+            self._exact[key].append(i)
+            grams = trigrams(key)
+            for gram in grams:
+                postings[gram].append(i)
+            row_grams.append(grams)
+        self._postings = {gram: np.array(ids, dtype=np.int32) for gram, ids in postings.items()}
+        self._gram_ids = {gram: k for k, gram in enumerate(self._postings)}
+        sizes = np.array([len(grams) for grams in row_grams], dtype=np.int64)
+        self._sizes = np.maximum(sizes, 1).astype(np.float64)
+        # Every row's trigram ids, concatenated (row i at _starts[i]:_starts[i + 1])
+        self._starts = np.concatenate([[0], np.cumsum(sizes)])
+        self._row_grams = np.array([self._gram_ids[gram] for grams in row_grams for gram in grams], dtype=np.int32)
+
+    @classmethod
+    def load(cls, execute):
+        """Reads institution_lookup through `execute(sql)` -> (columns, rows)."""
+        _, rows = execute(
+            "SELECT alias_key, inst_id, alias, name, state FROM institution_lookup ORDER BY alias_key, inst_id"
+        )
+        return cls(rows)
+
+    def _candidates(self, query):
+        """
+        (rows, shared trigram counts) of up to SEARCH_CANDIDATES aliases
+        sharing the most of the text's trigrams `query`. Candidates are
+        counted on the rarest trigrams only, up to SEED_POSTINGS rows in all,
+        so a lookup never counts every alias that holds a common trigram such
+        as "uni"; the few candidates are then counted exactly.
+        """
+        postings = sorted((self._postings[gram] for gram in query), key=len)
+        seeds, size = [], 0
+        for rows in postings:
+            if seeds and size + len(rows) > SEED_POSTINGS:
+                break
+            seeds.append(rows)
+            size += len(rows)
+        seen = np.bincount(np.concatenate(seeds))
+        rows = np.flatnonzero(seen)
+        if len(rows) > SEARCH_CANDIDATES:
+            rows = rows[np.argpartition(-seen[rows], SEARCH_CANDIDATES - 1)[:SEARCH_CANDIDATES]]
+        if len(seeds) == len(postings):
+            return rows, seen[rows]
+        return rows, self._shared(query, rows)
+
+    def _shared(self, query, rows):
+        """How many of the `query` trigrams each of `rows` contains, read from the rows' own trigrams."""
+        wanted = np.zeros(len(self._gram_ids), dtype=bool)
+        wanted[[self._gram_ids[gram] for gram in query]] = True
+        starts, sizes = self._starts[rows], self._starts[rows + 1] - self._starts[rows]
+        offsets = np.cumsum(sizes) - sizes
+        flat = np.arange(int(sizes.sum())) + np.repeat(starts - offsets, sizes)
+        return np.add.reduceat(wanted[self._row_grams[flat]], offsets)
+
+    def resolve(self, text, limit=5):
+        """
+        Best (inst_id, name, state, matched alias, score) per institution,
+        best first. Exact aliases score 1 and are all that is returned when
+        there are any. Otherwise the score weighs the share of the text's
+        trigrams the alias contains, the share of the text's words it
+        contains whole, and how much of the alias they cover.
+        """
+        key = normalize(text)
+        scores = {i: 1.0 for i in self._exact.get(key, ())}
+        query = [gram for gram in trigrams(key) if gram in self._postings]
+        if not scores and query:
+            top, shared = self._candidates(query)
+            grams = 0.6 * shared / len(trigrams(key)) + 0.15 * shared / self._sizes[top]
+            words = set(key.split())
+            for i, gram_score in zip(top.tolist(), grams.tolist()):
+                word_share = len(words.intersection(self.rows[i][0].split())) / len(words)
+                scores[i] = 0.9 * (gram_score + 0.25 * word_share)
+
+        best = {}
+        for i, score in scores.items():
+            _, inst_id, alias, name, state = self.rows[i]
+            if score >= MIN_SCORE and score > best.get(inst_id, (0.0,))[0]:
+                best[inst_id] = (score, name, state, alias)
+        ranked = sorted(best.items(), key=lambda item: (-item[1][0], item[0]))[:limit]
+        return [(inst_id, name, state, alias, round(float(score), 3))
+                for inst_id, (score, name, state, alias) in ranked]
+
+def _aliases(conn, config, latest):
+    """(inst_id, alias, source) for every institution; `latest` maps inst_id to (name, state)."""
+    aliases = [(inst_id, name, 'name') for inst_id, (name, _) in latest.items() if name]
+    aliases += conn.execute(
+        "SELECT DISTINCT inst_id, name, 'history' FROM institution_name_history ORDER BY inst_id, name"
+    ).fetchall()
+
+    home = config.get('institution') or {}
+    if home.get('inst_id'):
+        aliases += [(str(home['inst_id']), home[key], 'config') for key in ('name', 'short_name') if home.get(key)]
+    for members in (config.get('peers') or {}).values():
+        aliases += [(str(m['id']), m['name'], 'config') for m in members or [] if m.get('name')]
+
+    aliases += [(inst_id, acronym(alias), 'acronym') for inst_id, alias, source in list(aliases)
+                if source != 'config' and acronym(alias)]
+    return aliases
+
+def build_name_index(conn, config):
+    """(Re)builds institution_lookup and institution_search inside the load transaction."""
+    latest = {inst_id: (name, state) for inst_id, name, state in conn.execute(
+        "SELECT inst_id, name, state FROM institution_years ORDER BY year, inst_id"
+    )}
+    rows = {}
+    for inst_id, alias, source in _aliases(conn, config, latest):
+        key = normalize(alias)
+        if inst_id in latest and key and (key, inst_id) not in rows:
+            rows[(key, inst_id)] = (key, inst_id, alias, source) + latest[inst_id]
+
+    postgres = storage.dialect(conn) == 'postgresql'
+    conn.execute("DROP TABLE IF EXISTS institution_lookup")
+    conn.execute("""
+        CREATE TABLE institution_lookup (
+            alias_key TEXT NOT NULL, inst_id TEXT NOT NULL, alias TEXT, source TEXT, name TEXT, state TEXT,
+            PRIMARY KEY (alias_key, inst_id)
+        )""" + ("" if postgres else " WITHOUT ROWID"))
+    conn.executemany("INSERT INTO institution_lookup VALUES (?, ?, ?, ?, ?, ?)", list(rows.values()))
+
+    conn.execute("DROP TABLE IF EXISTS institution_search")
+    if postgres:
+        conn.execute("""
+            CREATE TABLE institution_search (alias_key TEXT, alias TEXT, inst_id TEXT, name TEXT, state TEXT)
+        """)
+    else:
+        conn.execute("""
+            CREATE VIRTUAL TABLE institution_search USING fts5(
+                alias_key, alias UNINDEXED, inst_id UNINDEXED, name UNINDEXED, state UNINDEXED,
+                tokenize = 'trigram'
+            )
+        """)
+    conn.execute("""
+        INSERT INTO institution_search SELECT alias_key, alias, inst_id, name, state FROM institution_lookup
+    """)
+    if postgres and conn.try_execute("CREATE EXTENSION IF NOT EXISTS pg_trgm WITH SCHEMA public"):
+        conn.execute("CREATE INDEX institution_search_trgm ON institution_search USING gin (alias_key public.gin_trgm_ops)")
+    return len(rows)
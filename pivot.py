@@ -0,0 +1,128 @@
+"""
+Direct sparse-to-wide builder for the `institutions` table.
+
+Replaces `pivot_table` over a five-string index: every (inst_id, year) gets
+an integer row id, every mapped metric an integer column id (in name
+order, as pivot_table sorted them), and values are scattered straight into place. Scaling (`* 1000`)
+and zero-filling happen in the same pass. When only a small share of the
+(row, column) cells is populated the cells stay in coordinate form and rows
+are expanded one at a time while they are written.
+"""
+import numpy as np
+
+# Identity columns of the wide table, in table order
+ID_COLUMNS = ['inst_id', 'name', 'city', 'state', 'year']
+
+# Raw-file identity columns (lowercase) and their wide table names
+RAW_ID_COLUMNS = ['inst_id', 'inst_name_long', 'inst_city', 'inst_state_code', 'year']
+RENAME_MAP = {'inst_name_long': 'name', 'inst_city': 'city', 'inst_state_code': 'state'}
+
+# Below this share of populated cells, never materialize the dense matrix
+DENSE_THRESHOLD = 0.25
+
+class WideYear:
+    """
+    One survey year in coordinate form: an identity frame with one row per
+    (inst_id, year), the metric names of the used columns, and the populated
+    (row, column, value) cells sorted by row then column.
+    """
+
+    def __init__(self, ids, metrics, rows, cols, values):
+        self.ids = ids
+        self.metrics = metrics
+        self.rows = rows
+        self.cols = cols
+        self.values = values
+        self.raw_names = []  # (inst_id, name as reported that year), set by etl.process_year
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def columns(self):
+        return list(self.ids.columns) + list(self.metrics)
+
+    @property
+    def density(self):
+        size = len(self.ids) * len(self.metrics)
+        return len(self.values) / size if size else 0.0
+
+    def to_dense(self):
+        """(n_rows, n_metrics) float array, zero where no value was reported."""
+        dense = np.zeros((len(self.ids), len(self.metrics)))
+        dense[self.rows, self.cols] = self.values
+        return dense
+
+    def iter_rows(self):
+        """Yields one plain-Python tuple per institution, ready for executemany."""
+        id_rows = self.ids.astype(object).where(self.ids.notna(), None).itertuples(index=False, name=None)
+
+        if self.density >= DENSE_THRESHOLD:
+            for id_row, values in zip(id_rows, self.to_dense().tolist()):
+                yield id_row + tuple(values)
+            return
+
+        # Sparse: expand one row at a time from the sorted cells
+        bounds = np.searchsorted(self.rows, np.arange(len(self.ids) + 1))
+        buffer = np.zeros(len(self.metrics))
+        for i, id_row in enumerate(id_rows):
+            lo, hi = bounds[i], bounds[i + 1]
+            buffer[:] = 0.0
+            buffer[self.cols[lo:hi]] = self.values[lo:hi]
+            yield id_row + tuple(buffer.tolist())
+
+    def iter_facts(self, column_ids):
+        """
+        Yields (inst_id, year, metric_id, value) for every non-zero cell (zeros
+        are implied, as in the wide table), where `column_ids` gives the
+        metric_id of each column in `metrics`.
+        """
+        nonzero = self.values != 0
+        rows = self.rows[nonzero]
+        inst_ids = self.ids['inst_id'].to_numpy(dtype=object)[rows]
+        years = self.ids['year'].to_numpy()[rows]
+        metric_ids = np.asarray(column_ids, dtype=np.int64)[self.cols[nonzero]]
+        return zip(inst_ids.tolist(), years.tolist(), metric_ids.tolist(), self.values[nonzero].tolist())
+
+def build_wide_year(df, metric_names, scale=1000):
+    """
+    Builds a WideYear from matched long rows.
+
+    `df` holds the raw identity columns plus `data` and `metric` (the
+    mapping column id from MappingIndex.match); `metric_names` maps those ids
+    to column names. For repeated (institution, metric) cells the first
+    non-null value wins, like `pivot_table(aggfunc='first')`.
+    """
+    # Like pivot_table, cells without a value or key are dropped
+    df = df.dropna(subset=['data', 'inst_id', 'year'])
+    if df.empty:
+        return None
+
+    # 1. Row ids: one per (inst_id, year), sorted like the old pivot index
+    row_ids = df.groupby(['inst_id', 'year'], sort=True).ngroup().to_numpy()
+    _, first_of_row = np.unique(row_ids, return_index=True)
+    id_cols = [c for c in RAW_ID_COLUMNS if c in df.columns]
+    ids = df.iloc[first_of_row][id_cols].rename(columns=RENAME_MAP).reset_index(drop=True)
+
+    # 2. Column ids: only metrics seen this year, sorted by name like the
+    # pivot_table columns were, so the table keeps its column order
+    metric = df['metric'].to_numpy()
+    metric_ids = np.unique(metric)
+    names = np.asarray(metric_names)[metric_ids]
+    order = np.argsort(names, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    col_ids = rank[np.searchsorted(metric_ids, metric)]
+
+    # 3. First value per cell; np.unique also sorts cells by (row, col)
+    flat = row_ids.astype(np.int64) * len(metric_ids) + col_ids
+    cells, first = np.unique(flat, return_index=True)
+    values = df['data'].to_numpy(dtype=np.float64)[first] * scale
+
+    return WideYear(
+        ids=ids,
+        metrics=names[order],
+        rows=cells // len(metric_ids),
+        cols=cells % len(metric_ids),
+        values=values,
+    )
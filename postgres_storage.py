@@ -0,0 +1,433 @@
+"""
+PostgreSQL backend (see storage.py), for serving many users from one
+database server.
+
+    HERD_DATABASE=postgresql://herd@db.example.edu/herd?schema=herd uv run etl.py
+
+Everything lives in one schema (`herd` unless the URL says `?schema=...`):
+
+- Loads: `institution_years`, `herd_facts` and the wide `institutions` are
+  partitioned by survey year (LIST partitions `<table>_<year>`), so
+  reloading a year drops and refills its partitions instead of deleting rows
+  from the whole table, and year filters only read their partitions. Rows
+  are streamed in with `COPY ... FROM STDIN` (one COPY per table and year),
+  not row-by-row INSERTs. A full rebuild loads into `<schema>_staging`,
+  which replaces the live schema in the commit; an incremental load runs in
+  place in one transaction. Either way readers see the previous load until
+  the commit, and an advisory lock keeps two loads from interleaving.
+- Reads: `PgQueryEngine` keeps a pool of connections whose transactions
+  are read-only. Queries run as a server-side cursor (so only one SELECT,
+  and pages are streamed), under a `statement_timeout`, and are rolled back
+  afterwards. Give the server a role that can only SELECT from the schema;
+  the read-only transaction is a second line of defence, not the only one.
+  Roles that could read the schema are granted the new one after a full
+  rebuild.
+
+The load code (bulk_loader, summaries, name_index) is shared with SQLite:
+`PgConnection` accepts its `?` parameters, and in CREATE / ALTER TABLE
+statements maps SQLite's 8-byte INTEGER and REAL to BIGINT and DOUBLE
+PRECISION (PostgreSQL's REAL is 4 bytes), gives TEXT the "C" collation
+(SQLite compares text byte by byte, so ORDER BY gives the same order
+whatever the server's locale) and drops `WITHOUT ROWID`.
+"""
+import csv
+import io
+import itertools
+import queue
+import re
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+import psycopg2.extras
+
+import instrumentation
+import storage
+from query_engine import (
+    DEFAULT_MAX_COLUMNS, DEFAULT_MAX_ROWS, DEFAULT_TIMEOUT, Page, QueryEngine, QueryNotAllowed, QueryTimeout,
+    blank_quoted, encode_page_token,
+)
+
+DEFAULT_SCHEMA = "herd"
+BASE_DIR = Path(__file__).parent
+
+# Seconds the read engine trusts its last look at the load generation
+GENERATION_TTL = 1.0
+
+# Session settings of a load transaction: sorts and hashes for the summary
+# tables and index builds stay in memory instead of spilling to disk
+LOAD_SETTINGS = {
+    'work_mem': '256MB',
+    'maintenance_work_mem': '512MB',
+}
+
+# Tables with one partition per survey year
+PARTITIONED_TABLES = ('institution_years', 'herd_facts', 'institutions')
+
+# COPY input: rows formatted per batch, and characters handed to psycopg2 per read
+COPY_BATCH_ROWS = 1000
+COPY_READ_SIZE = 1 << 20
+
+_IDENTIFIER = re.compile(r"[a-z_][a-z0-9_]*")
+_TABLE_DDL = re.compile(r"\s*(CREATE|ALTER)\s+TABLE\b", re.IGNORECASE)
+_WITHOUT_ROWID = re.compile(r"\s*\bWITHOUT ROWID\b", re.IGNORECASE)
+_SQLITE_TYPES = re.compile(r"\b(INTEGER|REAL|TEXT)\b")
+_PG_TYPES = {'INTEGER': 'BIGINT', 'REAL': 'DOUBLE PRECISION', 'TEXT': 'TEXT COLLATE "C"'}
+_READ_STATEMENTS = {'select', 'with', 'values', 'table'}
+
+# NUMERIC results (SUM of integers, AVG) as floats, as SQLite returns them
+_NUMERIC_AS_FLOAT = psycopg2.extensions.new_type(
+    psycopg2.extensions.DECIMAL.values, 'NUMERIC_AS_FLOAT', lambda value, cursor: None if value is None else float(value)
+)
+
+def partition(table, year):
+    return f"{table}_{int(year)}"
+
+def _placeholders(sql, params):
+    """psycopg2's %s for SQLite's ? when there are parameters (a literal % is then escaped)."""
+    return sql.replace('%', '%%').replace('?', '%s') if params else sql
+
+def _pg_sql(sql, params):
+    """A load statement written for SQLite, for psycopg2 (see the module docstring)."""
+    if _TABLE_DDL.match(sql):
+        sql = _SQLITE_TYPES.sub(lambda m: _PG_TYPES[m.group(1)], _WITHOUT_ROWID.sub("", sql))
+    return _placeholders(sql, params)
+
+def _read_only_statement(sql):
+    """`sql` without a trailing ';'; QueryNotAllowed unless it is one SELECT."""
+    statement = sql.strip().rstrip(';').rstrip()
+    if ';' in blank_quoted(statement):
+        raise QueryNotAllowed("Only one statement per query is allowed.")
+    words = blank_quoted(statement).lstrip(' (\n\t').split(None, 1)
+    if not words or words[0].lower() not in _READ_STATEMENTS:
+        raise QueryNotAllowed("Read-only access. Only SELECT queries are allowed.")
+    return statement
+
+def _plan_scans(node, parent, scans, ids, parents):
+    """
+    Full scans of a JSON plan as SQLite-style (parent, 'SCAN table') rows:
+    the inputs of one Nested Loop share a parent, as nested loops do in
+    SQLite's plans; the partitions under one Append count as a single scan
+    of their table.
+    """
+    kind = node['Node Type']
+    if kind == 'Seq Scan':
+        table = node['Relation Name']
+        scans.append((parent, f"SCAN {parents.get(table, table)}"))
+    children = node.get('Plans', [])
+    if kind in ('Append', 'Merge Append'):
+        inner = []
+        for child in children:
+            _plan_scans(child, parent, inner, ids, parents)
+        scans.extend(dict.fromkeys(inner))
+    elif kind in ('Nested Loop', 'Materialize'):
+        loop = next(ids) if kind == 'Nested Loop' else parent
+        for child in children:
+            _plan_scans(child, loop, scans, ids, parents)
+    else:
+        for child in children:
+            _plan_scans(child, next(ids), scans, ids, parents)
+
+class CsvStream:
+    """
+    Read-only text file over the CSV of `rows`, for COPY FROM STDIN. Rows
+    are formatted by the csv module in C, `batch_rows` at a time as COPY
+    reads: strings are quoted, so an unquoted empty field (None) is NULL and
+    "" an empty string.
+    """
+
+    def __init__(self, rows, batch_rows=COPY_BATCH_ROWS):
+        self._rows = iter(rows)
+        self._batch_rows = batch_rows
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer, quoting=csv.QUOTE_STRINGS, lineterminator="\n")
+        self._text, self._pos = "", 0
+
+    def _refill(self):
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._writer.writerows(itertools.islice(self._rows, self._batch_rows))
+        self._text, self._pos = self._buffer.getvalue(), 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return "".join(iter(lambda: self.read(COPY_READ_SIZE), ""))
+        if self._pos >= len(self._text):
+            self._refill()
+        chunk = self._text[self._pos:self._pos + size]
+        self._pos += len(chunk)
+        return chunk
+
+class PgConnection:
+    """
+    A psycopg2 connection with the sqlite3.Connection calls the load code
+    makes (`execute` returning the cursor, `executemany`), plus COPY.
+    """
+
+    dialect = 'postgresql'
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    @property
+    def closed(self):
+        return bool(self.raw.closed)
+
+    def execute(self, sql, params=()):
+        cursor = self.raw.cursor()
+        cursor.execute(_pg_sql(sql, params), tuple(params) or None)
+        return cursor
+
+    def executemany(self, sql, rows):
+        psycopg2.extras.execute_batch(self.raw.cursor(), _pg_sql(sql, True), rows, page_size=1000)
+
+    def copy_rows(self, table, columns, rows):
+        """
+        Streams `rows` (tuples in `columns` order) into `table` with one COPY
+        FROM STDIN, formatted COPY_BATCH_ROWS at a time as it is sent
+        (CsvStream), so a year is never held as one CSV text.
+        """
+        names = ", ".join(f'"{c}"' for c in columns)
+        self.raw.cursor().copy_expert(f'COPY "{table}" ({names}) FROM STDIN WITH (FORMAT csv)',
+                                      CsvStream(rows), size=COPY_READ_SIZE)
+
+    def try_execute(self, sql):
+        """Runs `sql` in a savepoint; False, with nothing changed, if it fails."""
+        cursor = self.raw.cursor()
+        cursor.execute("SAVEPOINT try_execute")
+        try:
+            cursor.execute(sql)
+        except psycopg2.Error:
+            cursor.execute("ROLLBACK TO SAVEPOINT try_execute")
+            return False
+        cursor.execute("RELEASE SAVEPOINT try_execute")
+        return True
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def close(self):
+        self.raw.close()
+
+class PgQueryEngine(QueryEngine):
+    """QueryEngine's calls on a pool of read-only PostgreSQL connections."""
+
+    dialect = 'postgresql'
+    Error = psycopg2.Error
+
+    def __init__(self, store, pool_size=4):
+        super().__init__(store.dsn, pool_size)
+        self.store = store
+        # Connections never go stale the way a replaced herd.db file does
+        self._file_id = store.schema
+        self._checked = float('-inf')
+        self._cursor_ids = itertools.count()
+
+    def _connect(self):
+        return self.store.connect_raw(readonly=True)
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._file_id, self._connect()
+
+    def release(self, handle):
+        if handle[1].closed:
+            return
+        super().release(handle)
+
+    def _finish(self, handle):
+        try:
+            handle[1].rollback()
+        except psycopg2.Error:
+            handle[1].close()  # broken connection; not returned to the pool
+        self.release(handle)
+
+    def generation(self):
+        """Load generation, read again at most every GENERATION_TTL seconds."""
+        if time.monotonic() - self._checked > GENERATION_TTL:
+            self._generation = self._with_connection(storage.read_generation)
+            self._checked = time.monotonic()
+        return self._generation
+
+    @staticmethod
+    def _translate(error):
+        if isinstance(error, psycopg2.errors.QueryCanceled):
+            return QueryTimeout("Query exceeded the time limit and was stopped.")
+        if isinstance(error, (psycopg2.errors.ReadOnlySqlTransaction, psycopg2.errors.InsufficientPrivilege)):
+            return QueryNotAllowed("Read-only access. Only SELECT queries are allowed.")
+        return error
+
+    def _start(self, conn, sql, params, timeout):
+        """`sql` opened as a server-side cursor under a statement timeout."""
+        statement = _read_only_statement(sql)
+        try:
+            conn.execute("SET LOCAL statement_timeout = ?", (int(timeout * 1000),))
+            cursor = conn.raw.cursor(name=f"herd_query_{next(self._cursor_ids)}")
+            cursor.execute(_placeholders(statement, params), tuple(params) or None)
+            return cursor
+        except psycopg2.Error as e:
+            raise self._translate(e) from e
+
+    def execute(self, sql, params=(), timeout=DEFAULT_TIMEOUT):
+        handle = self.acquire()
+        try:
+            cursor = self._start(handle[1], sql, params, timeout)
+            try:
+                rows = cursor.fetchall()
+            except psycopg2.Error as e:
+                raise self._translate(e) from e
+            return [d[0] for d in cursor.description or ()], rows
+        finally:
+            self._finish(handle)
+
+    def fetch_page(self, sql, offset=0, max_rows=DEFAULT_MAX_ROWS, max_columns=DEFAULT_MAX_COLUMNS,
+                   timeout=DEFAULT_TIMEOUT):
+        """Like QueryEngine.fetch_page; the rows before `offset` are skipped on the server (MOVE)."""
+        generation = self.generation()
+        handle = self.acquire()
+        try:
+            cursor = self._start(handle[1], sql, (), timeout)
+            try:
+                if offset:
+                    cursor.scroll(offset)
+                rows = cursor.fetchmany(max_rows + 1)
+            except psycopg2.Error as e:
+                raise self._translate(e) from e
+            columns = [d[0] for d in cursor.description or ()]
+        finally:
+            self._finish(handle)
+
+        more_rows = len(rows) > max_rows
+        rows = [row[:max_columns] for row in rows[:max_rows]]
+        next_token = encode_page_token(sql, offset + max_rows, generation) if more_rows else None
+        return Page(columns[:max_columns], rows, offset, more_rows, columns[max_columns:], next_token)
+
+    def explain(self, sql):
+        """Full scans in PostgreSQL's plan for `sql`, in QueryEngine.explain's (parent, detail) form."""
+        statement = _read_only_statement(sql)
+
+        def plan(conn):
+            try:
+                cursor = conn.raw.cursor()
+                cursor.execute("EXPLAIN (FORMAT JSON) " + statement)
+                (document,), = cursor.fetchall()
+            except psycopg2.Error as e:
+                raise self._translate(e) from e
+            parents = dict(conn.execute("""
+                SELECT c.relname, p.relname FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent
+            """).fetchall())
+            scans = []
+            _plan_scans(document[0]['Plan'], 0, scans, itertools.count(1), parents)
+            return scans
+        return self._with_connection(plan)
+
+class PostgresStorage:
+    """herd data in one schema of a PostgreSQL database."""
+
+    dialect = 'postgresql'
+
+    def __init__(self, url, schema=None, artifact_path=None):
+        parts = urlsplit(url)
+        query = parse_qsl(parts.query)
+        self.schema = schema or dict(query).get('schema', DEFAULT_SCHEMA)
+        if not _IDENTIFIER.fullmatch(self.schema):
+            raise ValueError(f"invalid schema name {self.schema!r} (lower-case letters, digits, _)")
+        self.dsn = urlunsplit(parts._replace(query=urlencode([(k, v) for k, v in query if k != 'schema'])))
+        self.dbname = parts.path.lstrip('/') or dict(query).get('dbname') or parts.username or 'postgres'
+        self._where = f"{parts.hostname or dict(query).get('host') or 'localhost'}/{self.dbname}"
+        self.artifact_path = Path(artifact_path or BASE_DIR / f"{self.dbname}-{self.schema}")
+
+    def __str__(self):
+        return f"PostgreSQL {self._where} (schema {self.schema})"
+
+    def connect_raw(self, readonly=False):
+        """A new PgConnection with the schema on its search path; read-only transactions if `readonly`."""
+        options = f"-c search_path={self.schema}"
+        if readonly:
+            options += f" -c default_transaction_read_only=on -c statement_timeout={int(DEFAULT_TIMEOUT * 1000)}"
+        raw = psycopg2.connect(self.dsn, options=options, application_name="herd")
+        psycopg2.extensions.register_type(_NUMERIC_AS_FLOAT, raw)
+        return PgConnection(raw)
+
+    @contextmanager
+    def connect(self, readonly=False):
+        conn = self.connect_raw(readonly)
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def exists(self):
+        with self.connect(readonly=True) as conn:
+            return bool(conn.execute("SELECT 1 FROM pg_namespace WHERE nspname = ?", (self.schema,)).fetchone())
+
+    def generation(self):
+        with self.connect(readonly=True) as conn:
+            return storage.read_generation(conn)
+
+    @contextmanager
+    def load(self, fresh=False):
+        """
+        Yields a connection inside the load transaction, in the live schema
+        or (`fresh`) an empty staging schema that replaces it on commit.
+        """
+        target = f"{self.schema}_staging" if fresh else self.schema
+        conn = self.connect_raw()
+        try:
+            conn.execute("SELECT pg_advisory_xact_lock(hashtext(?))", (self.schema,))
+            # Read under the lock (each statement sees the last committed load),
+            # so two loads never publish the same generation
+            generation = storage.read_generation(conn) + 1
+            if fresh:
+                conn.execute(f"DROP SCHEMA IF EXISTS {target} CASCADE")
+            conn.execute(f"CREATE SCHEMA IF NOT EXISTS {target}")
+            conn.execute(f"SET LOCAL search_path = {target}")
+            for setting, value in LOAD_SETTINGS.items():
+                conn.execute(f"SET LOCAL {setting} = '{value}'")
+            yield conn
+
+            with instrumentation.span("commit"):
+                conn.execute("CREATE TABLE IF NOT EXISTS etl_generation (generation INTEGER)")
+                conn.execute("DELETE FROM etl_generation")
+                conn.execute("INSERT INTO etl_generation VALUES (?)", (generation,))
+                if fresh:
+                    readers = self._readers(conn)
+                    conn.execute(f"DROP SCHEMA IF EXISTS {self.schema} CASCADE")
+                    conn.execute(f"ALTER SCHEMA {target} RENAME TO {self.schema}")
+                    for role in readers:
+                        conn.execute(f"GRANT USAGE ON SCHEMA {self.schema} TO {role}")
+                        conn.execute(f"GRANT SELECT ON ALL TABLES IN SCHEMA {self.schema} TO {role}")
+                conn.commit()
+
+                conn.raw.autocommit = True
+                for name, kind in storage.tables(conn).items():
+                    if kind == 'table':
+                        conn.execute(f'ANALYZE "{name}"')
+        except BaseException:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _readers(self, conn):
+        """Roles other than the owner that may use the live schema; a full rebuild grants them the new one."""
+        return [role for role, in conn.execute("""
+            SELECT DISTINCT a.grantee::regrole::text
+            FROM pg_namespace n, aclexplode(n.nspacl) a
+            WHERE n.nspname = ? AND a.privilege_type = 'USAGE' AND a.grantee NOT IN (0, n.nspowner)
+        """, (self.schema,))]
+
+    def engine(self, pool_size=4):
+        return PgQueryEngine(self, pool_size=pool_size)
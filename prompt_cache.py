@@ -0,0 +1,106 @@
+"""
+Prompt-side caching for LocalAgent.
+
+- `SQLMemo`: persistent question -> SQL memo (a small SQLite file next to
+  herd.db) with a time-to-live. Questions are normalized first, so repeated
+  questions that differ only in case, punctuation or spacing skip the LLM.
+  Keys also include a hash of the fixed prompt prefix and the model, so a
+  changed config or model starts from a clean slate.
+- `LatencyStats`: time-to-first-token and total latency of LLM calls.
+"""
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+# Memoized SQL older than this is regenerated
+DEFAULT_TTL = 7 * 24 * 3600
+
+_WORD = re.compile(r"[a-z0-9&]+")
+
+def memo_path(db_path):
+    db_path = Path(db_path)
+    return db_path.with_name(db_path.stem + ".sql_memo.db")
+
+def normalize_question(question):
+    """Lower-case words only: 'How has UNT grown?' == 'how has unt grown'."""
+    return " ".join(_WORD.findall(question.lower()))
+
+def prompt_hash(*parts):
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()[:16]
+
+class SQLMemo:
+    """On-disk question -> SQL memo with a TTL, safe to share between threads."""
+
+    def __init__(self, path, ttl=DEFAULT_TTL, namespace=""):
+        self.ttl = ttl
+        self.namespace = namespace
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS sql_memo (
+                key TEXT PRIMARY KEY, question TEXT, sql TEXT, created_at REAL
+            )
+        """)
+        # Expired entries are dropped on open
+        self._conn.execute("DELETE FROM sql_memo WHERE created_at < ?", (time.time() - ttl,))
+
+    def _key(self, question):
+        return f"{self.namespace}:{normalize_question(question)}"
+
+    def get(self, question):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT sql FROM sql_memo WHERE key = ? AND created_at >= ?",
+                (self._key(question), time.time() - self.ttl)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, question, sql):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sql_memo VALUES (?, ?, ?, ?)",
+                (self._key(question), question, sql, time.time())
+            )
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0}
+
+    def close(self):
+        self._conn.close()
+
+def _percentile(values, q):
+    """Linearly interpolated percentile, like numpy's default."""
+    values = sorted(values)
+    rank = (len(values) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+class LatencyStats:
+    """Time-to-first-token and total seconds of every LLM call."""
+
+    def __init__(self):
+        self.ttft = []
+        self.total = []
+
+    def record(self, ttft, total):
+        self.ttft.append(ttft if ttft is not None else total)
+        self.total.append(total)
+
+    def summary(self):
+        if not self.total:
+            return "no LLM calls"
+        ttft = [_percentile(self.ttft, q) * 1000 for q in (50, 95)]
+        total = [_percentile(self.total, q) * 1000 for q in (50, 95)]
+        return (f"{len(self.total)} LLM calls, TTFT p50 {ttft[0]:.0f} ms / p95 {ttft[1]:.0f} ms, "
+                f"total p50 {total[0]:.0f} ms / p95 {total[1]:.0f} ms")
@@ -0,0 +1,296 @@
+"""
+Read-only query engine behind the MCP server tools.
+
+Connections to herd.db are opened once (`mode=ro`, `query_only`, large page
+cache, memory-mapped reads) and kept in a pool, so a tool call reuses a warm
+connection together with its prepared-statement cache instead of paying
+connection setup and a cold cache every time. Queries run on a thread pool;
+async callers await them without blocking the event loop.
+
+etl.py replaces herd.db atomically with a new file. The engine notices the
+swap (a different inode / mtime) and reopens its connections on the new one,
+and reads the new file's load generation (`PRAGMA user_version`, bumped by
+every ETL load) for result-cache keys.
+
+Guardrails: an authorizer callback on every connection denies anything but
+reads, a progress handler aborts statements that run past a wall-clock
+timeout, and `fetch_page` streams at most `max_rows` rows (and `max_columns`
+columns) off the cursor, returning a continuation token for the next page.
+
+postgres_storage.PgQueryEngine offers the same calls on PostgreSQL.
+"""
+import asyncio
+import base64
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import storage
+
+# Per-connection tuning for a read-mostly database
+READ_PRAGMAS = {
+    'query_only': 'ON',
+    'mmap_size': 1 << 30,     # map up to 1 GiB of the file
+    'cache_size': -131072,    # 128 MiB page cache
+    'temp_store': 'MEMORY',
+}
+
+# Prepared statements kept per connection (sqlite3's LRU statement cache)
+STATEMENT_CACHE_SIZE = 256
+
+# Guardrail defaults for tool calls
+DEFAULT_MAX_ROWS = 200
+DEFAULT_MAX_COLUMNS = 40
+DEFAULT_TIMEOUT = 10.0            # seconds of wall-clock time per statement
+PROGRESS_INTERVAL = 1000          # SQLite VM steps between timeout checks
+
+class QueryNotAllowed(sqlite3.DatabaseError):
+    """The statement would do more than read the database."""
+
+class QueryTimeout(sqlite3.OperationalError):
+    """The statement ran past its wall-clock timeout and was interrupted."""
+
+# Authorizer: reading tables and calling functions is all a query may do
+_ALLOWED_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE}
+# Pragmas that only describe the schema (their argument is a table or index)
+_SCHEMA_PRAGMAS = {'table_info', 'table_xinfo', 'index_list', 'index_info', 'index_xinfo'}
+# Pragmas that may be read but not set (FTS5 reads data_version internally)
+_READ_PRAGMAS = {'user_version', 'data_version'}
+
+def _authorize(action, arg1, arg2, db_name, trigger):
+    if action in _ALLOWED_ACTIONS:
+        return sqlite3.SQLITE_OK
+    if action == sqlite3.SQLITE_PRAGMA:
+        pragma = arg1.lower()
+        if pragma in _SCHEMA_PRAGMAS or (pragma in _READ_PRAGMAS and arg2 is None):
+            return sqlite3.SQLITE_OK
+    return sqlite3.SQLITE_DENY
+
+# String literals, quoted identifiers and comments
+_QUOTED = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|`[^`]*`|\[[^\]]*\]|--[^\n]*|/\*.*?\*/", re.DOTALL)
+
+def blank_quoted(sql):
+    """`sql` with literals, quoted names and comments blanked out, so keywords can be looked for."""
+    return _QUOTED.sub(lambda m: " " * len(m.group()), sql)
+
+def strip_comments(sql):
+    """`sql` without its comments; literals and quoted names are kept as written."""
+    return _QUOTED.sub(lambda m: " " if m.group().startswith(('--', '/*')) else m.group(), sql)
+
+def encode_page_token(sql, offset, generation):
+    """Opaque continuation token: where the next page of `sql` starts."""
+    payload = json.dumps({'sql': sql, 'offset': offset, 'generation': generation})
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+def decode_page_token(token):
+    """Returns (sql, offset, generation) from a continuation token."""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token.encode()))
+        return payload['sql'], int(payload['offset']), payload['generation']
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError("invalid page token") from e
+
+class Page:
+    """One page of a query result plus what was cut off."""
+
+    def __init__(self, columns, rows, offset, more_rows, hidden_columns, next_token):
+        self.columns = columns
+        self.rows = rows
+        self.offset = offset
+        self.more_rows = more_rows
+        self.hidden_columns = hidden_columns
+        self.next_token = next_token
+
+class QueryEngine:
+    """Pool of read-only SQLite connections plus the threads that use them."""
+
+    dialect = 'sqlite'
+    Error = sqlite3.Error
+
+    def __init__(self, db_path, pool_size=4):
+        self.db_path = db_path
+        self.pool_size = pool_size
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._file_id = None
+        self._generation = None
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="herd-query")
+
+    # --- Connections ---
+
+    def _db_file_id(self):
+        stat = os.stat(self.db_path)
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            f"file:{os.fspath(self.db_path)}?mode=ro", uri=True,
+            check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        for pragma, value in READ_PRAGMAS.items():
+            conn.execute(f"PRAGMA {pragma} = {value}")
+        conn.set_authorizer(_authorize)
+        return conn
+
+    def _drain(self):
+        while True:
+            try:
+                self._idle.get_nowait()[1].close()
+            except queue.Empty:
+                return
+
+    def acquire(self):
+        """
+        Returns (file_id, connection). Pooled connections opened on a database
+        file that has since been replaced are discarded.
+        """
+        file_id = self._db_file_id()
+        with self._lock:
+            if file_id == self._file_id:
+                try:
+                    return self._idle.get_nowait()
+                except queue.Empty:
+                    pass
+
+        conn = self._connect()
+        if file_id != self._file_id:
+            generation = conn.execute("PRAGMA user_version").fetchone()[0]
+            with self._lock:
+                if file_id != self._file_id:
+                    self._drain()
+                    self._file_id = file_id
+                    self._generation = generation
+        return file_id, conn
+
+    def release(self, handle):
+        file_id, conn = handle
+        with self._lock:
+            if file_id == self._file_id and self._idle.qsize() < self.pool_size:
+                self._idle.put(handle)
+                return
+        conn.close()
+
+    def generation(self):
+        """Load generation of the current herd.db (changes with every ETL load)."""
+        self.release(self.acquire())
+        return self._generation
+
+    # --- Queries ---
+
+    def _cursor(self, conn, sql, params, timeout):
+        """
+        Starts `sql` with a wall-clock deadline enforced by the progress
+        handler, translating authorizer denials and interrupts.
+        """
+        deadline = time.monotonic() + timeout
+        conn.set_progress_handler(lambda: time.monotonic() > deadline, PROGRESS_INTERVAL)
+        try:
+            return conn.execute(sql, params), deadline
+        except sqlite3.DatabaseError as e:
+            raise self._translate(e, deadline) from e
+
+    @staticmethod
+    def _translate(error, deadline):
+        if str(error) == 'not authorized':
+            return QueryNotAllowed("Read-only access. Only SELECT queries are allowed.")
+        if str(error) == 'interrupted' and time.monotonic() > deadline:
+            return QueryTimeout("Query exceeded the time limit and was stopped.")
+        return error
+
+    def _finish(self, handle):
+        handle[1].set_progress_handler(None, 0)
+        handle[1].rollback()
+        self.release(handle)
+
+    def execute(self, sql, params=(), timeout=DEFAULT_TIMEOUT):
+        """Runs one query on a pooled connection; returns (column names, rows)."""
+        handle = self.acquire()
+        try:
+            cursor, deadline = self._cursor(handle[1], sql, params, timeout)
+            columns = [d[0] for d in cursor.description or ()]
+            try:
+                return columns, cursor.fetchall()
+            except sqlite3.DatabaseError as e:
+                raise self._translate(e, deadline) from e
+        finally:
+            self._finish(handle)
+
+    def fetch_page(self, sql, offset=0, max_rows=DEFAULT_MAX_ROWS, max_columns=DEFAULT_MAX_COLUMNS,
+                   timeout=DEFAULT_TIMEOUT):
+        """
+        Streams rows `offset`..`offset + max_rows` of `sql` off the cursor,
+        keeping only the first `max_columns` columns. Earlier rows are
+        stepped over, never kept. Pages are stable only for ordered queries.
+        """
+        handle = self.acquire()
+        generation = self._generation
+        try:
+            cursor, deadline = self._cursor(handle[1], sql, (), timeout)
+            columns = [d[0] for d in cursor.description or ()]
+            try:
+                skipped = 0
+                while skipped < offset:
+                    batch = cursor.fetchmany(min(offset - skipped, 1000))
+                    if not batch:
+                        break
+                    skipped += len(batch)
+                rows = cursor.fetchmany(max_rows + 1)
+            except sqlite3.DatabaseError as e:
+                raise self._translate(e, deadline) from e
+            cursor.close()
+        finally:
+            self._finish(handle)
+
+        more_rows = len(rows) > max_rows
+        rows = [row[:max_columns] for row in rows[:max_rows]]
+        next_token = encode_page_token(sql, offset + max_rows, generation) if more_rows else None
+        return Page(columns[:max_columns], rows, offset, more_rows, columns[max_columns:], next_token)
+
+    def explain(self, sql):
+        """(parent, detail) rows of SQLite's `EXPLAIN QUERY PLAN` for `sql`; nothing is read."""
+        _, rows = self.execute("EXPLAIN QUERY PLAN " + sql)
+        return [(parent, detail) for _, parent, _, detail in rows]
+
+    def _with_connection(self, read):
+        handle = self.acquire()
+        try:
+            return read(handle[1])
+        finally:
+            self._finish(handle)
+
+    def table_columns(self, table):
+        return self._with_connection(lambda conn: storage.table_columns(conn, table))
+
+    def schema(self):
+        """{table or view: [columns]} of the current load."""
+        return self._with_connection(
+            lambda conn: {name: storage.table_columns(conn, name) for name in storage.tables(conn)})
+
+    async def run(self, sql, params=()):
+        """`execute` on the engine's thread pool, for use from async code."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.execute, sql, params)
+
+    async def run_page(self, sql, offset=0, **limits):
+        """`fetch_page` on the engine's thread pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: self.fetch_page(sql, offset, **limits))
+
+    async def run_generation(self):
+        """`generation` on the engine's thread pool (it may open a connection)."""
+        return await self.run_call(self.generation)
+
+    async def run_call(self, fn, *args):
+        """`fn(*args)` on the engine's thread pool, for other reads async code must not block on."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            self._drain()
@@ -0,0 +1,258 @@
+"""
+Shared reader for the raw HERD survey files used by etl.py and
+analyze_schema.py.
+
+A year is stored either as an extracted CSV (`herd_{year}_*.csv`) or, when
+downloaded with `keep_archives`, as the original compressed archive
+(`herd_{year}.zip`). Archives are never inflated to disk: the CSV member is
+decompressed as a stream straight into the CSV parser.
+
+Parsed years are cached in `{data_dir}/.cache/{file name}/`: one flat array
+per column, with text columns dictionary-encoded (int32 codes + the distinct
+labels in meta.json) and numeric columns stored typed. The cache records the
+SHA-256 of its source and is rebuilt whenever the source bytes change, so a
+year is parsed from CSV once and afterwards every reader memory-maps just the
+columns it needs.
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Raw-file label columns the ETL reads (lowercase); everything else is skipped
+ROW_LABEL_COLUMNS = ['row', 'row_label', 'question_label']
+COL_LABEL_COLUMNS = ['column', 'column_label', 'col']
+NUMERIC_COLUMNS = {'year', 'data'}
+
+# Rows per CSV chunk; bounds peak memory regardless of file size
+DEFAULT_CHUNKSIZE = 250_000
+
+# Parsed-year cache layout; bump CACHE_VERSION when the format changes
+CACHE_DIRNAME = ".cache"
+CACHE_VERSION = 1
+
+def hash_file(path, block_size=1 << 20):
+    """SHA-256 of a file's contents, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def file_year(file_path):
+    """Extracts the survey year from 'herd_{year}_*.csv' / 'herd_{year}.zip'."""
+    match = re.search(r'herd_(\d{4})', os.path.basename(file_path))
+    return int(match.group(1)) if match else None
+
+def list_raw_files(data_dir):
+    """
+    Every raw source in `data_dir`, sorted by year: all `herd_{year}` CSVs,
+    plus the archives of years that have no extracted CSV.
+    """
+    data_dir = Path(data_dir)
+    csv_files = [p for p in sorted(data_dir.glob("herd_*.csv")) if file_year(p)]
+    csv_years = {file_year(p) for p in csv_files}
+    archives = [p for p in sorted(data_dir.glob("herd_*.zip")) if file_year(p) not in csv_years | {None}]
+    return sorted(csv_files + archives, key=lambda p: (file_year(p), p.name))
+
+def first_present(columns, candidates):
+    for c in candidates:
+        if c in columns: return c
+    return None
+
+def main_csv_member(archive):
+    """
+    The survey CSV inside a year's archive. The downloader extracts only this
+    member, so a year reads the same data whether it is kept compressed or not.
+    """
+    members = [name for name in archive.namelist() if name.lower().endswith('.csv')]
+    if not members:
+        raise ValueError(f"no CSV inside {archive.filename}")
+    # The main survey file is the largest member
+    return max(members, key=lambda name: archive.getinfo(name).file_size)
+
+@contextmanager
+def open_raw(file_path):
+    """Binary stream of a raw year, decompressing zip members on the fly."""
+    if str(file_path).endswith('.zip'):
+        with zipfile.ZipFile(file_path) as archive, archive.open(main_csv_member(archive)) as member:
+            yield member
+    else:
+        with open(file_path, 'rb') as f:
+            yield f
+
+def read_raw(file_path, **kwargs):
+    """`pd.read_csv` over a raw year (CSV or archive) with the survey's encoding."""
+    with open_raw(file_path) as f:
+        return pd.read_csv(f, encoding='latin-1', **kwargs)
+
+def raw_header(file_path, cache_dir=None):
+    """Column names of a raw HERD file, as written in the file."""
+    meta = load_cached_meta(file_path, cache_dir) if cache_dir else None
+    if meta:
+        return [c['header'] for c in meta['columns']]
+    return list(read_raw(file_path, nrows=0).columns)
+
+def read_raw_chunks(file_path, columns, chunksize=DEFAULT_CHUNKSIZE, cache_dir=None):
+    """
+    Streams a raw HERD file in bounded chunks, loading only `columns`
+    (matched case-insensitively). Text columns are read as categoricals so
+    repeated labels are stored once per chunk. Yields lowercase-named frames.
+
+    With `cache_dir` the year is served from the parsed-year cache, which is
+    built on first use.
+    """
+    if cache_dir:
+        meta = load_cached_meta(file_path, cache_dir) or build_cache(file_path, cache_dir, chunksize)
+        yield from read_cached_chunks(cache_path(file_path, cache_dir), meta, columns, chunksize)
+        return
+
+    wanted = {c.lower() for c in columns}
+    usecols = [c for c in raw_header(file_path) if c.lower() in wanted]
+    dtype = {c: 'category' for c in usecols if c.lower() not in NUMERIC_COLUMNS}
+
+    with open_raw(file_path) as f:
+        reader = pd.read_csv(f, encoding='latin-1', usecols=usecols, dtype=dtype, chunksize=chunksize)
+        with reader:
+            for chunk in reader:
+                chunk.columns = [c.lower() for c in chunk.columns]
+                yield chunk
+
+# --- Parsed-year cache ---
+
+def default_cache_dir(data_dir):
+    return Path(data_dir) / CACHE_DIRNAME
+
+def cache_path(file_path, cache_dir):
+    return Path(cache_dir) / Path(file_path).name
+
+def _write_meta(path, meta):
+    tmp = path / 'meta.json.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+    tmp.replace(path / 'meta.json')
+
+def load_cached_meta(file_path, cache_dir):
+    """meta.json of the cached parse of `file_path`, or None if missing or stale."""
+    path = cache_path(file_path, cache_dir)
+    try:
+        with open(path / 'meta.json') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('version') != CACHE_VERSION:
+        return None
+
+    # Same size + mtime means same bytes; otherwise compare content hashes
+    stat = os.stat(file_path)
+    if meta['size'] == stat.st_size and meta['mtime'] == stat.st_mtime:
+        return meta
+    if meta['size'] != stat.st_size or meta['sha256'] != hash_file(file_path):
+        return None
+    meta['mtime'] = stat.st_mtime
+    _write_meta(path, meta)
+    return meta
+
+def build_cache(file_path, cache_dir, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Parses a raw year once, in chunks, into the cache and returns its meta.
+    Label codes are kept consistent across chunks by one growing dictionary
+    per column, and arrays are appended to disk chunk by chunk.
+    """
+    target = cache_path(file_path, cache_dir)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(prefix=f"{target.name}.", suffix=".tmp", dir=target.parent))
+    try:
+        stat = os.stat(file_path)
+        sha = hash_file(file_path)
+        header = raw_header(file_path)
+        labels = {c: {} for c in header if c.lower() not in NUMERIC_COLUMNS}
+        integral = {c: True for c in header if c not in labels}
+        n_rows = 0
+
+        outputs = [open(tmp / f"{i}.bin", 'wb') for i in range(len(header))]
+        try:
+            with open_raw(file_path) as f:
+                reader = pd.read_csv(f, encoding='latin-1', dtype={c: 'category' for c in labels},
+                                     chunksize=chunksize)
+                with reader:
+                    for chunk in reader:
+                        for out, name in zip(outputs, header):
+                            column = chunk[name]
+                            if name in labels:
+                                # Re-code this chunk's categories into the file-wide dictionary
+                                seen = labels[name]
+                                recode = [seen.setdefault(label, len(seen)) for label in column.cat.categories]
+                                values = np.array(recode + [-1], dtype=np.int32)[column.cat.codes.to_numpy()]
+                            else:
+                                integral[name] &= pd.api.types.is_integer_dtype(column.dtype)
+                                values = pd.to_numeric(column, errors='coerce').to_numpy(dtype=np.float64)
+                            values.tofile(out)
+                        n_rows += len(chunk)
+        finally:
+            for out in outputs:
+                out.close()
+
+        columns = []
+        for i, name in enumerate(header):
+            entry = {'header': name, 'name': name.lower(), 'file': f"{i}.bin"}
+            if name in labels:
+                entry.update(dtype='int32', categories=list(labels[name]))
+            elif integral[name] and n_rows:
+                # Integer columns were widened per chunk; store them as int64
+                path = tmp / entry['file']
+                np.fromfile(path, dtype=np.float64).astype(np.int64).tofile(path)
+                entry['dtype'] = 'int64'
+            else:
+                entry['dtype'] = 'float64'
+            columns.append(entry)
+
+        meta = {
+            'version': CACHE_VERSION, 'source': Path(file_path).name, 'size': stat.st_size,
+            'mtime': stat.st_mtime, 'sha256': sha, 'rows': n_rows, 'columns': columns,
+        }
+        _write_meta(tmp, meta)
+        shutil.rmtree(target, ignore_errors=True)
+        tmp.replace(target)
+        return meta
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+def _column_array(path, entry, n_rows):
+    if not n_rows:
+        return np.empty(0, dtype=entry['dtype'])
+    return np.memmap(path / entry['file'], dtype=entry['dtype'], mode='r', shape=(n_rows,))
+
+def read_cached_chunks(path, meta, columns, chunksize=DEFAULT_CHUNKSIZE):
+    """Yields lowercase-named frames of `columns` from a cached year, like read_raw_chunks."""
+    wanted = {c.lower() for c in columns}
+    entries = [c for c in meta['columns'] if c['name'] in wanted]
+    arrays = [_column_array(path, c, meta['rows']) for c in entries]
+    dtypes = [pd.CategoricalDtype(c['categories']) if 'categories' in c else None for c in entries]
+
+    for start in range(0, meta['rows'], chunksize):
+        stop = start + chunksize
+        yield pd.DataFrame({
+            c['name']: pd.Categorical.from_codes(array[start:stop], dtype=dtype)
+            if dtype is not None else np.array(array[start:stop])
+            for c, array, dtype in zip(entries, arrays, dtypes)
+        })
+
+def prune_cache(cache_dir, raw_files):
+    """Removes cached years whose raw file is gone, plus unfinished builds."""
+    cache_dir = Path(cache_dir)
+    if not cache_dir.is_dir():
+        return
+    keep = {Path(p).name for p in raw_files}
+    for path in cache_dir.iterdir():
+        if path.name not in keep:
+            shutil.rmtree(path, ignore_errors=True)
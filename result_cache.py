@@ -0,0 +1,92 @@
+"""
+In-memory cache of rendered query results.
+
+Entries are keyed on (database generation, normalized SQL). The generation
+is herd.db's `PRAGMA user_version`, which etl.py bumps on every load, so a
+rebuilt database never serves results cached from the previous one.
+Eviction is least-recently-used, bounded both by entry count and by the
+total size of the cached text.
+"""
+import re
+import threading
+from collections import OrderedDict
+
+# String literals and quoted identifiers are kept verbatim when normalizing
+_QUOTED = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+_COMMENTS = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+_WHITESPACE = re.compile(r"\s+")
+
+def normalize_sql(sql):
+    """
+    Canonical text of a query for cache keys: comments dropped, whitespace
+    collapsed, unquoted text lower-cased, trailing semicolons removed.
+    """
+    parts = _QUOTED.split(sql)
+    for i in range(0, len(parts), 2):
+        parts[i] = _WHITESPACE.sub(" ", _COMMENTS.sub(" ", parts[i])).lower()
+    return "".join(parts).strip().rstrip(";").strip()
+
+def _text_size(value):
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    return sum(_text_size(v) for v in value)
+
+class ResultCache:
+    """Thread-safe LRU of rendered results (a string or a tuple of strings)."""
+
+    def __init__(self, max_entries=256, max_bytes=32 << 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()   # key -> (value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    @staticmethod
+    def key(generation, sql, *extra):
+        """Cache key of a query; `extra` distinguishes e.g. pages of one result."""
+        return (generation, normalize_sql(sql)) + extra
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = _text_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+            }
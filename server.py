@@ -1,16 +1,137 @@
 from fastmcp import FastMCP
-import sqlite3
-import pandas as pd
+import difflib
+import json
+import math
+import threading
+from functools import lru_cache
 from pathlib import Path
+import instrumentation
+from formatting import markdown_table
+from query_engine import QueryNotAllowed, decode_page_token
+from result_cache import ResultCache
+import storage
+import summaries
 
 # Initialize the MCP Server
 mcp = FastMCP("HERD-Data-Server")
 
-# Path to the database we built in step 2
-DB_PATH = Path(__file__).parent / "herd.db"
+# The database we built in step 2: herd.db, or $HERD_DATABASE (see storage.py)
+DB_PATH = storage.default_database(Path(__file__).parent / "herd.db")
+store = storage.open_storage(DB_PATH)
+
+# Pooled read-only connections; queries run off the event loop
+engine = store.engine()
+
+# Rendered results by (load generation, normalized SQL)
+result_cache = ResultCache()
+
+# Startup only defines the tools: results are rendered without pandas, and
+# config.yml is read on the first call that needs it.
+
+# Memory-mapped metric snapshot of the current load (see snapshot.py):
+# (load generation, Snapshot, or None while it is being built)
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+async def current_snapshot():
+    """
+    The snapshot for the current herd.db load, or None while it is being
+    built. NumPy is imported on first use; a new load swaps it, and if
+    etl.py has not written a matching one it is built from herd.db in a
+    background thread, so no tool call waits for the full read. The load
+    generation is read and the snapshot opened on the engine's threads.
+    """
+    generation = await engine.run_generation()
+    current = _snapshot
+    if current is not None and current[0] == generation:
+        return current[1]
+    return await engine.run_call(_load_snapshot, generation)
+
+def _load_snapshot(generation):
+    global _snapshot
+    import snapshot
+    with _snapshot_lock:
+        if _snapshot is None or _snapshot[0] != generation:
+            _snapshot = (generation, snapshot.load_snapshot(store, generation))
+            if _snapshot[1] is None:
+                threading.Thread(target=_build_snapshot, args=(generation,), daemon=True).start()
+        return _snapshot[1]
+
+def _build_snapshot(generation):
+    global _snapshot
+    import snapshot
+    try:
+        built = snapshot.Snapshot.build(store)
+    except Exception:
+        return  # lookups keep using SQL until the next load
+    with _snapshot_lock:
+        if _snapshot == (generation, None) and built.generation == generation:
+            _snapshot = (generation, built)
+
+async def lookup_snapshot(metric, inst_ids=(), group=None):
+    """The current snapshot, or until it is built, just `metric` for the institutions asked about, read with SQL."""
+    snap = await current_snapshot()
+    if snap is None:
+        import snapshot
+        snap = await snapshot.fetch_snapshot(engine, metric, inst_ids, group)
+    return snap
+
+# Alias index of the current load's institution names (see name_index.py)
+_names = None
+_names_lock = threading.Lock()
+
+async def current_names():
+    """
+    The AliasIndex for the current herd.db load, read again (on the engine's
+    threads) after a new load.
+    """
+    generation = await engine.run_generation()
+    current = _names
+    if current is not None and current[0] == generation:
+        return current[1]
+    return await engine.run_call(_load_names, generation)
+
+def _load_names(generation):
+    global _names
+    import name_index
+    with _names_lock:
+        if _names is None or _names[0] != generation:
+            _names = (generation, name_index.AliasIndex.load(engine.execute))
+        return _names[1]
+
+def unknown_metric(snap, metric):
+    matches = difflib.get_close_matches(metric, snap.metrics.tolist(), n=3, cutoff=0.6)
+    hint = f" Did you mean: {', '.join(matches)}?" if matches else " See data_dictionary for column names."
+    return f"Error: Unknown metric '{metric}'.{hint}"
+
+def metric_table(snap, inst_ids, metric, years):
+    """(columns, rows) with one row per institution and one column per year."""
+    found_years, values = snap.get_metric(inst_ids, metric, years)
+    columns = ['inst_id', 'name'] + [str(y) for y in found_years.tolist()]
+    rows = [(inst_id, snap.institution(inst_id)[0]) + tuple(row) for inst_id, row in zip(inst_ids, values.tolist())]
+    return columns, rows
+
+@lru_cache(maxsize=1)
+def cagr_columns():
+    """Growth columns for `analysis.default_period` in config.yml."""
+    config = summaries.load_config()
+    return {'5-year': ['cagr_5yr'], '10-year': ['cagr_10yr']}.get(
+        (config.get('analysis') or {}).get('default_period'), ['cagr_5yr', 'cagr_10yr'])
+
+def render_page(page):
+    """Markdown table of a page, plus notes on what was cut off."""
+    result = markdown_table(page.columns, page.rows)
+    notes = []
+    if page.hidden_columns:
+        notes.append(f"{len(page.hidden_columns)} more columns omitted; select fewer columns to see them.")
+    if page.more_rows:
+        last = page.offset + len(page.rows)
+        notes.append(f"Showing rows {page.offset + 1}-{last}; more rows available. "
+                     f"Call again with page_token='{page.next_token}' for the next page.")
+    return "\n\n".join([result] + notes)
 
 @mcp.tool()
-def query_herd_data(sql_query: str) -> str:
+async def query_herd_data(sql_query: str = "", page_token: str = "") -> str:
     """
     Executes a SQL query on the NSF HERD Higher Education R&D Survey database.
     
@@ -21,18 +142,207 @@ def query_herd_data(sql_query: str) -> str:
     - city (TEXT), state (TEXT), year (INTEGER)
     - federal (INTEGER): Federal R&D expenditures (in dollars)
     - total_rd (INTEGER): Total R&D expenditures (in dollars)
+
+    To find an institution's inst_id from a name or abbreviation, call
+    resolve_institution first, or filter on the institution_search table
+    (trigram index of lower-cased names and aliases):
+    WHERE inst_id IN (SELECT inst_id FROM institution_search WHERE alias_key LIKE '%a&m%')
+
+    Results are capped at 200 rows and 40 columns per call. When more rows
+    exist, the reply ends with a page_token; pass it (without sql_query) to
+    get the next page. Use ORDER BY so pages are stable.
+    """
+    instrumentation.count("tool_calls", tool="query_herd_data")
+    try:
+        generation = await engine.run_generation()
+        offset = 0
+        if page_token:
+            sql_query, offset, token_generation = decode_page_token(page_token)
+            if token_generation != generation:
+                return "Error: The database was reloaded since this page token was issued. Run the query again."
+
+        key = result_cache.key(generation, sql_query, offset)
+        cached = result_cache.get(key)
+        if cached is not None:
+            instrumentation.count("result_cache_hits", tool="query_herd_data")
+            return cached
+
+        with instrumentation.span("sql_exec", tool="query_herd_data"):
+            page = await engine.run_page(sql_query, offset)
+        with instrumentation.span("render", tool="query_herd_data"):
+            result = render_page(page)
+        result_cache.put(key, result)
+        return result
+    except QueryNotAllowed as e:
+        return f"Error: {e}"
+    except Exception as e:
+        return f"SQL Error: {str(e)}"
+
+@mcp.tool()
+async def institution_trends(inst_id: str, metric: str = "src_total") -> str:
+    """
+    Year-by-year trend of one metric for one institution from the precomputed
+    metric_trends table: value (dollars), year-over-year change and %,
+    compound annual growth rate, and rank within its state and nationally.
+    `metric` is a column name from data_dictionary (e.g. 'src_total',
+    'src_federal_government').
     """
-    # Security: Prevent modification
-    if any(cmd in sql_query.upper() for cmd in ["DROP", "DELETE", "INSERT", "UPDATE", "ALTER"]):
-        return "Error: Read-only access. Only SELECT queries are allowed."
+    instrumentation.count("tool_calls", tool="institution_trends")
+    cagr = "".join(f", t.{c}" for c in cagr_columns())
+    try:
+        with instrumentation.span("sql_exec", tool="institution_trends"):
+            columns, rows = await engine.run(f"""
+                SELECT y.name, t.year, t.value, t.yoy_change, t.yoy_pct{cagr}, t.state_rank, t.national_rank
+                FROM data_dictionary d
+                JOIN metric_trends t ON t.metric_id = d.metric_id
+                JOIN institution_years y ON y.year = t.year AND y.inst_id = t.inst_id
+                WHERE d.column_name = ? AND t.inst_id = ?
+                ORDER BY t.year
+            """, (metric, inst_id))
+    except Exception as e:
+        return f"SQL Error: {str(e)}"
+    if not rows:
+        return f"No reported values of '{metric}' for inst_id '{inst_id}'."
+    with instrumentation.span("render", tool="institution_trends"):
+        return markdown_table(columns, rows)
 
+@mcp.tool()
+async def peer_group_comparison(group: str = "texas", metric: str = "src_total", year: int = 0) -> str:
+    """
+    Compares the home institution with a peer group from config.yml (e.g.
+    'texas', 'national') on one metric, from the precomputed peer_group_stats
+    table: peer count, total, mean, min, max, the home value and its rank in
+    the group, followed by every member's value. `year` 0 means the latest.
+    """
+    instrumentation.count("tool_calls", tool="peer_group_comparison")
     try:
-        conn = sqlite3.connect(DB_PATH)
-        df = pd.read_sql(sql_query, conn)
-        conn.close()
-        return df.to_markdown(index=False)
+        with instrumentation.span("sql_exec", tool="peer_group_comparison"):
+            _, stats = await engine.run("""
+                SELECT s.year, s.n_peers, s.peer_total, s.peer_mean, s.peer_min, s.peer_max, s.home_value, s.home_rank
+                FROM data_dictionary d
+                JOIN peer_group_stats s ON s.metric_id = d.metric_id
+                WHERE s.group_name = ? AND d.column_name = ? AND (? = 0 OR s.year = ?)
+                ORDER BY s.year DESC LIMIT 1
+            """, (group, metric, year, year))
+            if not stats:
+                _, groups = await engine.run("SELECT DISTINCT group_name FROM peer_groups ORDER BY group_name")
+                return (f"No peer statistics for group '{group}', metric '{metric}'"
+                        f"{f', year {year}' if year else ''}. Groups: {', '.join(g for g, in groups)}.")
+
+            year, n_peers, total, mean, low, high, home_value, home_rank = stats[0]
+            columns, members = await engine.run("""
+                SELECT g.name, g.inst_id, g.is_home, COALESCE(t.value, 0) AS value, t.yoy_pct, t.national_rank
+                FROM peer_groups g
+                LEFT JOIN data_dictionary d ON d.column_name = ?
+                LEFT JOIN metric_trends t ON t.metric_id = d.metric_id AND t.inst_id = g.inst_id AND t.year = ?
+                WHERE g.group_name = ?
+                ORDER BY value DESC
+            """, (metric, year, group))
     except Exception as e:
         return f"SQL Error: {str(e)}"
 
+    rank = f"rank {home_rank} of {n_peers + 1}" if home_rank else "not reported"
+    summary = (f"**{metric}, {group} peers, {year}**: {n_peers} peers, total {total:,.0f}, "
+               f"mean {mean:,.0f}, min {low:,.0f}, max {high:,.0f}. "
+               f"Home value {home_value or 0:,.0f} ({rank}).")
+    with instrumentation.span("render", tool="peer_group_comparison"):
+        return summary + "\n\n" + markdown_table(columns, members)
+
+@mcp.tool()
+async def get_metric(inst_ids: list[str], metric: str = "src_total", years: list[int] = []) -> str:
+    """
+    Values of one metric (a column name from data_dictionary, e.g.
+    'src_total') for one or more institutions, one column per year (`years`
+    empty means every year). Served from an in-memory snapshot without SQL.
+    A blank cell means the institution was not surveyed that year; 0 means
+    it reported nothing for the metric.
+    """
+    instrumentation.count("tool_calls", tool="get_metric")
+    with instrumentation.span("lookup", tool="get_metric"):
+        snap = await lookup_snapshot(metric, inst_ids=inst_ids)
+        if not snap.has_metric(metric):
+            return unknown_metric(snap, metric)
+        known = [i for i in dict.fromkeys(inst_ids) if snap.has_institution(i)]
+        unknown = [i for i in inst_ids if not snap.has_institution(i)]
+        if not known:
+            return f"No institutions found for inst_ids {', '.join(inst_ids) or '(none)'}."
+        columns, rows = metric_table(snap, known, metric, years)
+    with instrumentation.span("render", tool="get_metric"):
+        result = markdown_table(columns, rows)
+        if unknown:
+            result += f"\n\nUnknown inst_ids: {', '.join(unknown)}."
+        return result
+
+@mcp.tool()
+async def compare_peers(group: str = "texas", metric: str = "src_total", years: list[int] = []) -> str:
+    """
+    One metric for every member of a peer group from config.yml (e.g.
+    'texas', 'national') and the home institution, one column per year
+    (`years` empty means every year), sorted by the latest year's value, with
+    the home institution's rank. Served from an in-memory snapshot without SQL.
+    """
+    instrumentation.count("tool_calls", tool="compare_peers")
+    with instrumentation.span("lookup", tool="compare_peers"):
+        snap = await lookup_snapshot(metric, group=group)
+        if group not in snap.groups:
+            return f"Error: Unknown peer group '{group}'. Groups: {', '.join(sorted(snap.groups))}."
+        if not snap.has_metric(metric):
+            return unknown_metric(snap, metric)
+        members = [(i, home) for i, home in snap.groups[group] if snap.has_institution(i)]
+        if not members:
+            return f"No members of peer group '{group}' are in the database."
+        columns, rows = metric_table(snap, [i for i, _ in members], metric, years)
+        if len(columns) == 2:
+            return f"No data for the years {', '.join(map(str, years))}."
+        columns.insert(2, 'home')
+        rows = [row[:2] + ('yes' if home else '',) + row[2:] for row, (_, home) in zip(rows, members)]
+
+    # Largest value in the latest year first; members not surveyed that year go last
+    latest = columns[-1]
+    surveyed = sorted((row for row in rows if not math.isnan(row[-1])), key=lambda row: -row[-1])
+    rows = surveyed + [row for row in rows if math.isnan(row[-1])]
+    home = next((k for k, row in enumerate(surveyed) if row[2]), None)
+    rank = f"home rank {home + 1} of {len(surveyed)}" if home is not None else "home institution not surveyed"
+    with instrumentation.span("render", tool="compare_peers"):
+        return (f"**{metric}, {group} peers**: {len(surveyed)} surveyed in {latest}, {rank}.\n\n"
+                + markdown_table(columns, rows))
+
+@mcp.tool()
+async def resolve_institution(text: str, limit: int = 5) -> str:
+    """
+    Finds institutions by name, former name, or abbreviation (e.g. 'UTRGV',
+    'Texas A&M', 'univ of north texas'; misspellings are tolerated) and
+    returns their inst_id, current name and state with a match score
+    (1 = exact alias). Use the inst_id in other tools and SQL instead of
+    matching on name.
+    """
+    instrumentation.count("tool_calls", tool="resolve_institution")
+    try:
+        with instrumentation.span("lookup", tool="resolve_institution"):
+            names = await current_names()
+            matches = await engine.run_call(names.resolve, text, max(1, min(limit, 50)))
+    except Exception as e:
+        return f"Error: Name index unavailable ({e}). Rebuild herd.db with etl.py."
+    if not matches:
+        return f"No institution matches '{text}'."
+    with instrumentation.span("render", tool="resolve_institution"):
+        return markdown_table(['inst_id', 'name', 'state', 'matched', 'score'], matches)
+
+@mcp.tool()
+def query_cache_stats() -> str:
+    """
+    Hit/miss/eviction counters and current size of the query result cache
+    (results are cached per database load, so a rebuilt herd.db starts cold).
+    """
+    return json.dumps(result_cache.stats(), indent=2)
+
+@mcp.tool()
+def server_metrics() -> str:
+    """
+    Tool call counts and time spent per stage (SQL execution, rendering) in
+    the Prometheus text format.
+    """
+    return instrumentation.recorder.prometheus()
+
 if __name__ == "__main__":
     mcp.run()
\ No newline at end of file
@@ -0,0 +1,258 @@
+"""
+Memory-mapped snapshot of herd.db for point lookups of one metric.
+
+server.py's `get_metric` and `compare_peers` tools read values straight from
+a dense cube instead of going through SQL:
+
+    values[metric, institution, year]
+
+It is metric-major, so a lookup (one metric, a few institutions, a range of
+years) touches one small block. A value is NaN when the institution is not
+in the survey that year and 0 when it is but reported nothing for the
+metric, as in the `institutions` table.
+
+etl.py writes it next to herd.db (the backend's `artifact_path`, see
+storage.py) after every load:
+- `herd.snapshot.npz`: the labels (inst_ids, names, states, years, metric
+  names), peer groups, the load generation and the name of the cube file;
+- `herd.snapshot.<generation>.npy`: the float64 cube, opened with
+  `mmap_mode='r'`, so every server process shares one copy in the page
+  cache and only the pages a lookup touches are ever read.
+
+The cube file is named per load generation and the labels file is replaced
+last, so a reader never pairs the labels of one load with the cube of
+another. When no saved snapshot matches the load, the server builds one in
+a background thread and meanwhile answers from `fetch_snapshot`, which
+reads just the metric and institutions asked about.
+"""
+import os
+from pathlib import Path
+
+import numpy as np
+
+import storage
+
+def snapshot_path(db_path):
+    db_path = Path(db_path)
+    return db_path.with_name(db_path.stem + ".snapshot.npz")
+
+def _cube_path(db_path, generation):
+    db_path = Path(db_path)
+    return db_path.with_name(f"{db_path.stem}.snapshot.{generation}.npy")
+
+def _read_cells(conn, metrics):
+    """
+    (cube rows, inst_ids, years, values) of every stored value, shaped for
+    one fancy-indexed assignment: values is [metric, cell] for the wide
+    table, or one value per herd_facts row. The wide table, when there is
+    one, reads several times faster than one facts row per value.
+    """
+    codes = {storage.column_name(storage.dialect(conn), name): i for i, name in enumerate(metrics)}
+    if storage.table_type(conn, 'institutions') == 'table':
+        columns = [c for c in storage.table_columns(conn, 'institutions') if c in codes]
+        selected = "".join(f', "{c}"' for c in columns)
+        rows = conn.execute(f"SELECT inst_id, year{selected} FROM institutions").fetchall()
+        if rows and columns:
+            values = np.nan_to_num(np.array([row[2:] for row in rows], dtype=float).T)
+            return (np.array([codes[c] for c in columns])[:, None],
+                    [row[0] for row in rows], [row[1] for row in rows], values)
+        return [], [], [], []
+
+    codes = {name: i for i, name in enumerate(metrics)}
+    facts = conn.execute("""
+        SELECT d.column_name, f.inst_id, f.year, f.value
+        FROM herd_facts f JOIN data_dictionary d ON d.metric_id = f.metric_id
+    """).fetchall()
+    if not facts:
+        return [], [], [], []
+    names, ids, years, values = zip(*facts)
+    return np.array([codes[n] for n in names]), ids, years, np.array(values, dtype=float)
+
+_MEMBERS = "SELECT group_name, inst_id, is_home FROM peer_groups ORDER BY group_name, is_home DESC, inst_id"
+
+class Snapshot:
+    """Dense (metric, institution, year) values of one herd.db load."""
+
+    def __init__(self, generation, values, inst_ids, names, states, years, metrics, groups):
+        self.generation = generation
+        self.values = values              # float64 [metric, institution, year]
+        self.inst_ids = inst_ids          # sorted
+        self.names = names                # latest name per institution
+        self.states = states
+        self.years = years                # sorted
+        self.metrics = metrics            # data_dictionary column names
+        self.groups = groups              # {group: [(inst_id, is_home)]}, home first
+        self._inst_codes = {inst_id: i for i, inst_id in enumerate(inst_ids.tolist())}
+        self._year_codes = {year: i for i, year in enumerate(years.tolist())}
+        self._metric_codes = {metric: i for i, metric in enumerate(metrics.tolist())}
+
+    @classmethod
+    def build(cls, database):
+        """Reads the current load of `database` (a path, URL or storage backend) into memory."""
+        with storage.open_storage(database).connect(readonly=True) as conn:
+            generation = storage.read_generation(conn)
+            identity = conn.execute("SELECT inst_id, name, state, year FROM institution_years ORDER BY year").fetchall()
+            metrics = [name for name, in conn.execute("SELECT column_name FROM data_dictionary ORDER BY metric_id")]
+            cells = _read_cells(conn, metrics)
+            members = []
+            if storage.table_type(conn, 'peer_groups'):
+                members = conn.execute(_MEMBERS).fetchall()
+        return cls.assemble(generation, identity, metrics, cells, members)
+
+    @classmethod
+    def assemble(cls, generation, identity, metrics, cells, members, years=None):
+        """
+        A snapshot from query results: (inst_id, name, state, year) rows
+        ordered by year, the metric names, cells shaped as by _read_cells,
+        and (group, inst_id, is_home) peer group members. The year axis is
+        `years`, or every year in `identity`.
+        """
+        latest = {inst_id: (name, state) for inst_id, name, state, _ in identity}
+        inst_ids = np.array(sorted(latest), dtype=str)
+        years = np.array(sorted(set(years) if years is not None else {row[3] for row in identity}), dtype=np.int64)
+
+        values = np.full((len(metrics), len(inst_ids), len(years)), np.nan)
+        if identity:
+            ids, _, _, id_years = zip(*identity)
+            values[:, np.searchsorted(inst_ids, ids), np.searchsorted(years, id_years)] = 0.0
+        metric_rows, ids, cell_years, cell_values = cells
+        if len(ids):
+            values[metric_rows, np.searchsorted(inst_ids, ids), np.searchsorted(years, cell_years)] = cell_values
+
+        groups = {}
+        for group_name, inst_id, is_home in members:
+            groups.setdefault(group_name, []).append((inst_id, bool(is_home)))
+        return cls(
+            generation=generation, values=values, inst_ids=inst_ids,
+            names=np.array([latest[i][0] or "" for i in inst_ids.tolist()], dtype=str),
+            states=np.array([latest[i][1] or "" for i in inst_ids.tolist()], dtype=str),
+            years=years, metrics=np.array(metrics, dtype=str), groups=groups,
+        )
+
+    def save(self, db_path):
+        """Writes the cube, then the labels, then drops cubes of older loads."""
+        cube = _cube_path(db_path, self.generation)
+        tmp = cube.with_name(cube.name + ".tmp")
+        with open(tmp, 'wb') as f:
+            np.save(f, np.ascontiguousarray(self.values))
+        os.replace(tmp, cube)
+
+        members = [(group, inst_id, is_home) for group, rows in self.groups.items() for inst_id, is_home in rows]
+        labels = snapshot_path(db_path)
+        tmp = labels.with_name(labels.name + ".tmp")
+        with open(tmp, 'wb') as f:
+            np.savez(
+                f, generation=np.array(self.generation), cube=np.array(cube.name),
+                inst_ids=self.inst_ids, names=self.names, states=self.states, years=self.years,
+                metrics=self.metrics,
+                group_names=np.array([m[0] for m in members], dtype=str),
+                group_inst_ids=np.array([m[1] for m in members], dtype=str),
+                group_home=np.array([m[2] for m in members], dtype=bool),
+            )
+        os.replace(tmp, labels)
+
+        for old in cube.parent.glob(f"{Path(db_path).stem}.snapshot.*.npy"):
+            if old != cube:
+                try:
+                    old.unlink()  # processes that mapped it keep their copy
+                except OSError:
+                    pass
+
+    @classmethod
+    def load(cls, db_path):
+        """Labels into memory, the cube memory-mapped read-only."""
+        path = snapshot_path(db_path)
+        with np.load(path, allow_pickle=False) as data:
+            labels = {name: data[name] for name in data.files}
+        values = np.load(path.with_name(str(labels['cube'])), mmap_mode='r')
+        shape = (len(labels['metrics']), len(labels['inst_ids']), len(labels['years']))
+        if values.shape != shape:
+            raise ValueError(f"snapshot cube has shape {values.shape}, labels expect {shape}")
+
+        groups = {}
+        for group_name, inst_id, is_home in zip(labels['group_names'].tolist(), labels['group_inst_ids'].tolist(),
+                                                labels['group_home'].tolist()):
+            groups.setdefault(group_name, []).append((inst_id, is_home))
+        return cls(
+            generation=int(labels['generation']), values=values, inst_ids=labels['inst_ids'],
+            names=labels['names'], states=labels['states'], years=labels['years'],
+            metrics=labels['metrics'], groups=groups,
+        )
+
+    # --- Lookups ---
+
+    def has_metric(self, metric):
+        return metric in self._metric_codes
+
+    def has_institution(self, inst_id):
+        return inst_id in self._inst_codes
+
+    def institution(self, inst_id):
+        """(name, state) of a known inst_id."""
+        i = self._inst_codes[inst_id]
+        return str(self.names[i]), str(self.states[i])
+
+    def get_metric(self, inst_ids, metric, years=None):
+        """
+        (years, values) for `metric`: one row per inst_id, one column per
+        year (all years by default; years outside the snapshot are skipped).
+        Raises KeyError for an unknown metric or inst_id.
+        """
+        rows = [self._inst_codes[inst_id] for inst_id in inst_ids]
+        block = self.values[self._metric_codes[metric]]
+        if years:
+            columns = [self._year_codes[y] for y in sorted(set(years)) if y in self._year_codes]
+        else:
+            columns = list(range(len(self.years)))
+        return self.years[columns], block[np.ix_(rows, columns)]
+
+def build_snapshot(database):
+    """Builds the snapshot of the load in `database` and saves it next to its artifact_path."""
+    db = storage.open_storage(database)
+    snapshot = Snapshot.build(db)
+    snapshot.save(db.artifact_path)
+    return snapshot
+
+def load_snapshot(database, generation=None):
+    """The saved snapshot when it matches load `generation` (any load if None), else None."""
+    db = storage.open_storage(database)
+    try:
+        snapshot = Snapshot.load(db.artifact_path)
+    except (OSError, ValueError, KeyError):
+        return None
+    if generation is None or snapshot.generation == generation:
+        return snapshot
+    return None
+
+async def fetch_snapshot(engine, metric, inst_ids=(), group=None):
+    """
+    A snapshot of `metric` alone for `inst_ids`, or the members of peer
+    `group`, read through `engine` with indexed queries. The server answers
+    lookups from it while the full snapshot is still being built. When
+    `metric` or `group` is unknown, it holds just the metric and group names
+    so the caller can list what exists.
+    """
+    generation = await engine.run_generation()
+    _, rows = await engine.run("SELECT column_name FROM data_dictionary ORDER BY metric_id")
+    metrics = [name for name, in rows]
+    _, members = await engine.run(_MEMBERS)
+    if group is not None:
+        inst_ids = [inst_id for name, inst_id, _ in members if name == group]
+    inst_ids = list(dict.fromkeys(inst_ids))
+    if metric not in metrics or not inst_ids:
+        return Snapshot.assemble(generation, [], metrics, ([], [], [], []), members)
+
+    _, years = await engine.run("SELECT DISTINCT year FROM institution_years")
+    marks = ", ".join("?" * len(inst_ids))
+    _, identity = await engine.run(
+        f"SELECT inst_id, name, state, year FROM institution_years WHERE inst_id IN ({marks}) ORDER BY year", inst_ids
+    )
+    column = storage.column_name(engine.dialect, metric)
+    _, rows = await engine.run(f'SELECT inst_id, year, "{column}" FROM institutions WHERE inst_id IN ({marks})',
+                               inst_ids)
+    cells = ([], [], [], [])
+    if rows:
+        ids, cell_years, values = zip(*rows)
+        cells = (np.zeros(len(rows), dtype=np.int64), ids, cell_years,
+                 np.nan_to_num(np.array(values, dtype=float)))
+    return Snapshot.assemble(generation, identity, [metric], cells, members, [year for year, in years])
@@ -0,0 +1,150 @@
+"""
+Pre-execution checks for LLM-generated SQL.
+
+`SQLValidator.validate` runs before a generated query touches any data:
+
+1. One statement only.
+2. The database plans it (`EXPLAIN QUERY PLAN` on SQLite, `EXPLAIN` on
+   PostgreSQL), which parses it and resolves every table and column against
+   the real schema without reading a row. Unknown names are reported with
+   the closest names from a schema snapshot cached per database load, so a
+   repair prompt can fix them.
+3. The plan is checked: a nested loop over two full table scans (a join
+   with no usable condition) is rejected, and any other full scan without a
+   top-level LIMIT gets `LIMIT max_rows + 1` appended (one row past a page,
+   so a cut result is still reported as having more rows).
+
+Errors the model can plausibly fix are raised as `InvalidSQL` with
+`fixable=True`; writes denied by the engine's authorizer are not.
+"""
+import difflib
+import re
+import threading
+from collections import defaultdict
+
+import instrumentation
+from query_engine import DEFAULT_MAX_ROWS, QueryNotAllowed, blank_quoted, strip_comments
+
+_LIMIT = re.compile(r"\blimit\b", re.IGNORECASE)
+_TABLE_REF = re.compile(r"(?:\bfrom|\bjoin|,)\s*(\w+)(?:\s+(?:as\s+)?(\w+))?", re.IGNORECASE)
+_FULL_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)$")
+# SQLite's and PostgreSQL's messages for a name that does not resolve
+_UNKNOWN = re.compile(r'no such (column|table): (\S+)|(column|relation) "?([\w.]+)"? does not exist')
+
+_KEYWORDS = {'from', 'select', 'where', 'join', 'on', 'left', 'right', 'inner', 'outer', 'cross', 'natural',
+             'full', 'group', 'order', 'limit', 'having', 'union', 'except', 'intersect', 'window', 'using'}
+
+def _top_level(text):
+    """`text` with everything inside parentheses blanked, so a subquery's LIMIT is not the query's."""
+    out, depth = [], 0
+    for ch in text:
+        if ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth = max(depth - 1, 0)
+        out.append(ch if depth == 0 or ch in '()' else ' ')
+    return "".join(out)
+
+class InvalidSQL(ValueError):
+    """A generated statement failed validation; `fixable` if worth a repair prompt."""
+
+    def __init__(self, message, fixable=True):
+        super().__init__(message)
+        self.fixable = fixable
+
+class SQLValidator:
+    """Validates and bounds SELECTs against the database behind `engine`."""
+
+    def __init__(self, engine, max_rows=DEFAULT_MAX_ROWS):
+        self.engine = engine
+        self.max_rows = max_rows
+        self._schema = (None, {})    # (load generation, {table or view: [columns]})
+        self._lock = threading.Lock()
+        self.counts = {'checked': 0, 'passed': 0, 'limited': 0, 'rejected': 0, 'repaired': 0}
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def schema(self):
+        """Tables and views with their columns, read once per database load."""
+        generation = self.engine.generation()
+        if self._schema[0] != generation:
+            self._schema = (generation, self.engine.schema())
+        return self._schema[1]
+
+    def _suggest(self, kind, name):
+        tables = self.schema()
+        if kind == 'table':
+            candidates = list(tables)
+        else:
+            name = name.split('.')[-1]
+            candidates = sorted({c for columns in tables.values() for c in columns})
+        matches = difflib.get_close_matches(name, candidates, n=3, cutoff=0.6)
+        return f" (did you mean: {', '.join(matches)}?)" if matches else ""
+
+    def _plan(self, sql):
+        try:
+            with instrumentation.span("sql_plan"):
+                return self.engine.explain(sql)
+        except QueryNotAllowed as e:
+            raise InvalidSQL(str(e), fixable=False) from e
+        except self.engine.Error as e:
+            # First line only: PostgreSQL adds the statement and a caret below it
+            message = str(e).strip().split("\n")[0]
+            unknown = _UNKNOWN.search(message)
+            if unknown:
+                kind, name = unknown.group(1, 2) if unknown.group(1) else unknown.group(3, 4)
+                message += self._suggest('table' if kind == 'relation' else kind, name)
+            raise InvalidSQL(message) from e
+
+    def validate(self, sql):
+        """
+        Returns `sql` without comments, possibly with a LIMIT appended, or
+        raises InvalidSQL. Nothing but the query plan is computed.
+        """
+        self.count('checked')
+        try:
+            # Dropping comments first keeps an appended LIMIT out of a trailing `-- ...`
+            sql = strip_comments(sql).strip().rstrip(';').strip()
+            text = blank_quoted(sql)
+            if not sql:
+                raise InvalidSQL("empty statement")
+            if ';' in text:
+                raise InvalidSQL("more than one statement; return a single SELECT")
+
+            plan = self._plan(sql)
+            tables = self.schema()
+            # Aliases in the plan resolve to the tables named in FROM / JOIN
+            aliases = {}
+            for table, alias in _TABLE_REF.findall(text):
+                aliases[table] = table
+                if alias and alias.lower() not in _KEYWORDS:
+                    aliases[alias] = table
+
+            scans = defaultdict(list)
+            for parent, detail in plan:
+                scan = _FULL_SCAN.match(detail)
+                if scan and aliases.get(scan.group(1), scan.group(1)) in tables:
+                    scans[parent].append(scan.group(1))
+            for scanned in scans.values():
+                if len(scanned) > 1:
+                    raise InvalidSQL(f"joins {' and '.join(scanned)} without a usable join condition "
+                                     f"(nested full table scans); join on inst_id and year")
+        except InvalidSQL:
+            self.count('rejected')
+            raise
+
+        if scans and not _LIMIT.search(_top_level(text)):
+            self.count('limited')
+            # One row more than fetch_page shows, so it still reports more_rows
+            return f"{sql} LIMIT {self.max_rows + 1};"
+        self.count('passed')
+        return sql + ";"
+
+    def summary(self):
+        c = self.counts
+        # A rejected statement is a failing (or runaway) execution that never
+        # ran; a repaired one was answered without the user asking again.
+        return (f"{c['checked']} checked, {c['limited']} bounded with LIMIT, {c['rejected']} rejected before "
+                f"running (DB round-trips saved), {c['repaired']} repaired in one LLM call (user retries saved)")
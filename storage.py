@@ -0,0 +1,158 @@
+"""
+Storage backends behind etl.py, server.py and local_agent.py.
+
+`open_storage` picks one from where the data lives:
+
+- a file path (`herd.db`, the default) or `sqlite:///path/herd.db`:
+  `SQLiteStorage`. Loads go through a staging copy that is renamed over the
+  file (bulk_loader.staging_database); reads through QueryEngine's pool.
+- `postgresql://user@host:5432/dbname?schema=herd`: `PostgresStorage`
+  (postgres_storage.py; psycopg2 is only imported then). Loads COPY into
+  tables partitioned by survey year; reads through a pool of read-only
+  connections.
+
+Both backends offer the same calls:
+
+- `load(fresh)`: context manager yielding the connection of one load
+  transaction. Readers keep seeing the previous load until it commits, and
+  every load bumps the load generation result caches key on.
+- `connect(readonly)`: context manager for etl.py's own reads (manifest)
+  and in-place manifest updates; commits on success.
+- `generation()`, `exists()`, `engine(pool_size)` (the read engine the
+  server and agent query through).
+- `artifact_path`: files derived from a load (column index, snapshot, SQL
+  memo) are named after it, e.g. `herd.columns.npz`.
+
+Load code is written once: connections of either backend take SQLite-style
+`?` parameters, and `dialect(conn)` tells the few places that differ
+(partitions, COPY, full-text search) which one they are on. `tables`,
+`table_columns` and `table_type` read the schema of either, and
+`column_name` gives a metric's column in the wide table (PostgreSQL limits
+identifiers to 63 bytes; some metric names are longer).
+
+Setting `HERD_DATABASE` points every entry point at another database.
+"""
+import hashlib
+import os
+import sqlite3
+from contextlib import closing, contextmanager
+from pathlib import Path
+
+DATABASE_ENV = "HERD_DATABASE"
+
+# PostgreSQL truncates longer identifiers (NAMEDATALEN - 1)
+MAX_IDENTIFIER = 63
+
+def default_database(path):
+    """`$HERD_DATABASE` when set, else `path`."""
+    return os.environ.get(DATABASE_ENV) or path
+
+def open_storage(database):
+    """
+    The backend for `database`: a postgresql:// URL, a SQLite path or
+    sqlite:/// URL, or a backend object, which is returned as is.
+    """
+    if hasattr(database, 'engine'):
+        return database
+    location = os.fspath(database)
+    if location.startswith(('postgresql://', 'postgres://')):
+        from postgres_storage import PostgresStorage
+        return PostgresStorage(location)
+    if location.startswith('sqlite:///'):
+        location = location[len('sqlite:///'):]
+    return SQLiteStorage(location)
+
+# --- Schema helpers for connections of either backend ---
+
+def dialect(conn):
+    """'postgresql' for a postgres_storage connection, else 'sqlite'."""
+    return getattr(conn, 'dialect', 'sqlite')
+
+def tables(conn):
+    """{name: 'table' or 'view'} of the data tables (no SQLite internals, no year partitions)."""
+    if dialect(conn) == 'postgresql':
+        rows = conn.execute("""
+            SELECT c.relname, CASE c.relkind WHEN 'v' THEN 'view' ELSE 'table' END
+            FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = current_schema() AND c.relkind IN ('r', 'p', 'v') AND NOT c.relispartition
+            ORDER BY c.relname
+        """)
+    else:
+        rows = conn.execute(
+            "SELECT name, type FROM sqlite_master WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite_%'"
+        )
+    return dict(rows.fetchall())
+
+def table_type(conn, name):
+    """'table', 'view', or None if `name` does not exist."""
+    return tables(conn).get(name)
+
+def table_columns(conn, table):
+    if dialect(conn) == 'postgresql':
+        rows = conn.execute("""
+            SELECT attname FROM pg_attribute
+            WHERE attrelid = to_regclass(quote_ident(?)) AND attnum > 0 AND NOT attisdropped
+            ORDER BY attnum
+        """, (table,))
+        return [name for name, in rows]
+    return [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+
+def column_name(dialect, metric):
+    """
+    Column of `metric` in the wide table: its name, or on PostgreSQL, when
+    that is too long, the start of it plus a hash of the whole name (a plain
+    cut would make some metrics collide).
+    """
+    if dialect != 'postgresql' or len(metric.encode()) <= MAX_IDENTIFIER:
+        return metric
+    return f"{metric[:MAX_IDENTIFIER - 9]}_{hashlib.sha1(metric.encode()).hexdigest()[:8]}"
+
+def read_generation(conn):
+    """Load generation stored in the database (0 before the first load)."""
+    if dialect(conn) == 'postgresql':
+        if not table_type(conn, 'etl_generation'):
+            return 0
+        row = conn.execute("SELECT generation FROM etl_generation").fetchone()
+        return row[0] if row else 0
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+# --- SQLite ---
+
+class SQLiteStorage:
+    """herd.db as a single SQLite file."""
+
+    dialect = 'sqlite'
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.artifact_path = self.path
+
+    def __str__(self):
+        return str(self.path)
+
+    def exists(self):
+        return self.path.exists()
+
+    def generation(self):
+        if not self.exists():
+            return 0
+        with self.connect(readonly=True) as conn:
+            return read_generation(conn)
+
+    @contextmanager
+    def connect(self, readonly=False):
+        if readonly:
+            conn = sqlite3.connect(f"file:{os.fspath(self.path)}?mode=ro", uri=True)
+        else:
+            conn = sqlite3.connect(self.path)
+        with closing(conn):
+            yield conn
+            conn.commit()
+
+    def load(self, fresh=False):
+        import bulk_loader
+        return bulk_loader.staging_database(self.path, fresh)
+
+    def engine(self, pool_size=4):
+        from query_engine import QueryEngine
+        return QueryEngine(self.path, pool_size=pool_size)
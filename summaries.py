@@ -0,0 +1,174 @@
+"""
+Materialized summary tables for peer and trend questions.
+
+etl.py rebuilds them from herd_facts / institution_years after every load,
+so common questions become primary-key lookups instead of scans of the wide
+`institutions` table:
+
+- `metric_trends`: one row per reported (non-zero) value with the
+  year-over-year change, 5- and 10-year CAGR, and the state and national rank
+  among all institutions for that metric and year. Keyed (metric_id,
+  inst_id, year).
+- `peer_groups`: members of every group under `peers` in config.yml, plus
+  the home institution (`institution.inst_id`, flagged `is_home`).
+- `peer_group_stats`: per group, metric and year, the peers' count, total,
+  mean, min and max (unreported values count as 0), and the home
+  institution's value and rank within the group.
+
+`summary_config` records which peer configuration they were built from, so
+editing config.yml triggers a rebuild on the next ETL run.
+"""
+import hashlib
+import json
+import math
+import sqlite3
+from pathlib import Path
+
+import storage
+
+CONFIG_PATH = Path(__file__).parent / "config.yml"
+
+def load_config(path=None):
+    """Parsed config.yml, or {} when it is missing."""
+    import yaml  # only needed here; keeps server.py startup light
+    try:
+        with open(path or CONFIG_PATH) as f:
+            return yaml.safe_load(f) or {}
+    except FileNotFoundError:
+        return {}
+
+def config_hash(config):
+    """Hash of the config.yml sections the summaries depend on."""
+    relevant = {key: config.get(key) for key in ('institution', 'peers')}
+    return hashlib.sha256(json.dumps(relevant, sort_keys=True).encode()).hexdigest()
+
+def stored_config_hash(conn):
+    """config_hash the summaries in `conn` were built with (None if never built)."""
+    if not storage.table_type(conn, 'summary_config'):
+        return None
+    row = conn.execute("SELECT sha256 FROM summary_config").fetchone()
+    return row[0] if row else None
+
+def _ensure_pow(conn):
+    """Older SQLite builds lack the math functions; fall back to Python's."""
+    if storage.dialect(conn) != 'sqlite':
+        return
+    try:
+        conn.execute("SELECT pow(2, 0.5)")
+    except sqlite3.OperationalError:
+        conn.create_function('pow', 2, math.pow, deterministic=True)
+
+def build_metric_trends(conn):
+    conn.execute("DROP TABLE IF EXISTS metric_trends")
+    conn.execute("""
+        CREATE TABLE metric_trends (
+            metric_id INTEGER NOT NULL,
+            inst_id TEXT NOT NULL,
+            year INTEGER NOT NULL,
+            state TEXT,
+            value REAL,
+            yoy_change REAL,
+            yoy_pct REAL,
+            cagr_5yr REAL,
+            cagr_10yr REAL,
+            state_rank INTEGER,
+            national_rank INTEGER,
+            PRIMARY KEY (metric_id, inst_id, year)
+        ) WITHOUT ROWID
+    """)
+    # Earlier years are primary-key lookups into herd_facts; a year without
+    # a reported value leaves the change / growth columns NULL.
+    conn.execute("""
+        INSERT INTO metric_trends
+        SELECT f.metric_id, f.inst_id, f.year, y.state, f.value,
+               f.value - p1.value,
+               CASE WHEN p1.value > 0 THEN f.value / p1.value - 1 END,
+               CASE WHEN p5.value > 0 AND f.value > 0 THEN pow(f.value / p5.value, 1.0 / 5) - 1 END,
+               CASE WHEN p10.value > 0 AND f.value > 0 THEN pow(f.value / p10.value, 1.0 / 10) - 1 END,
+               RANK() OVER (PARTITION BY f.metric_id, f.year, y.state ORDER BY f.value DESC),
+               RANK() OVER (PARTITION BY f.metric_id, f.year ORDER BY f.value DESC)
+        FROM herd_facts f
+        JOIN institution_years y ON y.year = f.year AND y.inst_id = f.inst_id
+        LEFT JOIN herd_facts p1 ON p1.metric_id = f.metric_id AND p1.year = f.year - 1 AND p1.inst_id = f.inst_id
+        LEFT JOIN herd_facts p5 ON p5.metric_id = f.metric_id AND p5.year = f.year - 5 AND p5.inst_id = f.inst_id
+        LEFT JOIN herd_facts p10 ON p10.metric_id = f.metric_id AND p10.year = f.year - 10 AND p10.inst_id = f.inst_id
+    """)
+    # "Top N in a year" lookups
+    conn.execute("CREATE INDEX idx_trends_rank ON metric_trends(metric_id, year, national_rank)")
+
+def build_peer_groups(conn, config):
+    conn.execute("DROP TABLE IF EXISTS peer_groups")
+    conn.execute("""
+        CREATE TABLE peer_groups (
+            group_name TEXT NOT NULL,
+            inst_id TEXT NOT NULL,
+            name TEXT,
+            is_home INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (inst_id, group_name)
+        ) WITHOUT ROWID
+    """)
+    home = config.get('institution') or {}
+    rows = {}  # (group, inst_id) -> row; the first listing wins, home first
+    for group_name, members in (config.get('peers') or {}).items():
+        if home.get('inst_id'):
+            rows[(group_name, str(home['inst_id']))] = (
+                group_name, str(home['inst_id']), home.get('short_name') or home.get('name'), 1)
+        for m in members or []:
+            rows.setdefault((group_name, str(m['id'])), (group_name, str(m['id']), m.get('name'), 0))
+    conn.executemany("INSERT INTO peer_groups VALUES (?, ?, ?, ?)", list(rows.values()))
+
+def build_peer_group_stats(conn):
+    conn.execute("DROP TABLE IF EXISTS peer_group_stats")
+    conn.execute("""
+        CREATE TABLE peer_group_stats (
+            group_name TEXT NOT NULL,
+            metric_id INTEGER NOT NULL,
+            year INTEGER NOT NULL,
+            n_peers INTEGER,
+            peer_total REAL,
+            peer_mean REAL,
+            peer_min REAL,
+            peer_max REAL,
+            home_value REAL,
+            home_rank INTEGER,
+            PRIMARY KEY (group_name, metric_id, year)
+        ) WITHOUT ROWID
+    """)
+    # n_peers counts peers in the survey that year, so peers that reported
+    # nothing for a metric pull the mean and minimum towards 0.
+    conn.execute("""
+        INSERT INTO peer_group_stats
+        WITH present AS (
+            SELECT g.group_name, y.year, COUNT(*) AS n_peers
+            FROM peer_groups g JOIN institution_years y ON y.inst_id = g.inst_id
+            WHERE g.is_home = 0
+            GROUP BY g.group_name, y.year
+        ),
+        ranked AS (
+            SELECT g.group_name, g.is_home, f.metric_id, f.year, f.value,
+                   RANK() OVER (PARTITION BY g.group_name, f.metric_id, f.year ORDER BY f.value DESC) AS group_rank
+            FROM herd_facts f JOIN peer_groups g ON g.inst_id = f.inst_id
+        )
+        SELECT r.group_name, r.metric_id, r.year, p.n_peers,
+               COALESCE(SUM(CASE WHEN r.is_home = 0 THEN r.value END), 0),
+               COALESCE(SUM(CASE WHEN r.is_home = 0 THEN r.value END), 0) / p.n_peers,
+               CASE WHEN SUM(CASE WHEN r.is_home = 0 THEN 1 ELSE 0 END) < p.n_peers THEN 0
+                    ELSE MIN(CASE WHEN r.is_home = 0 THEN r.value END) END,
+               COALESCE(MAX(CASE WHEN r.is_home = 0 THEN r.value END), 0),
+               MAX(CASE WHEN r.is_home = 1 THEN r.value END),
+               MAX(CASE WHEN r.is_home = 1 THEN r.group_rank END)
+        FROM ranked r
+        JOIN present p ON p.group_name = r.group_name AND p.year = r.year
+        GROUP BY r.group_name, r.metric_id, r.year, p.n_peers
+    """)
+
+def build_summary_tables(conn, config):
+    """(Re)builds every summary table inside the current load transaction."""
+    _ensure_pow(conn)
+    build_metric_trends(conn)
+    build_peer_groups(conn, config)
+    build_peer_group_stats(conn)
+
+    conn.execute("DROP TABLE IF EXISTS summary_config")
+    conn.execute("CREATE TABLE summary_config (sha256 TEXT)")
+    conn.execute("INSERT INTO summary_config VALUES (?)", (config_hash(config),))